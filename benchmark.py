@@ -0,0 +1,1093 @@
+# Benchmark su database sintetico
+#
+# Uso:
+#   python benchmark.py distinte --distinte 10000 --componenti 500000
+#   python benchmark.py piano
+#   python benchmark.py carico --secondi 10
+#   python benchmark.py lamiere --codici 5000
+#   python benchmark.py approvvigionamenti --produzioni 2000
+#   python benchmark.py fornitori --componenti 5000 --fornitori 50
+#   python benchmark.py ricerca --componenti 100000
+#   python benchmark.py dove-usato --distinte 2000
+#   python benchmark.py numerazione --processi 4 --thread 4
+#   python benchmark.py rotte --json prima.json
+#   python benchmark.py rotte --confronta prima.json
+#
+# Il database viene generato in una cartella temporanea (mai su database.db)
+# con un seed fisso, cosi' i risultati sono confrontabili tra versioni.
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import main_6
+
+MACROZONE = ['Telaio', 'Carrozzeria', 'Coperchio', 'Base', 'Maniglie', 'Aria', 'Supporti']
+MATERIALI = ['S235', 'AISI304', 'AISI430', 'Corten', 'Alluminio']
+SPESSORI = ['1', '1.5', '2', '3', '4', '5']
+TIPI = ['Acquisto', 'Produzione']
+
+
+# Crea lo schema con init_db() e lo popola con dati casuali ripetibili
+def genera_database(percorso, n_distinte, n_componenti, n_fornitori=20, n_ordini=1000, seed=42):
+    rnd = random.Random(seed)
+    main_6.prepara_db(percorso)
+
+    conn = sqlite3.connect(percorso)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO distinte (id, codice, descrizione) VALUES (?, ?, ?)",
+        ((i, f"DB-{i:06d}", f"Distinta sintetica {i}") for i in range(1, n_distinte + 1)))
+
+    def componenti():
+        for i in range(1, n_componenti + 1):
+            macrozona = rnd.choice(MACROZONE)
+            nome = f"Particolare {i}"
+            yield (i, rnd.randint(1, n_distinte), macrozona, nome,
+                   f"{macrozona[:3].upper()}-{i:07d}", rnd.choice(MATERIALI),
+                   rnd.choice(SPESSORI), rnd.randint(1, 20), "Taglio laser",
+                   round(rnd.uniform(0.5, 250), 2), rnd.choice(TIPI))
+
+    c.executemany('''
+        INSERT INTO componenti (
+            id, id_distinta, macrozona, nome, codice, materiale,
+            spessore, qty, lavorazioni, costo, tipo
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', componenti())
+
+    c.executemany(
+        "INSERT INTO fornitori (id, nome, email, telefono) VALUES (?, ?, ?, ?)",
+        ((i, f"Fornitore {i}", f"ordini@fornitore{i}.it", f"0{i:09d}") for i in range(1, n_fornitori + 1)))
+
+    def prezzi():
+        for id_comp in range(1, n_componenti + 1):
+            for id_forn in rnd.sample(range(1, n_fornitori + 1), rnd.randint(1, min(3, n_fornitori))):
+                yield id_comp, id_forn, round(rnd.uniform(0.5, 250), 2)
+
+    c.executemany(
+        "INSERT INTO prezzi_fornitori (id_componente, id_fornitore, prezzo) VALUES (?, ?, ?)", prezzi())
+    # Listino da sempre con il prezzo base; un componente su tre ha anche gli scaglioni 100 e 500
+    c.execute('''
+        INSERT INTO listini_fornitori (id_componente, id_fornitore, valido_dal, qty_minima, prezzo)
+        SELECT pf.id_componente, pf.id_fornitore, ?, s.qty, ROUND(pf.prezzo * s.fattore, 2)
+        FROM prezzi_fornitori pf
+        JOIN (SELECT 1 AS qty, 1.0 AS fattore UNION ALL SELECT 100, 0.9 UNION ALL SELECT 500, 0.8) s
+          ON s.qty = 1 OR pf.id_componente % 3 = 0
+    ''', (main_6.LISTINO_DA_SEMPRE,))
+
+    def ordini():
+        for i in range(1, n_ordini + 1):
+            data = f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+            yield i, f"ORD-{i:06d}", rnd.randint(1, n_fornitori), data, f"OC-{rnd.randint(1, n_distinte)}"
+
+    ordini = list(ordini())
+    c.executemany('''
+        INSERT INTO ordini_fornitore (id, numero_ordine, id_fornitore, data_ordine, riferimento_oc)
+        VALUES (?, ?, ?, ?, ?)
+    ''', ordini)
+
+    def righe():
+        for id_ordine, _, _, data, _ in ordini:
+            for _ in range(rnd.randint(1, 20)):
+                confermata = data if rnd.random() < 0.7 else None
+                consegna = data if confermata and rnd.random() < 0.6 else None
+                yield (id_ordine, rnd.randint(1, n_componenti), rnd.randint(1, 100),
+                       data, confermata, consegna)
+
+    c.executemany('''
+        INSERT INTO righe_ordine_fornitore (
+            id_ordine, id_componente, qty, data_richiesta, data_confermata, data_consegna
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    ''', righe())
+    conn.commit()
+    conn.close()
+
+
+# Conta (e registra) le istruzioni SQL eseguite dalle view nel blocco
+@contextlib.contextmanager
+def conta_query():
+    contatore = {'query': 0, 'sql': []}
+    get_db_originale = main_6.get_db
+
+    def traccia(sql):
+        contatore['query'] += 1
+        contatore['sql'].append(sql)
+
+    def get_db():
+        conn = get_db_originale()
+        conn.set_trace_callback(traccia)
+        return conn
+
+    main_6.get_db = get_db
+    try:
+        yield contatore
+    finally:
+        main_6.get_db = get_db_originale
+        # Le connessioni del pool hanno ancora il trace: si riaprono da zero
+        main_6.chiudi_pool()
+
+
+# Misura la pagina /distinte su piu' pagine e ordinamenti: il numero di query
+# deve restare costante qualunque sia la dimensione del database
+def bench_distinte(percorso, ripetizioni=5):
+    main_6.DB_NAME = percorso
+    client = main_6.app.test_client()
+    casi = [
+        {},
+        {'pagina': 50},
+        {'ordina': 'costo', 'dir': 'desc'},
+        {'ordina': 'componenti', 'dir': 'asc', 'pagina': 3},
+        {'codice': 'DB-0001'},
+    ]
+    risultati = []
+    for parametri in casi:
+        tempi = []
+        for _ in range(ripetizioni):
+            with conta_query() as contatore:
+                inizio = time.perf_counter()
+                risposta = client.get('/distinte', query_string=parametri)
+                tempi.append(time.perf_counter() - inizio)
+            assert risposta.status_code == 200, risposta.status_code
+        risultati.append((parametri, contatore['query'], min(tempi), sorted(tempi)[len(tempi) // 2]))
+
+    print(f"{'parametri':<45} {'query':>6} {'min ms':>9} {'p50 ms':>9}")
+    for parametri, n_query, minimo, mediana in risultati:
+        print(f"{str(parametri):<45} {n_query:>6} {minimo * 1000:>9.1f} {mediana * 1000:>9.1f}")
+
+    conteggi = {n_query for _, n_query, _, _ in risultati}
+    if len(conteggi) != 1:
+        raise SystemExit(f"Numero di query non costante: {sorted(conteggi)}")
+    print(f"OK: {conteggi.pop()} query per richiesta")
+
+
+# Pagine in sola lettura da controllare con EXPLAIN QUERY PLAN
+ROUTE_PIANO = [
+    ('GET', '/distinte', {}),
+    ('GET', '/distinte', {'ordina': 'costo', 'dir': 'desc'}),
+    ('GET', '/distinte', {'codice': 'DB-0001', 'pagina': 2}),
+    ('GET', '/distinta/1', {}),
+    ('GET', '/distinta/1/revisioni', {'da': 1, 'a': 2}),
+    ('GET', '/componente/1/fornitori', {}),
+    ('GET', '/componente/1/modifica', {}),
+    ('POST', '/simula/1', {'qty': 10}),
+    ('GET', '/genera-ordine/1', {}),
+    ('POST', '/genera-ordine/1', {'qty_produzione': 5}),
+    ('GET', '/fornitori', {}),
+    ('GET', '/ordini-fornitore', {}),
+    ('GET', '/ordini-fornitore', {'dopo': '2025-06-15_500'}),
+    ('GET', '/ordini-fornitore', {'fornitore': 3, 'stato': 'giallo'}),
+    ('GET', '/ordini-fornitore', {'dal': '2025-03-01', 'al': '2025-04-30', 'prima': '2025-03-10_1'}),
+    ('GET', '/ordine-fornitore/1', {}),
+    ('GET', '/ordine-fornitore/1/modifica', {}),
+    ('GET', '/ordine-fornitore/manuale', {}),
+    ('GET', '/mrp', {}),
+    ('POST', '/mrp', {'azione': 'calcola', 'richieste': 'DB-000001 5\nDB-000002 3'}),
+    ('GET', '/piano-approvvigionamenti', {'dal': '2025-01-01', 'periodo': 'mese'}),
+    ('GET', '/componenti/cerca', {'q': 'aisi304 tel'}),
+    ('GET', '/componenti/cerca', {'q': 'particolare 12', 'materiale': 'S235', 'pagina': 2}),
+    ('GET', '/api/componenti/cerca', {'q': 'carrozeria'}),
+    ('GET', '/dove-usato', {'codice': 'tel-0000001', 'variazione': 10}),
+    ('GET', '/api/dove-usato', {'materiale': 'S235', 'spessore': '2'}),
+    ('GET', '/api/dove-usato', {'fornitore': 3}),
+    ('GET', '/api/impatto-prezzo', {'materiale': 'AISI304', 'variazione': 5}),
+]
+
+# Anagrafiche piccole che le pagine elencano per intero: la scansione e' voluta
+TABELLE_ELENCO = {'distinte', 'fornitori', 'statistiche_fornitori', 'consegne_fornitore'}
+
+# Query note che leggono una tabella grande per intero
+QUERY_AMMESSE = set()
+
+
+# Mappa alias -> tabella reale per leggere le righe del piano (che usano gli alias)
+def alias_tabelle(sql, tabelle):
+    alias = {}
+    for tabella, nome in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.I):
+        if tabella in tabelle:
+            alias[tabella] = tabella
+            if nome and nome.upper() not in ('WHERE', 'JOIN', 'LEFT', 'ON', 'GROUP', 'ORDER', 'LIMIT'):
+                alias[nome] = tabella
+    return alias
+
+
+# Esegue le pagine, raccoglie le SELECT e ritorna quelle che leggono per intero
+# una tabella grande (SCAN senza indice o indice automatico costruito al volo)
+# come (url, tabella, riga del piano, sql)
+def scansioni_complete(percorso):
+    main_6.DB_NAME = percorso
+    client = main_6.app.test_client()
+    conn = sqlite3.connect(percorso)
+    tabelle = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    errori = []
+    for metodo, url, parametri in ROUTE_PIANO:
+        with conta_query() as contatore:
+            if metodo == 'GET':
+                risposta = client.get(url, query_string=parametri)
+            else:
+                risposta = client.post(url, data=parametri)
+        assert risposta.status_code == 200, (url, risposta.status_code)
+
+        for sql in contatore['sql']:
+            testo = ' '.join(sql.split())
+            if not re.match(r'(SELECT|WITH)\b', testo, re.I) or testo in QUERY_AMMESSE:
+                continue
+            alias = alias_tabelle(testo, tabelle)
+            for riga in conn.execute("EXPLAIN QUERY PLAN " + sql):
+                dettaglio = riga[3]
+                m = re.match(r'(SCAN|SEARCH) (\w+)', dettaglio)
+                if not m or alias.get(m.group(2)) is None:
+                    continue
+                tabella = alias[m.group(2)]
+                scansione = m.group(1) == 'SCAN' and 'INDEX' not in dettaglio
+                if (scansione and tabella not in TABELLE_ELENCO) or 'AUTOMATIC' in dettaglio:
+                    errori.append((url, tabella, dettaglio, testo))
+    conn.close()
+    return errori
+
+
+def verifica_piani(percorso):
+    errori = scansioni_complete(percorso)
+    for url, tabella, dettaglio, testo in errori:
+        print(f"{url}: {tabella}: {dettaglio}\n    {testo}")
+    if errori:
+        raise SystemExit(f"{len(errori)} query leggono una tabella per intero")
+    print(f"OK: nessuna scansione completa in {len(ROUTE_PIANO)} pagine")
+
+
+# Vecchio strato di connessione: una connessione nuova per richiesta, journal
+# rollback e nessun pool, per confrontare le prestazioni
+@contextlib.contextmanager
+def senza_pool(percorso):
+    apri_originale, pool_originale = main_6._apri_connessione, main_6.POOL_MAX
+    main_6.chiudi_pool()
+    conn = sqlite3.connect(percorso)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+    main_6._apri_connessione = lambda p: sqlite3.connect(p, check_same_thread=False,
+                                                         factory=main_6.ConnessioneStrumentata)
+    main_6.POOL_MAX = 0
+    try:
+        yield
+    finally:
+        main_6._apri_connessione, main_6.POOL_MAX = apri_originale, pool_originale
+
+
+# Lettori concorrenti sulle pagine piu' usate mentre un altro thread genera
+# ordini fornitore in continuazione; ritorna richieste/s dei lettori
+def carico(percorso, n_distinte, secondi, lettori):
+    main_6.DB_NAME = percorso
+    stop = threading.Event()
+    conteggi = {'letture': 0, 'errori': 0, 'ordini': 0}
+    lock = threading.Lock()
+    pagine = ['/distinte', '/distinta/{}', '/ordini-fornitore', '/ordine-fornitore/{}', '/componente/{}/fornitori']
+
+    def lettore(n):
+        client = main_6.app.test_client()
+        i = n
+        while not stop.is_set():
+            i += 1
+            url = pagine[i % len(pagine)].format(i % n_distinte + 1)
+            esito = client.get(url).status_code
+            with lock:
+                conteggi['letture' if esito == 200 else 'errori'] += 1
+
+    def scrittore():
+        client = main_6.app.test_client()
+        i = 0
+        while not stop.is_set():
+            i += 1
+            esito = client.post(f'/genera-ordine/{i % n_distinte + 1}', data={'qty_produzione': 5, 'azione': 'conferma'}).status_code
+            with lock:
+                conteggi['ordini' if esito == 302 else 'errori'] += 1
+
+    threads = [threading.Thread(target=lettore, args=(n,)) for n in range(lettori)]
+    threads.append(threading.Thread(target=scrittore))
+    for t in threads:
+        t.start()
+    time.sleep(secondi)
+    stop.set()
+    for t in threads:
+        t.join()
+    main_6.chiudi_pool()
+    return conteggi['letture'] / secondi, conteggi['ordini'] / secondi, conteggi['errori']
+
+
+# Ogni modalita' parte da una copia del database appena generato: lo scrittore
+# aggiunge ordini e renderebbe piu' lenta la seconda misura
+def confronta_carico(percorso, n_distinte, secondi, lettori):
+    shutil.copy(percorso, percorso + '.prima')
+    shutil.copy(percorso, percorso + '.dopo')
+    with senza_pool(percorso + '.prima'):
+        prima = carico(percorso + '.prima', n_distinte, secondi, lettori)
+    dopo = carico(percorso + '.dopo', n_distinte, secondi, lettori)
+
+    print(f"{'':<12} {'letture/s':>10} {'ordini/s':>10} {'errori':>8}")
+    for nome, (letture, ordini, errori) in (('senza pool', prima), ('pool + WAL', dopo)):
+        print(f"{nome:<12} {letture:>10.1f} {ordini:>10.1f} {errori:>8}")
+    print(f"Lettori: x{dopo[0] / max(prima[0], 1e-9):.2f}")
+
+
+# Stima lamiere su pezzi casuali: n codici distinti per (materiale, spessore),
+# ognuno con quantita' casuale fino a quantita_max
+def bench_lamiere(n_codici, quantita_max, seed):
+    rnd = random.Random(seed)
+    pezzi = []
+    for i in range(n_codici):
+        w, h = rnd.uniform(20, 1400), rnd.uniform(20, 1400)
+        riga = (i, 1, 'Telaio', f'P{i}', f'P{i}', rnd.choice(MATERIALI), rnd.choice(SPESSORI))
+        geometria = main_6.GeometriaDxf(0, 0, w, h, 2 * (w + h), w * h * 0.8, 1, 0, 4, 0)
+        pezzi.append((riga, rnd.randint(1, quantita_max), geometria))
+
+    tempi = []
+    for _ in range(3):
+        inizio = time.perf_counter()
+        stime = main_6.stima_lamiere(pezzi)
+        tempi.append(time.perf_counter() - inizio)
+    print(f"{n_codici} codici, {sum(s.n_pezzi for s in stime)} pezzi, {len(stime)} gruppi, "
+          f"{sum(s.n_fogli for s in stime)} fogli: {min(tempi) * 1000:.1f} ms")
+
+
+# Istanza casuale di scelta fornitori: ogni componente ha 2-6 offerte, i
+# fornitori hanno costo d'ordine e in parte un minimo d'ordine
+def istanza_fornitori(rnd, n_componenti, n_fornitori):
+    costi = np.full((n_componenti, n_fornitori), np.inf)
+    for i in range(n_componenti):
+        base = rnd.uniform(0.05, 5) * rnd.randint(1, 20)
+        for j in rnd.sample(range(n_fornitori), min(n_fornitori, rnd.randint(2, 6))):
+            costi[i, j] = base * rnd.uniform(0.8, 1.3)
+    fissi = np.array([rnd.uniform(20, 300) for _ in range(n_fornitori)])
+    minimi = np.array([rnd.choice([0, 0, rnd.uniform(200, 5000)]) for _ in range(n_fornitori)])
+    return costi, fissi, minimi
+
+
+# Euristica su un'istanza grande (tempo e risparmio sul solo prezzo minimo) e
+# confronto con l'ottimo per enumerazione su istanze piccole
+def bench_fornitori(n_componenti, n_fornitori, seed):
+    rnd = random.Random(seed)
+    costi, fissi, minimi = istanza_fornitori(rnd, n_componenti, n_fornitori)
+    tempi = []
+    for _ in range(3):
+        inizio = time.perf_counter()
+        assegnazione = main_6.ottimizza_fornitori(costi, fissi, minimi)
+        tempi.append(time.perf_counter() - inizio)
+    base = np.argmin(costi, axis=1)
+    prima = main_6._costo_fornitori(costi, base, fissi, minimi)
+    dopo = main_6._costo_fornitori(costi, assegnazione, fissi, minimi)
+    print(f"{n_componenti} componenti, {n_fornitori} fornitori: {min(tempi) * 1000:.1f} ms, "
+          f"fornitori {len(np.unique(base))} -> {len(np.unique(assegnazione))}, "
+          f"costo {prima:.2f} -> {dopo:.2f} ({(1 - dopo / prima) * 100:.1f}% in meno)")
+
+    scarti = []
+    for _ in range(300):
+        costi, fissi, minimi = istanza_fornitori(rnd, rnd.randint(2, 7), rnd.randint(2, 4))
+        offerte = [np.flatnonzero(np.isfinite(riga)) for riga in costi]
+        ottimo = min(main_6._costo_fornitori(costi, np.array(scelta), fissi, minimi)
+                     for scelta in itertools.product(*offerte))
+        trovato = main_6._costo_fornitori(costi, main_6.ottimizza_fornitori(costi, fissi, minimi), fissi, minimi)
+        assert trovato <= main_6._costo_fornitori(costi, np.argmin(costi, axis=1), fissi, minimi) + 1e-6
+        scarti.append(trovato / ottimo - 1)
+    scarti = np.array(scarti)
+    print(f"Istanze piccole: ottimo in {np.mean(scarti < 1e-9) * 100:.0f}% dei casi, "
+          f"scarto medio {scarti.mean() * 100:.2f}%, massimo {scarti.max() * 100:.1f}%")
+
+
+# Un anno di produzioni casuali delle distinte e giacenze per meta' dei componenti
+def aggiungi_produzioni(conn, rnd, n_distinte, n_produzioni):
+    conn.executemany(
+        "INSERT INTO produzioni (id_distinta, qty_prodotta, data_produzione) VALUES (?, ?, ?)",
+        ((rnd.randint(1, n_distinte), rnd.randint(1, 50), f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}")
+         for _ in range(n_produzioni)))
+    n_componenti = conn.execute("SELECT MAX(id) FROM componenti").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO magazzino (id_componente, giacenza) VALUES (?, ?)",
+        ((id_comp, rnd.randint(0, 200)) for id_comp in range(1, n_componenti + 1, 2)))
+    conn.commit()
+
+
+# Piano a periodi su un anno di produzioni casuali di tutte le distinte, con
+# giacenze per meta' dei componenti; il totale pianificato non puo' essere
+# inferiore al netto dell'MRP sulle stesse produzioni
+def bench_approvvigionamenti(percorso, n_distinte, n_produzioni, seed):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(percorso)
+    aggiungi_produzioni(conn, rnd, n_distinte, n_produzioni)
+    conn.close()
+
+    main_6.DB_NAME = percorso
+    with main_6.app.app_context():
+        c = main_6.get_db().cursor()
+        for periodo in main_6.PIANO_PERIODI:
+            inizio = time.perf_counter()
+            piano = main_6.piano_approvvigionamenti(c, '2025-01-01', 12, periodo)
+            secondi = time.perf_counter() - inizio
+            print(f"{periodo:<10} {len(piano.periodi):>3} periodi, {piano.matrice.shape[0]} componenti, "
+                  f"{len(piano.ordini)} ordini pianificati: {secondi:.2f}s")
+
+        c.execute("SELECT id_distinta, SUM(qty_prodotta) FROM produzioni GROUP BY id_distinta")
+        netto = sum(f.netto for f in main_6.fabbisogno_netto(c, c.fetchall()))
+        pianificato = sum(o.qty for o in piano.ordini)
+        print(f"Netto MRP {netto:.0f}, pianificato {pianificato:.0f} "
+              f"(di piu' per gli arrivi dopo il fabbisogno o oltre l'orizzonte)")
+        assert pianificato >= netto - 1e-6 * max(netto, 1)
+
+
+# Latenza dell'autocompletamento via HTTP (client di test) su prefissi brevi,
+# parole intere, codici e parole con un errore di battitura
+def bench_ricerca(percorso, ripetizioni, seed):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(percorso)
+    n_componenti = conn.execute("SELECT MAX(id) FROM componenti").fetchone()[0]
+    codici = [conn.execute("SELECT codice FROM componenti WHERE id = ?", (rnd.randint(1, n_componenti),)).fetchone()[0]
+              for _ in range(ripetizioni)]
+    conn.close()
+
+    def refuso(parola):
+        i = rnd.randrange(len(parola) - 1)
+        return parola[:i] + parola[i + 1] + parola[i] + parola[i + 2:]
+
+    casi = {
+        'prefisso': lambda: rnd.choice(MACROZONE + MATERIALI)[:rnd.randint(2, 4)],
+        'parole': lambda: f"{rnd.choice(MATERIALI)} {rnd.choice(MACROZONE)}",
+        'codice': lambda: rnd.choice(codici)[:rnd.randint(5, 11)],
+        'refuso': lambda: refuso(rnd.choice(MACROZONE + ['particolare', 'alluminio'])).lower(),
+    }
+
+    main_6.DB_NAME = percorso
+    client = main_6.app.test_client()
+    client.get('/api/componenti/cerca', query_string={'q': 'riscaldamento'})
+    print(f"{'caso':<10} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'risultati':>10}")
+    peggiore = 0
+    for caso, genera in casi.items():
+        tempi = []
+        trovati = 0
+        for _ in range(ripetizioni):
+            inizio = time.perf_counter()
+            risposta = client.get('/api/componenti/cerca', query_string={'q': genera()})
+            tempi.append(time.perf_counter() - inizio)
+            assert risposta.status_code == 200, risposta.status_code
+            trovati += bool(risposta.get_json()['risultati'])
+        tempi.sort()
+        p95 = tempi[int(len(tempi) * 0.95)]
+        peggiore = max(peggiore, p95)
+        print(f"{caso:<10} {tempi[len(tempi) // 2] * 1000:>9.1f} {p95 * 1000:>9.1f} "
+              f"{tempi[-1] * 1000:>9.1f} {trovati:>5}/{ripetizioni}")
+    if peggiore > 0.020:
+        raise SystemExit(f"p95 {peggiore * 1000:.1f} ms oltre i 20 ms")
+    print("OK: p95 sotto i 20 ms")
+
+
+# Collega le distinte in una gerarchia: ogni distinta usa fino a due distinte
+# con id maggiore tramite un componente, cosi' i trigger tengono aggiornata la
+# chiusura. Ritorna i legami (padre, figlio, qty).
+def collega_distinte(conn, rnd, n_distinte):
+    legami = [(padre, rnd.randint(padre + 1, n_distinte), rnd.randint(1, 3))
+              for padre in range(1, n_distinte) for _ in range(rnd.randint(0, 2))]
+    conn.executemany(
+        "INSERT INTO componenti (id_distinta, nome, qty, costo, tipo, id_sottodistinta) "
+        "VALUES (?, 'Sottoassieme', ?, 0, 'Produzione', ?)",
+        ((padre, qty, figlio) for padre, figlio, qty in legami))
+    conn.commit()
+    return legami
+
+
+# Distinte multilivello (collega_distinte), poi misura dove usato e impatto di
+# prezzo e confronta l'impatto con l'esplosione di tutte le distinte
+def bench_dove_usato(percorso, n_distinte, seed):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(percorso)
+    inizio = time.perf_counter()
+    legami = collega_distinte(conn, rnd, n_distinte)
+    n_chiusura = conn.execute("SELECT COUNT(*) FROM legami_distinte").fetchone()[0]
+    print(f"{len(legami)} legami inseriti in {time.perf_counter() - inizio:.2f}s, "
+          f"{n_chiusura} coppie nella chiusura")
+    codice = conn.execute("SELECT codice FROM componenti WHERE id_distinta = ? AND id_sottodistinta IS NULL",
+                          (n_distinte,)).fetchone()[0]
+    a_listino = {r[0] for r in conn.execute("SELECT id_componente FROM prezzi_fornitori WHERE id_fornitore = 3")}
+    conn.close()
+
+    main_6.DB_NAME = percorso
+    # (parametri, righe esplose trovate); riga = (id, id_distinta, macrozona, nome, codice, materiale, spessore, ...)
+    casi = [
+        ({'codice': codice, 'prezzo': 999}, lambda riga: riga[4] == codice),
+        ({'materiale': 'S235', 'spessore': '2', 'variazione': 10}, lambda riga: riga[5:7] == ('S235', '2')),
+        ({'materiale': 'AISI304', 'variazione': -5}, lambda riga: riga[5] == 'AISI304'),
+        ({'fornitore': '3', 'variazione': 8}, lambda riga: riga[0] in a_listino),
+    ]
+    with main_6.app.app_context():
+        c = main_6.get_db().cursor()
+        esplosione = main_6.esplodi_distinta(c, list(range(1, n_distinte + 1)))
+        print(f"{'ricerca':<45} {'distinte':>9} {'ms':>9}")
+        for args, trovata in casi:
+            righe_sql, parametri, descrizione = main_6.righe_dove_usato(args)
+            prezzo, variazione = main_6.leggi_modifica_prezzo({k: str(v) for k, v in args.items()})
+            tempi = []
+            for _ in range(5):
+                inizio = time.perf_counter()
+                impieghi = main_6.dove_usato(c, righe_sql, parametri, prezzo, variazione)
+                tempi.append(time.perf_counter() - inizio)
+            print(f"{descrizione:<45} {len(impieghi):>9} {min(tempi) * 1000:>9.1f}")
+
+            # Stesse distinte e stessa variazione dalle righe foglia esplose di ogni distinta
+            attese = {id_d for id_d, fabbisogno in esplosione.fabbisogni.items()
+                      if any(trovata(esplosione.componenti[id_comp]) for id_comp in fabbisogno)}
+            assert attese <= {impiego.id_distinta for impiego in impieghi}
+            for impiego in impieghi:
+                righe = [(esplosione.componenti[id_comp], qty)
+                         for id_comp, qty in esplosione.fabbisogni[impiego.id_distinta].items()]
+                attesa = sum(qty * ((prezzo - riga[8]) if prezzo is not None else riga[8] * variazione / 100)
+                             for riga, qty in righe if trovata(riga))
+                assert abs(impiego.variazione - attesa) <= 1e-6 * max(1, abs(attesa)), (impiego, attesa)
+    print("OK: impatto uguale a quello dell'esplosione")
+
+
+# Suite di tutte le route
+#
+# Ogni endpoint dell'app ha almeno un caso: una funzione che per la richiesta
+# i ritorna (metodo, url, argomenti del client di test). I casi girano in
+# ordine, ognuno con una richiesta di riscaldamento, le ripetizioni misurate e
+# un'ultima richiesta sotto tracemalloc per il picco di memoria Python (la
+# memoria interna di SQLite non e' compresa). Le letture vengono prima, poi le
+# modifiche: le revisioni leggono le distinte modificate dai casi precedenti e
+# le eliminazioni usano ordini della meta' alta, che le letture non toccano.
+# Le istruzioni SQL sono quelle contate dalla strumentazione dell'app
+# (Server-Timing), comprese quelle eseguite durante lo streaming della risposta.
+
+Caso = namedtuple('Caso', 'nome endpoint richiesta stato attendi', defaults=(200, False))
+
+# Soglie per --confronta: una route regredisce se il p50 o il p95 crescono
+# oltre il rapporto e di almeno REGRESSIONE_MARGINE_MS (il p95 su poche
+# ripetizioni risente di una sola misura disturbata), o se esegue piu'
+# istruzioni SQL di prima
+REGRESSIONE_P50 = 1.5
+REGRESSIONE_P95 = 2.0
+REGRESSIONE_MARGINE_MS = 5.0
+
+DXF_RETTANGOLO = "0\nSECTION\n2\nENTITIES\n{}0\nENDSEC\n0\nEOF\n"
+DXF_LINEA = "0\nLINE\n8\n0\n10\n{}\n20\n{}\n11\n{}\n21\n{}\n"
+
+
+# Disegno DXF di un rettangolo lato x lato/2, diverso per ogni richiesta
+def dxf_rettangolo(lato):
+    vertici = [(0, 0), (lato, 0), (lato, lato / 2), (0, lato / 2)]
+    linee = "".join(DXF_LINEA.format(*a, *b) for a, b in zip(vertici, vertici[1:] + vertici[:1]))
+    return DXF_RETTANGOLO.format(linee).encode('ascii')
+
+
+def casi_rotte(client, conn, rnd, n_distinte, n_componenti, n_fornitori, n_ordini, n_richieste, esiti):
+    def casuali(n):
+        return [rnd.randint(1, n) for _ in range(n_richieste)]
+
+    def uno(sql, *parametri):
+        return conn.execute(sql, parametri).fetchone()
+
+    distinte, componenti, fornitori = casuali(n_distinte), casuali(n_componenti), casuali(n_fornitori)
+    ordini = casuali(n_ordini // 2)
+    codici = [uno("SELECT codice FROM componenti WHERE id = ?", id_c)[0] for id_c in componenti]
+    parole = [f"{rnd.choice(MATERIALI)} {rnd.choice(MACROZONE)[:rnd.randint(2, 5)]}" for _ in range(n_richieste)]
+    # Distinte modificate (una per richiesta) e ordini da eliminare, mai letti dalle altre richieste
+    modificate = rnd.sample(range(1, n_distinte + 1), n_richieste)
+    esportate = rnd.sample(range(1, n_distinte + 1), n_richieste)
+    eliminati = list(range(n_ordini, n_ordini - n_richieste, -1))
+    ridotti = list(range(n_ordini // 2 + 1, n_ordini // 2 + 1 + n_richieste))
+
+    def get(url, **parametri):
+        return 'GET', url, {'query_string': parametri}
+
+    def post(url, **dati):
+        return 'POST', url, {'data': dati}
+
+    def componente_di(id_distinta):
+        return uno("SELECT id FROM componenti WHERE id_distinta = ? AND id_sottodistinta IS NULL ORDER BY id",
+                   id_distinta)[0]
+
+    def modifica_ordine(i):
+        testata = uno("SELECT numero_ordine, riferimento_oc, data_ordine FROM ordini_fornitore WHERE id = ?",
+                      ordini[i])
+        righe = conn.execute("SELECT id, qty + 1, data_richiesta, data_confermata, data_consegna "
+                             "FROM righe_ordine_fornitore WHERE id_ordine = ?", (ordini[i],)).fetchall()
+        campi = dict(zip(['riga_id', 'qty', 'data_richiesta', 'data_confermata', 'data_consegna'],
+                         map(list, zip(*righe)))) if righe else {}
+        return post(f'/ordine-fornitore/{ordini[i]}/modifica', numero_ordine=testata[0], riferimento_oc=testata[1],
+                    data_ordine=testata[2], **{k: [v or '' for v in valori] for k, valori in campi.items()})
+
+    def elimina_riga(i):
+        id_riga, = uno("SELECT MIN(id) FROM righe_ordine_fornitore WHERE id_ordine = ?", ridotti[i])
+        return post(f'/ordine-fornitore/{ridotti[i]}/riga/{id_riga}/elimina')
+
+    def importa(i):
+        xlsx = client.get(f'/distinta/{modificate[i]}/export_excel').get_data()
+        return 'POST', f'/distinta/{modificate[i]}/importa', {
+            'data': {'file': (io.BytesIO(xlsx), 'import.xlsx')}, 'content_type': 'multipart/form-data'}
+
+    def carica_file(i):
+        id_c = componente_di(modificate[i])
+        return 'POST', f'/componente/{id_c}/carica-file/{modificate[i]}', {
+            'data': {'file': (io.BytesIO(dxf_rettangolo(100 + i)), f'pezzo_{i}.dxf')},
+            'content_type': 'multipart/form-data'}
+
+    def allegato(i):
+        hash_file, nome = uno("SELECT file, nome_file FROM componenti WHERE id = ?", componente_di(modificate[i]))
+        return get(f'/allegati/{hash_file}/{nome}')
+
+    def componente(i):
+        return dict(macrozona=rnd.choice(MACROZONE), nome=f"Suite {i}", materiale=rnd.choice(MATERIALI),
+                    spessore=rnd.choice(SPESSORI), qty=rnd.randint(1, 20), lavorazioni="Piega",
+                    costo=round(rnd.uniform(0.5, 250), 2), tipo='Acquisto')
+
+    def job_pdf(campo):
+        return lambda i: get(esiti['avvia_export_pdf'].get_json()[campo])
+
+    return [
+        # Letture
+        Caso('dashboard', 'dashboard', lambda i: get('/')),
+        Caso('static', 'static', lambda i: get('/static/logo_it_saldature.png')),
+        Caso('metriche', 'metriche', lambda i: get('/metrics')),
+        Caso('distinte', 'distinte', lambda i: get('/distinte', pagina=distinte[i] % 20 + 1)),
+        Caso('distinte ordinate per costo', 'distinte', lambda i: get('/distinte', ordina='costo', dir='desc')),
+        Caso('statistiche_cache_costi', 'statistiche_cache_costi', lambda i: get('/api/cache-costi')),
+        Caso('dettaglio_distinta', 'dettaglio_distinta', lambda i: get(f'/distinta/{distinte[i]}')),
+        Caso('export_distinta_excel', 'export_distinta_excel', lambda i: get(f'/distinta/{distinte[i]}/export_excel')),
+        Caso('export_catalogo_excel', 'export_catalogo_excel', lambda i: get('/distinte/export_excel')),
+        Caso('avvia_export_pdf', 'avvia_export_pdf', lambda i: post(f'/distinta/{esportate[i]}/export_pdf/job'),
+             attendi=True),
+        Caso('stato_export', 'stato_export', job_pdf('stato_url')),
+        Caso('scarica_export', 'scarica_export', job_pdf('download')),
+        Caso('export_distinta_pdf', 'export_distinta_pdf', lambda i: get(f'/distinta/{esportate[-1]}/export_pdf')),
+        Caso('simula_distinta', 'simula_distinta', lambda i: get(f'/simula/{distinte[i]}')),
+        Caso('simula_distinta quantita', 'simula_distinta', lambda i: post(f'/simula/{distinte[i]}', qty=10)),
+        Caso('api_simulazione', 'api_simulazione',
+             lambda i: get('/api/simulazione', distinte=f"{distinte[i]},{distinte[-1 - i]}", quantita='1, 10, 100')),
+        Caso('genera_ordine_fornitore', 'genera_ordine_fornitore', lambda i: get(f'/genera-ordine/{distinte[i]}')),
+        Caso('genera_ordine_fornitore anteprima', 'genera_ordine_fornitore',
+             lambda i: post(f'/genera-ordine/{distinte[i]}', qty_produzione=5)),
+        Caso('elenco_fornitori', 'elenco_fornitori', lambda i: get('/fornitori')),
+        Caso('ricerca_componenti', 'ricerca_componenti', lambda i: get('/componenti/cerca', q=parole[i])),
+        Caso('api_cerca_componenti', 'api_cerca_componenti', lambda i: get('/api/componenti/cerca', q=codici[i][:7])),
+        Caso('pagina_dove_usato', 'pagina_dove_usato',
+             lambda i: get('/dove-usato', codice=codici[i], variazione=10)),
+        Caso('api_dove_usato', 'api_dove_usato',
+             lambda i: get('/api/dove-usato', materiale=rnd.choice(MATERIALI), spessore=rnd.choice(SPESSORI))),
+        Caso('api_impatto_prezzo', 'api_impatto_prezzo',
+             lambda i: get('/api/impatto-prezzo', fornitore=fornitori[i], variazione=5)),
+        Caso('fornitori_componente', 'fornitori_componente',
+             lambda i: get(f'/componente/{componenti[i]}/fornitori')),
+        Caso('modifica_componente', 'modifica_componente', lambda i: get(f'/componente/{componenti[i]}/modifica')),
+        Caso('elenco_ordini_fornitore', 'elenco_ordini_fornitore', lambda i: get('/ordini-fornitore')),
+        Caso('elenco_ordini_fornitore filtrato', 'elenco_ordini_fornitore',
+             lambda i: get('/ordini-fornitore', fornitore=fornitori[i], stato='giallo')),
+        Caso('dettaglio_ordine_fornitore', 'dettaglio_ordine_fornitore',
+             lambda i: get(f'/ordine-fornitore/{ordini[i]}')),
+        Caso('modifica_ordine_fornitore', 'modifica_ordine_fornitore',
+             lambda i: get(f'/ordine-fornitore/{ordini[i]}/modifica')),
+        Caso('crea_ordine_manuale', 'crea_ordine_manuale', lambda i: get('/ordine-fornitore/manuale')),
+        Caso('fabbisogno_materiali', 'fabbisogno_materiali', lambda i: get('/mrp')),
+        Caso('fabbisogno_materiali calcola', 'fabbisogno_materiali',
+             lambda i: post('/mrp', azione='calcola', richieste=f"DB-{distinte[i]:06d} 5\nDB-{distinte[-1 - i]:06d} 3")),
+        Caso('piano_approvvigionamenti_pagina', 'piano_approvvigionamenti_pagina',
+             lambda i: get('/piano-approvvigionamenti', dal='2025-01-01', periodo='mese')),
+        Caso('nuova_distinta', 'nuova_distinta', lambda i: get('/nuova-distinta')),
+        Caso('nuovo_fornitore', 'nuovo_fornitore', lambda i: get('/nuovo-fornitore')),
+        Caso('nuovo_cliente', 'nuovo_cliente', lambda i: get('/nuovo-cliente')),
+        Caso('aggiungi_componente', 'aggiungi_componente',
+             lambda i: get(f'/distinta/{distinte[i]}/aggiungi-componente')),
+        Caso('importa_componenti_distinta', 'importa_componenti_distinta',
+             lambda i: get(f'/distinta/{distinte[i]}/importa')),
+
+        # Modifiche
+        Caso('aggiungi_componente salva', 'aggiungi_componente',
+             lambda i: post(f'/distinta/{modificate[i]}/aggiungi-componente', **componente(i)), 302),
+        Caso('modifica_componente salva', 'modifica_componente',
+             lambda i: post(f'/componente/{componente_di(modificate[i])}/modifica', **componente(i)), 302),
+        Caso('revisioni_distinta', 'revisioni_distinta',
+             lambda i: get(f'/distinta/{modificate[i]}/revisioni', da=1, a=2)),
+        Caso('revisione_distinta', 'revisione_distinta', lambda i: get(f'/distinta/{modificate[i]}/revisione/2')),
+        Caso('importa_componenti_distinta salva', 'importa_componenti_distinta', importa),
+        Caso('carica_file_componente', 'carica_file_componente', carica_file, 302),
+        Caso('scarica_allegato', 'scarica_allegato', allegato),
+        Caso('aggiungi_prezzo_fornitore', 'aggiungi_prezzo_fornitore',
+             lambda i: post(f'/componente/{componenti[i]}/aggiungi-prezzo', id_fornitore=fornitori[i],
+                            prezzo=round(rnd.uniform(0.5, 250), 2), scaglioni='100: 0.9', valido_dal='2025-06-01'),
+             302),
+        Caso('condizioni_fornitore', 'condizioni_fornitore',
+             lambda i: post(f'/fornitore/{fornitori[i]}/condizioni', costo_ordine=25, ordine_minimo=100), 302),
+        Caso('genera_ordine_fornitore conferma', 'genera_ordine_fornitore',
+             lambda i: post(f'/genera-ordine/{distinte[i]}', qty_produzione=5, azione='conferma'), 302),
+        Caso('fabbisogno_materiali ordina', 'fabbisogno_materiali',
+             lambda i: post('/mrp', azione='ordina', richieste=f"DB-{distinte[i]:06d} 5"), 302),
+        Caso('fabbisogno_materiali pianifica', 'fabbisogno_materiali',
+             lambda i: post('/mrp', azione='pianifica', codice=f"DB-{distinte[i]:06d}", qty=10, data='2025-06-01'),
+             302),
+        Caso('crea_ordine_manuale salva', 'crea_ordine_manuale',
+             lambda i: post('/ordine-fornitore/manuale', fornitore_esistente=fornitori[i], riferimento_oc=f"OC-{i}",
+                            **{'componente[]': componenti[i], 'qty[]': 10, 'prezzo[]': 12.5}), 302),
+        Caso('modifica_ordine_fornitore salva', 'modifica_ordine_fornitore', modifica_ordine, 302),
+        Caso('elimina_riga_ordine', 'elimina_riga_ordine', elimina_riga, 302),
+        Caso('elimina_ordine_fornitore', 'elimina_ordine_fornitore',
+             lambda i: post(f'/ordine-fornitore/{eliminati[i]}/elimina'), 302),
+        Caso('nuova_distinta salva', 'nuova_distinta',
+             lambda i: post('/nuova-distinta', codice=f"SUITE-{i:04d}", descrizione="Distinta della suite"), 302),
+        Caso('nuovo_fornitore salva', 'nuovo_fornitore',
+             lambda i: post('/nuovo-fornitore', nome=f"Fornitore suite {i}", indirizzo="Via Roma 1", piva="01234567890",
+                            email=f"suite{i}@fornitore.it", telefono="0123456789", iban="IT00X0000000000000000000000",
+                            lavorazioni="Taglio laser", costo_ordine=30, ordine_minimo=0), 302),
+        Caso('nuovo_cliente salva', 'nuovo_cliente',
+             lambda i: post('/nuovo-cliente', ragione_sociale=f"Cliente suite {i}", indirizzo="Via Roma 1",
+                            email=f"suite{i}@cliente.it", telefono="0123456789", iban="IT00X0000000000000000000000",
+                            persona_riferimento="Mario Rossi", note=""), 302),
+    ]
+
+
+# Statistiche SQL delle connessioni prese dalle richieste nel blocco: il
+# dizionario resta aggiornato anche dopo after_request, quindi conta anche le
+# istruzioni eseguite mentre la risposta viene inviata in streaming
+@contextlib.contextmanager
+def statistiche_sql():
+    raccolte = []
+    get_db_originale = main_6.get_db
+
+    def get_db():
+        conn = get_db_originale()
+        if not any(statistiche is conn.statistiche for statistiche in raccolte):
+            raccolte.append(conn.statistiche)
+        return conn
+
+    main_6.get_db = get_db
+    try:
+        yield raccolte
+    finally:
+        main_6.get_db = get_db_originale
+
+
+# Esegue la richiesta i del caso e ritorna i secondi; per un export attende il
+# completamento del job interrogandone lo stato
+def esegui_caso(client, caso, i, esiti):
+    metodo, url, argomenti = caso.richiesta(i)
+    inizio = time.perf_counter()
+    risposta = client.open(url, method=metodo, **argomenti)
+    risposta.get_data()
+    while caso.attendi and risposta.status_code == 200 and risposta.get_json()['stato'] == 'in corso':
+        time.sleep(0.005)
+        risposta = client.get(risposta.get_json()['stato_url'])
+    secondi = time.perf_counter() - inizio
+    if risposta.status_code != caso.stato:
+        raise SystemExit(f"{caso.nome}: {metodo} {url} -> {risposta.status_code}, atteso {caso.stato}")
+    if caso.attendi and risposta.get_json()['stato'] != 'completato':
+        raise SystemExit(f"{caso.nome}: export {risposta.get_json()['stato']}: {risposta.get_json()['errore']}")
+    esiti[caso.nome] = risposta
+    return secondi
+
+
+def versione_git():
+    with contextlib.suppress(OSError):
+        esito = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        return esito.stdout.strip() or None
+    return None
+
+
+# Regressioni rispetto a un risultato precedente, per le route presenti in entrambi
+def confronta_rotte(precedente, attuale):
+    if precedente['parametri'] != attuale['parametri']:
+        print(f"Attenzione: parametri diversi dal confronto ({precedente['parametri']})")
+    regressioni = []
+    for nome, dopo in attuale['rotte'].items():
+        prima = precedente['rotte'].get(nome)
+        if prima is None:
+            continue
+        for misura, rapporto in (('p50_ms', REGRESSIONE_P50), ('p95_ms', REGRESSIONE_P95)):
+            if dopo[misura] > prima[misura] * rapporto and dopo[misura] - prima[misura] >= REGRESSIONE_MARGINE_MS:
+                regressioni.append(f"{nome}: {misura[:3]} {prima[misura]:.1f} -> {dopo[misura]:.1f} ms")
+        if dopo['sql'] > prima['sql']:
+            regressioni.append(f"{nome}: SQL {prima['sql']} -> {dopo['sql']}")
+    return regressioni
+
+
+# Dati completi (distinte multilivello, produzioni, giacenze, condizioni dei
+# fornitori), poi tutti i casi; fallisce se una route dell'app non ha casi o
+# se ci sono regressioni rispetto al file di confronto
+def bench_rotte(percorso, parametri, ripetizioni, percorso_json=None, percorso_confronto=None):
+    n_richieste = ripetizioni + 2
+    if parametri['distinte'] < n_richieste or parametri['ordini'] < 4 * n_richieste:
+        raise SystemExit(f"Servono almeno {n_richieste} distinte e {4 * n_richieste} ordini")
+    rnd = random.Random(parametri['seed'])
+    conn = sqlite3.connect(percorso)
+    collega_distinte(conn, rnd, parametri['distinte'])
+    aggiungi_produzioni(conn, rnd, parametri['distinte'], parametri['distinte'])
+    conn.execute("UPDATE fornitori SET costo_ordine = 10 * (id % 5), ordine_minimo = 50 * (id % 3)")
+    conn.commit()
+
+    cartella = os.path.dirname(percorso)
+    main_6.DB_NAME = percorso
+    main_6.EXPORT_FOLDER = os.path.join(cartella, 'export')
+    main_6.BLOB_FOLDER = os.path.join(cartella, 'allegati')
+    os.makedirs(main_6.EXPORT_FOLDER)
+    client = main_6.app.test_client()
+    esiti = {}
+    casi = casi_rotte(client, conn, rnd, parametri['distinte'], parametri['componenti'], parametri['fornitori'],
+                      parametri['ordini'], n_richieste, esiti)
+    scoperte = {r.endpoint for r in main_6.app.url_map.iter_rules()} - {caso.endpoint for caso in casi}
+    if scoperte:
+        raise SystemExit(f"Route senza casi nella suite: {', '.join(sorted(scoperte))}")
+
+    rotte = {}
+    print(f"{'route':<40} {'p50 ms':>9} {'p95 ms':>9} {'SQL':>6} {'picco KB':>9}")
+    try:
+        with statistiche_sql() as raccolte:
+            for caso in casi:
+                esegui_caso(client, caso, 0, esiti)
+                tempi, istruzioni = [], []
+                for i in range(1, ripetizioni + 1):
+                    raccolte.clear()
+                    tempi.append(esegui_caso(client, caso, i, esiti))
+                    istruzioni.append(sum(statistiche['istruzioni'] for statistiche in raccolte))
+                tracemalloc.start()
+                esegui_caso(client, caso, n_richieste - 1, esiti)
+                picco = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                tempi.sort()
+                istruzioni.sort()
+                rotte[caso.nome] = {
+                    'endpoint': caso.endpoint,
+                    'p50_ms': round(tempi[len(tempi) // 2] * 1000, 3),
+                    'p95_ms': round(tempi[int(len(tempi) * 0.95)] * 1000, 3),
+                    'sql': istruzioni[len(istruzioni) // 2],
+                    'picco_kb': round(picco / 1024, 1),
+                }
+                voce = rotte[caso.nome]
+                print(f"{caso.nome:<40} {voce['p50_ms']:>9.1f} {voce['p95_ms']:>9.1f} {voce['sql']:>6} "
+                      f"{voce['picco_kb']:>9.0f}")
+    finally:
+        conn.close()
+        if main_6._esecutore_export is not None:
+            main_6._esecutore_export.shutdown()
+            main_6._esecutore_export = None
+
+    risultato = {
+        'versione': versione_git(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'ambiente': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                     'piattaforma': platform.platform()},
+        'parametri': parametri | {'ripetizioni': ripetizioni},
+        'rotte': rotte,
+    }
+    if percorso_json:
+        with open(percorso_json, 'w', encoding='utf-8') as f:
+            json.dump(risultato, f, indent=2)
+        print(f"Risultati salvati in {percorso_json}")
+    if percorso_confronto:
+        with open(percorso_confronto, encoding='utf-8') as f:
+            regressioni = confronta_rotte(json.load(f), risultato)
+        if regressioni:
+            raise SystemExit("Regressioni:\n  " + "\n  ".join(regressioni))
+        print(f"OK: nessuna regressione rispetto a {percorso_confronto}")
+
+
+# Un processo scrittore della prova di numerazione: thread che generano ordini
+# dalle distinte assegnate (piu' fornitori, quindi piu' numeri per richiesta)
+# alternati a ordini manuali. Ritorna (ordini creati, errori).
+def scrittore_numerazione(percorso, distinte, thread, n_fornitori):
+    main_6.DB_NAME = percorso
+    conteggi = {'ok': 0, 'errori': []}
+    lock = threading.Lock()
+
+    def scrivi(mie):
+        client = main_6.app.test_client()
+        for i, id_distinta in enumerate(mie):
+            if i % 2:
+                risposta = client.post('/ordine-fornitore/manuale', data={
+                    'fornitore_esistente': id_distinta % n_fornitori + 1, 'riferimento_oc': f"OC-{id_distinta}",
+                    'componente[]': id_distinta, 'qty[]': 5, 'prezzo[]': 10})
+            else:
+                risposta = client.post(f'/genera-ordine/{id_distinta}', data={'qty_produzione': 50, 'azione': 'conferma'})
+            with lock:
+                if risposta.status_code == 302:
+                    conteggi['ok'] += 1
+                else:
+                    conteggi['errori'].append(f"{risposta.status_code} {risposta.get_data(as_text=True)[:200]}")
+
+    threads = [threading.Thread(target=scrivi, args=(distinte[n::thread],)) for n in range(thread)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    main_6.chiudi_pool()
+    return conteggi['ok'], conteggi['errori']
+
+
+Numerazione = namedtuple('Numerazione', 'richieste numeri contatori errori secondi')
+
+
+# Ordini fornitore da piu' processi e thread insieme sullo stesso database:
+# ritorna i numeri assegnati agli ordini nuovi e i contatori per serie
+def prova_numerazione(percorso, n_distinte, processi, thread, n_fornitori=20):
+    conn = sqlite3.connect(percorso)
+    prima = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ordini_fornitore").fetchone()[0]
+    conn.close()
+
+    distinte = list(range(1, n_distinte + 1))
+    inizio = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processi, mp_context=multiprocessing.get_context('spawn')) as esecutore:
+        esiti = list(esecutore.map(scrittore_numerazione, itertools.repeat(percorso),
+                                   [distinte[n::processi] for n in range(processi)],
+                                   itertools.repeat(thread), itertools.repeat(n_fornitori)))
+    secondi = time.perf_counter() - inizio
+
+    conn = sqlite3.connect(percorso)
+    numeri = [r[0] for r in conn.execute("SELECT numero_ordine FROM ordini_fornitore WHERE id > ?", (prima,))]
+    contatori = dict(conn.execute("SELECT serie, ultimo FROM numeratori"))
+    conn.close()
+    return Numerazione(sum(ok for ok, _ in esiti), numeri, contatori,
+                       [errore for _, elenco in esiti for errore in elenco], secondi)
+
+
+# Progressivi dei numeri automatici raggruppati per anno
+def progressivi_per_anno(numeri):
+    per_anno = {}
+    for numero in numeri:
+        assert main_6.NUMERO_ORDINE_AUTOMATICO.fullmatch(numero), numero
+        _, anno, progressivo = numero.split('-')
+        per_anno.setdefault(anno, []).append(int(progressivo))
+    return per_anno
+
+
+# I numeri nuovi devono essere tutti diversi e, per ogni anno, esattamente
+# 1..N senza buchi, con N il valore del contatore
+def bench_numerazione(percorso, n_distinte, processi, thread, n_fornitori=20):
+    richieste, numeri, contatori, errori, secondi = prova_numerazione(percorso, n_distinte, processi, thread,
+                                                                      n_fornitori)
+    print(f"{processi} processi x {thread} thread: {richieste} richieste, {len(numeri)} ordini "
+          f"in {secondi:.1f}s ({len(numeri) / secondi:.0f} ordini/s), {len(errori)} errori")
+    for errore in errori[:5]:
+        print("  " + errore)
+
+    assert not errori, f"{len(errori)} richieste fallite"
+    assert len(set(numeri)) == len(numeri), "numeri d'ordine ripetuti"
+    for anno, progressivi in progressivi_per_anno(numeri).items():
+        assert sorted(progressivi) == list(range(1, contatori[f"ordini-{anno}"] + 1)), f"buchi nella serie {anno}"
+    print(f"OK: {len(numeri)} numeri unici e consecutivi")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gestionale distinte")
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p = sub.add_parser('distinte', help="elenco distinte aggregato e paginato")
+    p.add_argument('--distinte', type=int, default=10000)
+    p.add_argument('--componenti', type=int, default=500000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--ripetizioni', type=int, default=5)
+
+    p = sub.add_parser('piano', help="EXPLAIN QUERY PLAN delle query delle pagine")
+    p.add_argument('--distinte', type=int, default=500)
+    p.add_argument('--componenti', type=int, default=20000)
+    p.add_argument('--seed', type=int, default=42)
+
+    p = sub.add_parser('carico', help="lettori concorrenti durante la generazione ordini")
+    p.add_argument('--distinte', type=int, default=2000)
+    p.add_argument('--componenti', type=int, default=100000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--secondi', type=float, default=10)
+    p.add_argument('--lettori', type=int, default=8)
+
+    p = sub.add_parser('lamiere', help="stima fogli e sfrido per materiale e spessore")
+    p.add_argument('--codici', type=int, default=5000)
+    p.add_argument('--quantita', type=int, default=20, help="quantita' massima per codice")
+    p.add_argument('--seed', type=int, default=42)
+
+    p = sub.add_parser('approvvigionamenti', help="piano a periodi su 12 mesi di produzioni")
+    p.add_argument('--distinte', type=int, default=2000)
+    p.add_argument('--componenti', type=int, default=100000)
+    p.add_argument('--produzioni', type=int, default=2000)
+    p.add_argument('--seed', type=int, default=42)
+
+    p = sub.add_parser('fornitori', help="scelta fornitori con costi d'ordine e minimi")
+    p.add_argument('--componenti', type=int, default=5000)
+    p.add_argument('--fornitori', type=int, default=50)
+    p.add_argument('--seed', type=int, default=42)
+
+    p = sub.add_parser('ricerca', help="latenza dell'autocompletamento componenti")
+    p.add_argument('--distinte', type=int, default=2000)
+    p.add_argument('--componenti', type=int, default=100000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--ripetizioni', type=int, default=200)
+
+    p = sub.add_parser('dove-usato', help="dove usato e impatto prezzi su distinte multilivello")
+    p.add_argument('--distinte', type=int, default=2000)
+    p.add_argument('--componenti', type=int, default=100000)
+    p.add_argument('--seed', type=int, default=42)
+
+    p = sub.add_parser('rotte', help="latenza, SQL e memoria di tutte le route, con confronto tra versioni")
+    p.add_argument('--distinte', type=int, default=500)
+    p.add_argument('--componenti', type=int, default=20000)
+    p.add_argument('--fornitori', type=int, default=20)
+    p.add_argument('--ordini', type=int, default=1000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--ripetizioni', type=int, default=20)
+    p.add_argument('--json', help="salva i risultati in questo file")
+    p.add_argument('--confronta', help="risultati precedenti: fallisce se una route e' regredita")
+
+    p = sub.add_parser('numerazione', help="numeri d'ordine con scrittori concorrenti in piu' processi")
+    p.add_argument('--distinte', type=int, default=400, help="una richiesta di ordine per distinta")
+    p.add_argument('--componenti', type=int, default=20000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--processi', type=int, default=4)
+    p.add_argument('--thread', type=int, default=4, help="thread scrittori per processo")
+
+    args = parser.parse_args()
+    if args.comando == 'lamiere':
+        bench_lamiere(args.codici, args.quantita, args.seed)
+        return
+    if args.comando == 'fornitori':
+        bench_fornitori(args.componenti, args.fornitori, args.seed)
+        return
+
+    with tempfile.TemporaryDirectory() as cartella:
+        percorso = os.path.join(cartella, 'benchmark.db')
+        inizio = time.perf_counter()
+        genera_database(percorso, args.distinte, args.componenti, n_fornitori=getattr(args, 'fornitori', 20),
+                        n_ordini=getattr(args, 'ordini', 1000), seed=args.seed)
+        print(f"Database generato in {time.perf_counter() - inizio:.1f}s "
+              f"({args.distinte} distinte, {args.componenti} componenti)")
+
+        if args.comando == 'distinte':
+            bench_distinte(percorso, args.ripetizioni)
+        elif args.comando == 'piano':
+            verifica_piani(percorso)
+        elif args.comando == 'carico':
+            confronta_carico(percorso, args.distinte, args.secondi, args.lettori)
+        elif args.comando == 'approvvigionamenti':
+            bench_approvvigionamenti(percorso, args.distinte, args.produzioni, args.seed)
+        elif args.comando == 'ricerca':
+            bench_ricerca(percorso, args.ripetizioni, args.seed)
+        elif args.comando == 'dove-usato':
+            bench_dove_usato(percorso, args.distinte, args.seed)
+        elif args.comando == 'numerazione':
+            bench_numerazione(percorso, args.distinte, args.processi, args.thread)
+        elif args.comando == 'rotte':
+            parametri = {nome: getattr(args, nome) for nome in ('distinte', 'componenti', 'fornitori', 'ordini', 'seed')}
+            bench_rotte(percorso, parametri, args.ripetizioni, args.json, args.confronta)
+
+
+if __name__ == '__main__':
+    main()
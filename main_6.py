@@ -1,400 +1,2957 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, g, jsonify, Response, stream_with_context
+from flask import before_render_template, template_rendered, has_request_context
 import sqlite3
 import os
+import contextlib
+import hashlib
+import json
+import math
+import multiprocessing
+import re
+import tempfile
+import threading
+import unicodedata
+import time
+import zipfile
+import itertools
+import heapq
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape as xml_escape
 import os
-from flask import render_template, send_file, render_template_string
+from flask import render_template, send_file
 import pandas as pd
+import numpy as np
 import io
 from werkzeug.utils import secure_filename
-from xhtml2pdf import pisa
+from openpyxl import load_workbook
+import click
+
+UPLOAD_FOLDER = os.path.join('static', 'uploads')
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+app = Flask(__name__)
+DB_NAME = "database.db"
+
+# Inizializza il database (idempotente) e applica le migrazioni mancanti
+def init_db(percorso=None):
+    conn = sqlite3.connect(percorso or DB_NAME)
+    c = conn.cursor()
+
+    # Tabella Distinte
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS distinte (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codice TEXT NOT NULL,
+            descrizione TEXT
+        )
+    ''')
+
+    # Tabella Componenti
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS componenti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_distinta INTEGER,
+            macrozona TEXT,
+            nome TEXT,
+            codice TEXT,
+            materiale TEXT,
+            spessore TEXT,
+            qty REAL,
+            lavorazioni TEXT,
+            costo REAL,
+            tipo TEXT,
+            FOREIGN KEY (id_distinta) REFERENCES distinte(id)
+        )
+    ''')
+
+    # Tabella Fornitori
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS fornitori (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            email TEXT,
+            telefono TEXT
+        )
+    ''')
+
+    # Tabella Prezzi Fornitori
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS prezzi_fornitori (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_componente INTEGER,
+            id_fornitore INTEGER,
+            prezzo REAL,
+            FOREIGN KEY (id_componente) REFERENCES componenti(id),
+            FOREIGN KEY (id_fornitore) REFERENCES fornitori(id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS magazzino (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_componente INTEGER NOT NULL,
+            giacenza REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (id_componente) REFERENCES componenti(id)
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS produzioni (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_distinta INTEGER NOT NULL,
+            qty_prodotta INTEGER NOT NULL,
+            data_produzione TEXT NOT NULL,
+            numero_produzione TEXT,
+            FOREIGN KEY (id_distinta) REFERENCES distinte(id)
+        )
+    ''')
+    
+    # Testata ordini
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ordini_fornitore (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            numero_ordine TEXT NOT NULL,
+            id_fornitore INTEGER NOT NULL,
+            data_ordine TEXT NOT NULL,
+            riferimento_oc TEXT,
+            FOREIGN KEY (id_fornitore) REFERENCES fornitori(id)
+        )
+    ''')
+
+    # Righe ordini
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS righe_ordine_fornitore (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_ordine INTEGER NOT NULL,
+            id_componente INTEGER NOT NULL,
+            qty INTEGER NOT NULL,
+            data_richiesta TEXT NOT NULL,
+            data_confermata TEXT,
+            data_consegna TEXT,
+            FOREIGN KEY (id_ordine) REFERENCES ordini_fornitore(id),
+            FOREIGN KEY (id_componente) REFERENCES componenti(id)
+        )
+    ''')
+    
+    # Tabella Clienti
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS clienti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codice TEXT UNIQUE,  -- verrà generato automaticamente
+            ragione_sociale TEXT NOT NULL,
+            indirizzo TEXT,
+            email TEXT,
+            telefono TEXT,
+            iban TEXT,
+            persona_riferimento TEXT,
+            note TEXT
+        )
+    ''')
+
+    conn.commit()
+    migra_db(conn)
+    conn.close()
+
+    
+# Colonne aggiunte a mano sul database in produzione e mai riportate in init_db()
+def _migrazione_colonne_mancanti(c):
+    colonne = {
+        'componenti': [('file', 'TEXT')],
+        'fornitori': [('indirizzo', 'TEXT'), ('piva', 'TEXT'), ('iban', 'TEXT'), ('lavorazioni', 'TEXT')],
+    }
+    for tabella, nuove in colonne.items():
+        esistenti = {r[1] for r in c.execute(f"PRAGMA table_info({tabella})")}
+        for nome, tipo in nuove:
+            if nome not in esistenti:
+                c.execute(f"ALTER TABLE {tabella} ADD COLUMN {nome} {tipo}")
+
+
+# Storico revisioni: la prima revisione di ogni distinta esistente e' lo stato
+# attuale, con lo snapshot completo. I campi sono quelli dello schema a questa
+# versione, indipendenti da CAMPI_REVISIONE.
+def _migrazione_revisioni(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revisioni_distinta (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_distinta INTEGER NOT NULL REFERENCES distinte(id),
+            numero INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            nota TEXT,
+            snapshot TEXT,  -- JSON {id_componente: valori} ogni REVISIONI_SNAPSHOT revisioni
+            UNIQUE (id_distinta, numero)
+        )
+    ''')
+    # Solo i componenti cambiati rispetto alla revisione precedente (valori NULL = rimosso)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS righe_revisione (
+            id_revisione INTEGER NOT NULL REFERENCES revisioni_distinta(id),
+            id_componente INTEGER NOT NULL,
+            valori TEXT,
+            PRIMARY KEY (id_revisione, id_componente)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_righe_revisione_componente "
+              "ON righe_revisione(id_componente, id_revisione)")
+    data = time.strftime('%Y-%m-%d %H:%M:%S')
+    for (id_distinta,) in c.execute("SELECT id FROM distinte ORDER BY id").fetchall():
+        c.execute('''
+            SELECT id, macrozona, nome, codice, materiale, spessore, qty,
+                   lavorazioni, costo, tipo, id_sottodistinta
+            FROM componenti WHERE id_distinta = ?
+        ''', (id_distinta,))
+        stato = {riga[0]: list(riga[1:]) for riga in c.fetchall()}
+        if not stato:
+            continue
+        c.execute('''
+            INSERT INTO revisioni_distinta (id_distinta, numero, data, nota, snapshot)
+            VALUES (?, 1, ?, 'Stato iniziale', ?)
+        ''', (id_distinta, data, json.dumps(stato)))
+        id_revisione = c.lastrowid
+        c.executemany("INSERT INTO righe_revisione (id_revisione, id_componente, valori) VALUES (?, ?, ?)",
+                      [(id_revisione, id_c, json.dumps(valori)) for id_c, valori in stato.items()])
+
+
+# Allegati nell'archivio a indirizzamento per contenuto: i file gia' caricati
+# in UPLOAD_FOLDER vengono copiati nell'archivio (BLOB_FOLDER/ab/cd/<sha256>)
+# e componenti.file diventa l'hash. Un file referenziato ma assente resta solo
+# come nome_file. La copia non usa le funzioni dell'archivio, che possono
+# cambiare dopo questa versione dello schema.
+def _migrazione_allegati(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS allegati (
+            hash TEXT PRIMARY KEY,  -- SHA-256 del contenuto
+            dimensione INTEGER NOT NULL,
+            riferimenti INTEGER NOT NULL DEFAULT 0,  -- componenti con file = hash
+            creato TEXT NOT NULL
+        )
+    ''')
+    if 'nome_file' not in {r[1] for r in c.execute("PRAGMA table_info(componenti)")}:
+        c.execute("ALTER TABLE componenti ADD COLUMN nome_file TEXT")
+    c.execute("SELECT DISTINCT file FROM componenti WHERE file IS NOT NULL AND nome_file IS NULL")
+    for (nome,) in c.fetchall():
+        percorso = os.path.join(UPLOAD_FOLDER, nome)
+        hash_file = None
+        if os.path.isfile(percorso):
+            cartella = os.path.join(BLOB_FOLDER, 'tmp')
+            os.makedirs(cartella, exist_ok=True)
+            sha = hashlib.sha256()
+            fd, temporaneo = tempfile.mkstemp(dir=cartella)
+            with open(percorso, 'rb') as sorgente, os.fdopen(fd, 'wb') as copia:
+                while blocco := sorgente.read(1024 * 1024):
+                    sha.update(blocco)
+                    copia.write(blocco)
+            hash_file = sha.hexdigest()
+            destinazione = os.path.join(BLOB_FOLDER, hash_file[:2], hash_file[2:4], hash_file)
+            if os.path.exists(destinazione):
+                os.remove(temporaneo)
+            else:
+                os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+                os.replace(temporaneo, destinazione)
+            c.execute("INSERT INTO allegati (hash, dimensione, creato) VALUES (?, ?, ?) ON CONFLICT(hash) DO NOTHING",
+                      (hash_file, os.path.getsize(percorso), time.strftime('%Y-%m-%d %H:%M:%S')))
+        c.execute("UPDATE componenti SET file = ?, nome_file = ? WHERE file = ? AND nome_file IS NULL",
+                  (hash_file, nome, nome))
+
+    # Contatore dei riferimenti aggiornato da ogni scrittura su componenti.file
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS allegati_riferimento_inserito
+        AFTER INSERT ON componenti WHEN NEW.file IS NOT NULL
+        BEGIN
+            UPDATE allegati SET riferimenti = riferimenti + 1 WHERE hash = NEW.file;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS allegati_riferimento_modificato
+        AFTER UPDATE OF file ON componenti WHEN OLD.file IS NOT NEW.file
+        BEGIN
+            UPDATE allegati SET riferimenti = riferimenti - 1 WHERE hash = OLD.file;
+            UPDATE allegati SET riferimenti = riferimenti + 1 WHERE hash = NEW.file;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS allegati_riferimento_eliminato
+        AFTER DELETE ON componenti WHEN OLD.file IS NOT NULL
+        BEGIN
+            UPDATE allegati SET riferimenti = riferimenti - 1 WHERE hash = OLD.file;
+        END
+    ''')
+    c.execute("UPDATE allegati SET riferimenti = (SELECT COUNT(*) FROM componenti WHERE file = allegati.hash)")
+
+
+# Indice delle geometrie DXF. I disegni gia' caricati si indicizzano con
+# `flask indicizza-dxf`, non all'avvio: analizzarli tutti qui bloccherebbe la
+# partenza dell'applicazione.
+def _migrazione_geometrie_dxf(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS geometrie_dxf (
+            hash TEXT PRIMARY KEY,  -- allegati.hash
+            versione INTEGER NOT NULL,  -- DXF_VERSIONE con cui e' stata calcolata
+            min_x REAL, min_y REAL, larghezza REAL, altezza REAL,  -- mm
+            lunghezza_taglio REAL,  -- mm
+            area REAL,  -- mm2, pezzi meno fori
+            n_pezzi INTEGER, n_fori INTEGER, n_entita INTEGER, n_ignorate INTEGER,
+            errore TEXT,
+            calcolato TEXT NOT NULL
+        )
+    ''')
+
+
+# Statistiche di consegna per fornitore tenute aggiornate da trigger
+#
+# Ogni riga d'ordine con qty > 0 contribuisce al suo fornitore con i giorni da
+# data richiesta a consegna e a conferma e con la puntualita' (consegna entro la
+# data confermata); le date mancanti o non valide non contano. I trigger
+# sottraggono il contributo della riga vecchia e aggiungono quello della nuova,
+# quindi le pagine leggono aggregati gia' pronti invece dello storico.
+
+COLONNE_STATISTICHE_FORNITORI = ['n_consegne', 'giorni_consegna', 'n_conferme', 'giorni_conferma',
+                                 'n_verificabili', 'n_puntuali']
+
+
+# SELECT dei contributi delle righe di `sorgente` (alias r) con fornitore `fornitore`
+def _contributi_righe(sorgente, fornitore):
+    consegna = "julianday(r.data_consegna) - julianday(r.data_richiesta)"
+    conferma = "julianday(r.data_confermata) - julianday(r.data_richiesta)"
+    return f'''
+        SELECT {fornitore} AS id_fornitore, r.qty AS qty,
+               CASE WHEN {consegna} >= 0 THEN CAST(ROUND({consegna}) AS INTEGER) END AS consegna,
+               CASE WHEN {conferma} >= 0 THEN CAST(ROUND({conferma}) AS INTEGER) END AS conferma,
+               julianday(r.data_consegna) <= julianday(r.data_confermata) AS puntuale
+        FROM {sorgente} r
+    '''
+
+
+# Somma (segno = 1) o sottrae (segno = -1) i contributi a statistiche e istogramma
+def _applica_contributi(segno, sorgente, fornitore):
+    contributi = _contributi_righe(sorgente, fornitore)
+    return [f'''
+        INSERT INTO statistiche_fornitori (id_fornitore, {', '.join(COLONNE_STATISTICHE_FORNITORI)})
+        SELECT id_fornitore,
+               {segno} * COUNT(consegna), {segno} * TOTAL(consegna),
+               {segno} * COUNT(conferma), {segno} * TOTAL(conferma),
+               {segno} * COUNT(puntuale), {segno} * TOTAL(puntuale)
+        FROM ({contributi})
+        WHERE qty > 0 AND id_fornitore IS NOT NULL
+        GROUP BY id_fornitore
+        ON CONFLICT (id_fornitore) DO UPDATE SET
+            {', '.join(f"{col} = {col} + excluded.{col}" for col in COLONNE_STATISTICHE_FORNITORI)}
+    ''', f'''
+        INSERT INTO consegne_fornitore (id_fornitore, giorni, n)
+        SELECT id_fornitore, consegna, {segno} * COUNT(*)
+        FROM ({contributi})
+        WHERE qty > 0 AND id_fornitore IS NOT NULL AND consegna IS NOT NULL
+        GROUP BY id_fornitore, consegna
+        ON CONFLICT (id_fornitore, giorni) DO UPDATE SET n = n + excluded.n
+    ''']
+
+
+def _migrazione_statistiche_fornitori(c):
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS statistiche_fornitori (
+            id_fornitore INTEGER PRIMARY KEY REFERENCES fornitori(id),
+            {', '.join(f"{col} REAL NOT NULL DEFAULT 0" for col in COLONNE_STATISTICHE_FORNITORI)}
+        )
+    ''')
+    # Istogramma dei giorni di consegna, per mediana e percentili senza rileggere le righe
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS consegne_fornitore (
+            id_fornitore INTEGER NOT NULL,
+            giorni INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (id_fornitore, giorni)
+        ) WITHOUT ROWID
+    ''')
+
+    riga = "(SELECT {0}.id_ordine AS id_ordine, {0}.qty AS qty, {0}.data_richiesta AS data_richiesta, " \
+           "{0}.data_confermata AS data_confermata, {0}.data_consegna AS data_consegna)"
+    fornitore_riga = "(SELECT id_fornitore FROM ordini_fornitore WHERE id = r.id_ordine)"
+    con_date = "COALESCE({0}.data_confermata, '') != '' OR COALESCE({0}.data_consegna, '') != ''"
+    trigger = {
+        'statistiche_riga_inserita': (
+            f"AFTER INSERT ON righe_ordine_fornitore WHEN {con_date.format('NEW')}",
+            _applica_contributi(1, riga.format('NEW'), fornitore_riga)),
+        'statistiche_riga_eliminata': (
+            f"AFTER DELETE ON righe_ordine_fornitore WHEN {con_date.format('OLD')}",
+            _applica_contributi(-1, riga.format('OLD'), fornitore_riga)),
+        'statistiche_riga_modificata': (
+            "AFTER UPDATE OF id_ordine, qty, data_richiesta, data_confermata, data_consegna "
+            "ON righe_ordine_fornitore WHEN OLD.id_ordine IS NOT NEW.id_ordine OR OLD.qty IS NOT NEW.qty "
+            "OR OLD.data_richiesta IS NOT NEW.data_richiesta OR OLD.data_confermata IS NOT NEW.data_confermata "
+            "OR OLD.data_consegna IS NOT NEW.data_consegna",
+            _applica_contributi(-1, riga.format('OLD'), fornitore_riga)
+            + _applica_contributi(1, riga.format('NEW'), fornitore_riga)),
+        'statistiche_ordine_fornitore': (
+            "AFTER UPDATE OF id_fornitore ON ordini_fornitore WHEN OLD.id_fornitore IS NOT NEW.id_fornitore",
+            _applica_contributi(-1, "(SELECT * FROM righe_ordine_fornitore WHERE id_ordine = OLD.id)",
+                                "OLD.id_fornitore")
+            + _applica_contributi(1, "(SELECT * FROM righe_ordine_fornitore WHERE id_ordine = NEW.id)",
+                                  "NEW.id_fornitore")),
+    }
+    for nome, (evento, istruzioni) in trigger.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {nome}")
+        c.execute(f"CREATE TRIGGER {nome} {evento} BEGIN {'; '.join(istruzioni)}; END")
+
+    c.execute("DELETE FROM statistiche_fornitori")
+    c.execute("DELETE FROM consegne_fornitore")
+    for istruzione in _applica_contributi(1, "righe_ordine_fornitore", fornitore_riga):
+        c.execute(istruzione)
+
+
+# Listini con validita' e scaglioni: i prezzi esistenti diventano la prima
+# versione, valida da sempre ('0001-01-01', come LISTINO_DA_SEMPRE), con il
+# solo scaglione da 1 pezzo
+def _migrazione_listini(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS listini_fornitori (
+            id_componente INTEGER NOT NULL REFERENCES componenti(id),
+            id_fornitore INTEGER NOT NULL REFERENCES fornitori(id),
+            valido_dal TEXT NOT NULL,
+            qty_minima REAL NOT NULL,
+            prezzo REAL NOT NULL,
+            PRIMARY KEY (id_componente, id_fornitore, valido_dal, qty_minima)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO listini_fornitori (id_componente, id_fornitore, valido_dal, qty_minima, prezzo)
+        SELECT id_componente, id_fornitore, ?, 1, prezzo
+        FROM prezzi_fornitori
+        WHERE id_componente IS NOT NULL AND id_fornitore IS NOT NULL AND prezzo IS NOT NULL
+    ''', ('0001-01-01',))
+
+
+# Indice di ricerca full-text sui componenti (FTS5 con contenuto esterno:
+# il testo resta in componenti, l'indice e' tenuto allineato dai trigger)
+def _migrazione_ricerca_componenti(c):
+    colonne_ricerca = ['nome', 'codice', 'materiale', 'lavorazioni', 'macrozona']
+    colonne = ', '.join(colonne_ricerca)
+    nuove = ', '.join(f"NEW.{col}" for col in colonne_ricerca)
+    vecchie = ', '.join(f"OLD.{col}" for col in colonne_ricerca)
+    c.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS cerca_componenti USING fts5(
+            {colonne},
+            content='componenti', content_rowid='id',
+            tokenize="unicode61 remove_diacritics 2 tokenchars '_./'",
+            prefix='2 3'
+        )
+    ''')
+    # Vocabolario dell'indice, per correggere i termini senza corrispondenze
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cerca_componenti_termini USING fts5vocab(cerca_componenti, 'row')")
+    # Cresce a ogni modifica dell'indice: invalida le parole tenute in memoria per le correzioni
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS versione_ricerca (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            versione INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO versione_ricerca (id, versione) VALUES (1, 0)")
+    incrementa = "UPDATE versione_ricerca SET versione = versione + 1 WHERE id = 1;"
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cerca_componente_inserito AFTER INSERT ON componenti
+        BEGIN
+            INSERT INTO cerca_componenti (rowid, {colonne}) VALUES (NEW.id, {nuove});
+            {incrementa}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cerca_componente_eliminato AFTER DELETE ON componenti
+        BEGIN
+            INSERT INTO cerca_componenti (cerca_componenti, rowid, {colonne}) VALUES ('delete', OLD.id, {vecchie});
+            {incrementa}
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cerca_componente_modificato AFTER UPDATE OF {colonne} ON componenti
+        BEGIN
+            INSERT INTO cerca_componenti (cerca_componenti, rowid, {colonne}) VALUES ('delete', OLD.id, {vecchie});
+            INSERT INTO cerca_componenti (rowid, {colonne}) VALUES (NEW.id, {nuove});
+            {incrementa}
+        END
+    ''')
+    c.execute("INSERT INTO cerca_componenti (cerca_componenti) VALUES ('rebuild')")
+
+
+# Somma (segno = 1) o toglie (segno = -1) il legame padre -> figlio con quantita' qty
+# alla chiusura legami_distinte. Ogni antenato del padre (padre compreso) guadagna
+# ogni discendente del figlio (figlio compreso) con percorsi e moltiplicatori
+# composti: in un grafo senza cicli l'aggiornamento e' esatto anche quando si toglie.
+def _applica_legame(segno, padre, figlio, qty):
+    return [f'''
+        INSERT INTO legami_distinte (id_discendente, id_antenato, percorsi, moltiplicatore)
+        SELECT d.id, a.id, {segno} * a.percorsi * d.percorsi,
+               {segno} * a.moltiplicatore * COALESCE({qty}, 0) * d.moltiplicatore
+        FROM (SELECT {padre} AS id, 1 AS percorsi, 1.0 AS moltiplicatore
+              UNION ALL
+              SELECT id_antenato, percorsi, moltiplicatore FROM legami_distinte WHERE id_discendente = {padre}) a,
+             (SELECT {figlio} AS id, 1 AS percorsi, 1.0 AS moltiplicatore
+              UNION ALL
+              SELECT id_discendente, percorsi, moltiplicatore FROM legami_distinte WHERE id_antenato = {figlio}) d
+        WHERE {figlio} IS NOT NULL AND {padre} IS NOT NULL
+        ON CONFLICT (id_discendente, id_antenato) DO UPDATE SET
+            percorsi = percorsi + excluded.percorsi,
+            moltiplicatore = moltiplicatore + excluded.moltiplicatore
+    ''', f'''
+        DELETE FROM legami_distinte
+        WHERE percorsi = 0
+          AND id_antenato IN (SELECT {padre} UNION ALL
+                              SELECT id_antenato FROM legami_distinte WHERE id_discendente = {padre})
+    ''']
+
+
+def _migrazione_dove_usato(c):
+    # Chiusura transitiva dei legami tra distinte: per ogni coppia (discendente,
+    # antenato) i percorsi che le collegano e i pezzi del discendente in un pezzo
+    # dell'antenato, sommati su tutti i percorsi
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS legami_distinte (
+            id_discendente INTEGER NOT NULL,
+            id_antenato INTEGER NOT NULL,
+            percorsi INTEGER NOT NULL,
+            moltiplicatore REAL NOT NULL,
+            PRIMARY KEY (id_discendente, id_antenato)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_legami_antenato "
+              "ON legami_distinte(id_antenato, id_discendente, percorsi, moltiplicatore)")
+
+    # Un ciclo renderebbe la chiusura infinita: i form lo impediscono gia'
+    # (verifica_sottodistinta), il trigger lo impedisce a import e altri processi
+    ciclo = ("SELECT RAISE(ABORT, 'Ciclo tra le distinte') WHERE NEW.id_sottodistinta = NEW.id_distinta "
+             "OR EXISTS (SELECT 1 FROM legami_distinte "
+             "WHERE id_discendente = NEW.id_distinta AND id_antenato = NEW.id_sottodistinta)")
+    trigger = {
+        'legami_componente_inserito': (
+            "AFTER INSERT ON componenti WHEN NEW.id_sottodistinta IS NOT NULL",
+            [ciclo] + _applica_legame(1, 'NEW.id_distinta', 'NEW.id_sottodistinta', 'NEW.qty')),
+        'legami_componente_eliminato': (
+            "AFTER DELETE ON componenti WHEN OLD.id_sottodistinta IS NOT NULL",
+            _applica_legame(-1, 'OLD.id_distinta', 'OLD.id_sottodistinta', 'OLD.qty')),
+        'legami_componente_modificato': (
+            "AFTER UPDATE OF id_distinta, id_sottodistinta, qty ON componenti "
+            "WHEN (OLD.id_sottodistinta IS NOT NULL OR NEW.id_sottodistinta IS NOT NULL) "
+            "AND (OLD.id_distinta IS NOT NEW.id_distinta OR OLD.id_sottodistinta IS NOT NEW.id_sottodistinta "
+            "OR OLD.qty IS NOT NEW.qty)",
+            _applica_legame(-1, 'OLD.id_distinta', 'OLD.id_sottodistinta', 'OLD.qty')
+            + [ciclo] + _applica_legame(1, 'NEW.id_distinta', 'NEW.id_sottodistinta', 'NEW.qty')),
+    }
+    for nome, (evento, istruzioni) in trigger.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {nome}")
+        c.execute(f"CREATE TRIGGER {nome} {evento} BEGIN {'; '.join(istruzioni)}; END")
+
+    c.execute("DELETE FROM legami_distinte")
+    c.execute("SELECT id_distinta, id_sottodistinta, qty FROM componenti WHERE id_sottodistinta IS NOT NULL")
+    for padre, figlio, qty in c.fetchall():
+        for istruzione in _applica_legame(1, ':padre', ':figlio', ':qty'):
+            c.execute(istruzione, {'padre': padre, 'figlio': figlio, 'qty': qty})
+
+    # Indici inversi per gli impieghi diretti: i codici sono confrontati senza
+    # spazi e maiuscole, come arrivano dagli import Excel
+    c.execute("CREATE INDEX IF NOT EXISTS idx_componenti_codice "
+              "ON componenti(upper(trim(codice)), id_distinta, qty, costo, id_sottodistinta)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_componenti_materiale "
+              "ON componenti(materiale, spessore, id_distinta, qty, costo, id_sottodistinta)")
+    c.execute("DROP INDEX IF EXISTS idx_prezzi_fornitore")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_prezzi_fornitore ON prezzi_fornitori(id_fornitore, id_componente)")
+
+
+def _migrazione_numerazione_ordini(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS numeratori (
+            serie TEXT PRIMARY KEY,
+            ultimo INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # Gli ordini creati nello stesso secondo hanno lo stesso numero: dal
+    # secondo in poi diventano unici con l'id come suffisso
+    c.execute('''
+        UPDATE ordini_fornitore SET numero_ordine = numero_ordine || '-' || id
+        WHERE id NOT IN (SELECT MIN(id) FROM ordini_fornitore GROUP BY numero_ordine)
+    ''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ordini_numero ON ordini_fornitore(numero_ordine)")
+
+
+# Trigger della ricerca senza il contatore versione_ricerca: la riga condivisa,
+# aggiornata da ogni scrittura su componenti, era un punto di contesa tra gli
+# scrittori. Le parole per le correzioni si invalidano dalla struttura dell'indice.
+def _migrazione_ricerca_senza_versione(c):
+    colonne_ricerca = ['nome', 'codice', 'materiale', 'lavorazioni', 'macrozona']
+    colonne = ', '.join(colonne_ricerca)
+    nuove = ', '.join(f"NEW.{col}" for col in colonne_ricerca)
+    vecchie = ', '.join(f"OLD.{col}" for col in colonne_ricerca)
+    trigger = {
+        'cerca_componente_inserito': ("AFTER INSERT ON componenti", [
+            f"INSERT INTO cerca_componenti (rowid, {colonne}) VALUES (NEW.id, {nuove})",
+        ]),
+        'cerca_componente_eliminato': ("AFTER DELETE ON componenti", [
+            f"INSERT INTO cerca_componenti (cerca_componenti, rowid, {colonne}) VALUES ('delete', OLD.id, {vecchie})",
+        ]),
+        'cerca_componente_modificato': (f"AFTER UPDATE OF {colonne} ON componenti", [
+            f"INSERT INTO cerca_componenti (cerca_componenti, rowid, {colonne}) VALUES ('delete', OLD.id, {vecchie})",
+            f"INSERT INTO cerca_componenti (rowid, {colonne}) VALUES (NEW.id, {nuove})",
+        ]),
+    }
+    for nome, (evento, istruzioni) in trigger.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {nome}")
+        c.execute(f"CREATE TRIGGER {nome} {evento} BEGIN {'; '.join(istruzioni)}; END")
+    c.execute("DROP TABLE IF EXISTS versione_ricerca")
+
+
+# Migrazioni dello schema in ordine di versione: (versione, descrizione, passi).
+# I passi sono istruzioni SQL oppure una funzione che riceve il cursore.
+# La versione applicata e' salvata in PRAGMA user_version.
+MIGRAZIONI = [
+    (1, "colonne file/indirizzo/piva/iban/lavorazioni", _migrazione_colonne_mancanti),
+    (2, "indici sulle chiavi esterne e sulle date ordine", [
+        # Copre anche SUM(qty * costo) per distinta senza leggere le righe della tabella
+        "CREATE INDEX IF NOT EXISTS idx_componenti_distinta ON componenti(id_distinta, qty, costo)",
+        "CREATE INDEX IF NOT EXISTS idx_prezzi_fornitore ON prezzi_fornitori(id_fornitore)",
+        "CREATE INDEX IF NOT EXISTS idx_righe_ordine ON righe_ordine_fornitore(id_ordine)",
+        "CREATE INDEX IF NOT EXISTS idx_righe_componente ON righe_ordine_fornitore(id_componente)",
+        "CREATE INDEX IF NOT EXISTS idx_ordini_data ON ordini_fornitore(data_ordine)",
+        "CREATE INDEX IF NOT EXISTS idx_distinte_codice ON distinte(codice)",
+    ]),
+    (3, "un solo prezzo per componente e fornitore", [
+        # Tiene il prezzo inserito per ultimo tra i duplicati creati da INSERT OR REPLACE
+        '''
+        DELETE FROM prezzi_fornitori
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM prezzi_fornitori GROUP BY id_componente, id_fornitore
+        )
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_prezzi_componente_fornitore "
+        "ON prezzi_fornitori(id_componente, id_fornitore)",
+    ]),
+    (4, "sottodistinte per i componenti di produzione", [
+        "ALTER TABLE componenti ADD COLUMN id_sottodistinta INTEGER REFERENCES distinte(id)",
+        "CREATE INDEX IF NOT EXISTS idx_componenti_sottodistinta ON componenti(id_sottodistinta)",
+    ]),
+    (5, "indici coprenti per i costi per materiale e i legami tra distinte", [
+        # Copre le somme per distinta e per (distinta, materiale) sulle sole foglie
+        "DROP INDEX IF EXISTS idx_componenti_distinta",
+        "CREATE INDEX IF NOT EXISTS idx_componenti_costi "
+        "ON componenti(id_distinta, materiale, qty, costo, id_sottodistinta)",
+        # Quasi tutti i componenti non hanno sottodistinta: basta indicizzare gli altri
+        "DROP INDEX IF EXISTS idx_componenti_sottodistinta",
+        "CREATE INDEX IF NOT EXISTS idx_componenti_sottodistinta "
+        "ON componenti(id_sottodistinta) WHERE id_sottodistinta IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_componenti_legami "
+        "ON componenti(id_distinta, id_sottodistinta, qty) WHERE id_sottodistinta IS NOT NULL",
+    ]),
+    (6, "riepilogo costi per distinta invalidato da trigger", [
+        '''
+        CREATE TABLE IF NOT EXISTS riepilogo_costi (
+            id_distinta INTEGER PRIMARY KEY REFERENCES distinte(id),
+            n_componenti INTEGER NOT NULL,
+            costo_totale REAL NOT NULL,
+            macrozone TEXT NOT NULL  -- JSON [[macrozona, costo], ...]
+        )
+        ''',
+        # Ogni modifica ai componenti cancella il riepilogo della distinta...
+        '''
+        CREATE TRIGGER IF NOT EXISTS riepilogo_componente_inserito AFTER INSERT ON componenti
+        BEGIN
+            DELETE FROM riepilogo_costi WHERE id_distinta = NEW.id_distinta;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS riepilogo_componente_modificato
+        AFTER UPDATE OF id_distinta, macrozona, qty, costo, id_sottodistinta ON componenti
+        BEGIN
+            DELETE FROM riepilogo_costi WHERE id_distinta IN (OLD.id_distinta, NEW.id_distinta);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS riepilogo_componente_eliminato AFTER DELETE ON componenti
+        BEGIN
+            DELETE FROM riepilogo_costi WHERE id_distinta = OLD.id_distinta;
+        END
+        ''',
+        # ...e a cascata quelli delle distinte che la usano come sottodistinta
+        # (serve PRAGMA recursive_triggers per risalire piu' di un livello)
+        '''
+        CREATE TRIGGER IF NOT EXISTS riepilogo_padri AFTER DELETE ON riepilogo_costi
+        BEGIN
+            DELETE FROM riepilogo_costi
+            WHERE id_distinta IN (SELECT id_distinta FROM componenti WHERE id_sottodistinta = OLD.id_distinta);
+        END
+        ''',
+    ]),
+    (7, "indici per stato e paginazione degli ordini fornitore", [
+        # Copre il conteggio delle date mancanti per ordine senza leggere le righe
+        "DROP INDEX IF EXISTS idx_righe_ordine",
+        "CREATE INDEX IF NOT EXISTS idx_righe_stato "
+        "ON righe_ordine_fornitore(id_ordine, qty, data_confermata, data_consegna)",
+        "CREATE INDEX IF NOT EXISTS idx_ordini_fornitore_data ON ordini_fornitore(id_fornitore, data_ordine)",
+    ]),
+    (8, "revisioni delle distinte come delta con snapshot periodici", _migrazione_revisioni),
+    (9, "allegati nell'archivio per hash con conteggio dei riferimenti", _migrazione_allegati),
+    (10, "indice delle geometrie dei disegni DXF", _migrazione_geometrie_dxf),
+    (11, "indici per il fabbisogno netto su giacenze e ordini aperti", [
+        "CREATE INDEX IF NOT EXISTS idx_magazzino_componente ON magazzino(id_componente, giacenza)",
+        # Solo le righe non ancora consegnate: stessa condizione di fabbisogno_netto()
+        "CREATE INDEX IF NOT EXISTS idx_righe_aperte ON righe_ordine_fornitore(id_componente, qty) "
+        "WHERE COALESCE(data_consegna, '') = ''",
+        "CREATE INDEX IF NOT EXISTS idx_produzioni_data ON produzioni(data_produzione)",
+    ]),
+    # Vuota: i tempi di consegna si leggono dalle statistiche della migrazione 13,
+    # l'indice sullo storico delle consegne previsto qui non serve
+    (12, "nessuna modifica", []),
+    (13, "statistiche di consegna per fornitore aggiornate da trigger", _migrazione_statistiche_fornitori),
+    (14, "costo fisso e valore minimo d'ordine per fornitore", [
+        "ALTER TABLE fornitori ADD COLUMN costo_ordine REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE fornitori ADD COLUMN ordine_minimo REAL NOT NULL DEFAULT 0",
+    ]),
+    (15, "listini fornitori con data di validita' e scaglioni di quantita'", _migrazione_listini),
+    (16, "ricerca full-text sui componenti", _migrazione_ricerca_componenti),
+    (17, "chiusura dei legami tra distinte e indici inversi per il dove usato", _migrazione_dove_usato),
+    (18, "numeri d'ordine fornitore unici da un contatore per anno", _migrazione_numerazione_ordini),
+    (19, "trigger della ricerca senza contatore delle modifiche", _migrazione_ricerca_senza_versione),
+]
+
+
+# Applica le migrazioni non ancora eseguite, ognuna nella sua transazione
+def migra_db(conn):
+    for versione, descrizione, passi in MIGRAZIONI:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Riletta dentro la transazione: un altro processo potrebbe averla appena applicata
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= versione:
+                conn.rollback()
+                continue
+            c = conn.cursor()
+            if callable(passi):
+                passi(c)
+            else:
+                for sql in passi:
+                    c.execute(sql)
+            c.execute(f"PRAGMA user_version = {versione}")
+            conn.commit()
+            app.logger.info("Migrazione %d applicata: %s", versione, descrizione)
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# Connessioni al database
+#
+# Ogni richiesta prende una connessione da un piccolo pool e la restituisce nel
+# teardown, anche se la view esce prima o solleva un'eccezione. Le connessioni
+# restano aperte tra una richiesta e l'altra, cosi' la cache delle istruzioni
+# preparate (cached_statements) viene riutilizzata. In WAL i lettori non
+# vengono bloccati da una scrittura in corso (es. genera_ordine_fornitore).
+POOL_MAX = 8
+APERTURA_ATTESE = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, None)  # secondi tra i tentativi di apertura
+_pool = {}  # percorso database -> connessioni libere
+_pool_lock = threading.Lock()
+_db_pronti = set()  # database gia' inizializzati e migrati da questo processo
+_db_pronti_lock = threading.Lock()
+
+
+# Schema e migrazioni alla prima connessione del processo a un database: vale
+# per i worker WSGI e per i comandi flask, non solo per l'avvio con __main__.
+# migra_db e' sicura anche con piu' processi che partono insieme.
+def prepara_db(percorso):
+    with _db_pronti_lock:
+        if percorso not in _db_pronti:
+            init_db(percorso)
+            _db_pronti.add(percorso)
+
+
+def _apri_connessione(percorso):
+    conn = sqlite3.connect(percorso, timeout=10, check_same_thread=False, cached_statements=256,
+                           factory=ConnessioneStrumentata)
+    # Chi apre per primo un database in WAL (o chiude l'ultima connessione)
+    # tiene per un attimo un lock esclusivo sull'indice condiviso: in quel
+    # momento le altre connessioni ricevono "database is locked" subito, senza
+    # busy timeout, e devono riprovare. WAL resta salvato nel file, quindi si
+    # imposta solo la prima volta.
+    for attesa in APERTURA_ATTESE:
+        try:
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+                conn.execute("PRAGMA journal_mode = WAL")
+            break
+        except sqlite3.OperationalError as e:
+            if attesa is None or 'locked' not in str(e):
+                conn.close()
+                raise
+            time.sleep(attesa)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -20000")  # 20 MB
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA recursive_triggers = ON")  # invalidazione di riepilogo_costi su piu' livelli
+    return conn
+
+
+def get_db():
+    if 'db' not in g:
+        with _pool_lock:
+            libere = _pool.setdefault(DB_NAME, [])
+            conn = libere.pop() if libere else None
+        if conn is None and DB_NAME not in _db_pronti:
+            prepara_db(DB_NAME)
+        g.db_percorso = DB_NAME
+        g.db = conn or _apri_connessione(DB_NAME)
+        g.db.statistiche = nuove_statistiche_sql()
+    return g.db
+
+
+@app.teardown_appcontext
+def rilascia_db(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    percorso = g.pop('db_percorso')
+    # Una transazione rimasta aperta (errore o return anticipato) non va riusata
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        libere = _pool.setdefault(percorso, [])
+        if len(libere) < POOL_MAX:
+            libere.append(conn)
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+# Chiude le connessioni libere (es. dopo aver cambiato DB_NAME o a fine processo)
+def chiudi_pool():
+    with _pool_lock:
+        connessioni = [conn for libere in _pool.values() for conn in libere]
+        _pool.clear()
+    for conn in connessioni:
+        conn.close()
+
+
+# Strumentazione delle richieste
+#
+# Le connessioni del pool sono ConnessioneStrumentata: ogni istruzione eseguita,
+# il tempo passato in SQLite (execute, lettura delle righe e commit) e le righe
+# lette si sommano in conn.statistiche, azzerate quando get_db() consegna la
+# connessione a una richiesta. A fine richiesta questi totali e il tempo di
+# rendering dei template vanno nell'header Server-Timing e nelle metriche del
+# processo, esposte da /metrics nel formato testuale di Prometheus. Con
+# SQL_LENTE_MS impostato le istruzioni piu' lente della soglia finiscono nel
+# log insieme al loro EXPLAIN QUERY PLAN.
+
+SQL_LENTE_MS = None  # es. 100: registra nel log le istruzioni che durano di piu'
+DURATA_LIMITI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # bucket in secondi
+
+
+def nuove_statistiche_sql():
+    return {'istruzioni': 0, 'secondi': 0.0, 'righe': 0}
+
+
+_orologio = time.perf_counter
+
+
+# Tempo e righe dell'istruzione corrente restano nel cursore e passano alla
+# connessione quando l'istruzione finisce: righe esaurite, nuova execute,
+# close o cursore abbandonato
+class CursoreStrumentato(sqlite3.Cursor):
+    _sql = None
+    _parametri = None
+    _secondi = 0.0
+    _righe = 0
+
+    def _chiudi_istruzione(self):
+        statistiche = self.connection.statistiche
+        statistiche['secondi'] += self._secondi
+        statistiche['righe'] += self._righe
+        if SQL_LENTE_MS is not None and self._secondi * 1000 >= SQL_LENTE_MS:
+            registra_sql_lenta(self.connection, self._sql, self._parametri, self._secondi)
+        self._sql = None
+
+    def _esegui(self, metodo, sql, argomento, parametri):
+        if self._sql is not None:
+            self._chiudi_istruzione()
+        self.connection.statistiche['istruzioni'] += 1
+        self._sql, self._parametri, self._secondi, self._righe = sql, parametri, 0.0, 0
+        inizio = _orologio()
+        try:
+            return metodo(self, *argomento)
+        finally:
+            self._secondi += _orologio() - inizio
+
+    def execute(self, sql, parametri=()):
+        return self._esegui(sqlite3.Cursor.execute, sql, (sql, parametri), parametri)
+
+    def executemany(self, sql, sequenza):
+        return self._esegui(sqlite3.Cursor.executemany, sql, (sql, sequenza), None)
+
+    def executescript(self, script):
+        return self._esegui(sqlite3.Cursor.executescript, script, (script,), None)
+
+    def fetchone(self):
+        inizio = _orologio()
+        riga = sqlite3.Cursor.fetchone(self)
+        self._secondi += _orologio() - inizio
+        if riga is None:
+            if self._sql is not None:
+                self._chiudi_istruzione()
+        else:
+            self._righe += 1
+        return riga
+
+    def fetchmany(self, size=None):
+        inizio = _orologio()
+        righe = sqlite3.Cursor.fetchmany(self, self.arraysize if size is None else size)
+        self._secondi += _orologio() - inizio
+        self._righe += len(righe)
+        if not righe and self._sql is not None:
+            self._chiudi_istruzione()
+        return righe
+
+    def fetchall(self):
+        inizio = _orologio()
+        righe = sqlite3.Cursor.fetchall(self)
+        self._secondi += _orologio() - inizio
+        self._righe += len(righe)
+        if self._sql is not None:
+            self._chiudi_istruzione()
+        return righe
+
+    def __next__(self):
+        inizio = _orologio()
+        try:
+            riga = sqlite3.Cursor.__next__(self)
+        except StopIteration:
+            self._secondi += _orologio() - inizio
+            if self._sql is not None:
+                self._chiudi_istruzione()
+            raise
+        self._secondi += _orologio() - inizio
+        self._righe += 1
+        return riga
+
+    def close(self):
+        if self._sql is not None:
+            self._chiudi_istruzione()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        if self._sql is not None:
+            self._chiudi_istruzione()
+
+
+class ConnessioneStrumentata(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statistiche = nuove_statistiche_sql()
+
+    def cursor(self, factory=CursoreStrumentato):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametri=()):
+        return self.cursor().execute(sql, parametri)
+
+    def executemany(self, sql, sequenza):
+        return self.cursor().executemany(sql, sequenza)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        inizio = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.statistiche['secondi'] += time.perf_counter() - inizio
+
+
+# Log di un'istruzione lenta con il suo piano; il piano e' letto con un
+# cursore semplice per non contarlo nelle statistiche della richiesta
+def registra_sql_lenta(conn, sql, parametri, secondi):
+    testo = ' '.join(sql.split())
+    piano = ''
+    if parametri is not None and re.match(r'(SELECT|WITH|INSERT|UPDATE|DELETE)\b', testo, re.I):
+        try:
+            righe = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parametri).fetchall()
+            piano = ''.join(f"\n    {riga[3]}" for riga in righe)
+        except sqlite3.Error as e:
+            piano = f"\n    (piano non disponibile: {e})"
+    percorso = request.path if has_request_context() else '-'
+    app.logger.warning("SQL lenta %.1f ms in %s: %s%s", secondi * 1000, percorso, testo, piano)
+
+
+_metriche = {}  # (route, metodo) -> totali della route
+_metriche_lock = threading.Lock()
+
+
+@before_render_template.connect_via(app)
+def _inizio_template(sender, template, context, **extra):
+    g.inizio_template = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _fine_template(sender, template, context, **extra):
+    inizio = g.pop('inizio_template', None)
+    if inizio is not None:
+        g.secondi_template = g.get('secondi_template', 0.0) + time.perf_counter() - inizio
+
+
+@app.before_request
+def _inizio_richiesta():
+    g.inizio_richiesta = time.perf_counter()
+
+
+@app.after_request
+def _fine_richiesta(risposta):
+    inizio = g.get('inizio_richiesta')
+    if inizio is None:
+        return risposta
+    secondi = time.perf_counter() - inizio
+    conn = g.get('db')
+    statistiche = conn.statistiche if conn is not None else nuove_statistiche_sql()
+    secondi_template = g.get('secondi_template', 0.0)
+
+    tempi = [('sql', statistiche['secondi'], f"{statistiche['istruzioni']} istruzioni, {statistiche['righe']} righe"),
+             ('template', secondi_template),
+             ('totale', secondi)]
+    esistente = risposta.headers.get('Server-Timing')
+    risposta.headers['Server-Timing'] = ", ".join(filter(None, [esistente, server_timing(tempi)]))
+
+    route = request.url_rule.rule if request.url_rule is not None else 'nessuna'
+    with _metriche_lock:
+        voce = _metriche.get((route, request.method))
+        if voce is None:
+            voce = _metriche[(route, request.method)] = {
+                'stati': {}, 'bucket': [0] * len(DURATA_LIMITI), 'secondi': 0.0,
+                'sql_istruzioni': 0, 'sql_secondi': 0.0, 'sql_righe': 0, 'template_secondi': 0.0,
+            }
+        voce['stati'][risposta.status_code] = voce['stati'].get(risposta.status_code, 0) + 1
+        for i, limite in enumerate(DURATA_LIMITI):
+            if secondi <= limite:
+                voce['bucket'][i] += 1
+        voce['secondi'] += secondi
+        voce['sql_istruzioni'] += statistiche['istruzioni']
+        voce['sql_secondi'] += statistiche['secondi']
+        voce['sql_righe'] += statistiche['righe']
+        voce['template_secondi'] += secondi_template
+    return risposta
+
+
+def _etichette(**valori):
+    def valore(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{nome}="{valore(v)}"' for nome, v in valori.items()) + '}'
+
+
+# Metriche del processo nel formato testuale di Prometheus (ogni worker ha le sue)
+@app.route('/metrics')
+def metriche():
+    with _metriche_lock:
+        voci = sorted((chiave, dict(voce, stati=dict(voce['stati']), bucket=list(voce['bucket'])))
+                      for chiave, voce in _metriche.items())
+    with _statistiche_lock:
+        cache = dict(_statistiche_riepiloghi)
+    with _pool_lock:
+        libere = sum(len(conn) for conn in _pool.values())
+
+    righe = []
+
+    def metrica(nome, tipo, descrizione, valori):
+        righe.append(f"# HELP {nome} {descrizione}")
+        righe.append(f"# TYPE {nome} {tipo}")
+        righe.extend(f"{nome}{etichette} {valore:g}" if isinstance(valore, float) else f"{nome}{etichette} {valore}"
+                     for etichette, valore in valori)
+
+    metrica('gestionale_richieste_total', 'counter', "Richieste servite per route, metodo e stato HTTP",
+            [(_etichette(route=route, metodo=metodo, stato=stato), n)
+             for (route, metodo), voce in voci for stato, n in sorted(voce['stati'].items())])
+
+    righe.append("# HELP gestionale_richiesta_secondi Durata delle richieste")
+    righe.append("# TYPE gestionale_richiesta_secondi histogram")
+    for (route, metodo), voce in voci:
+        etichette = dict(route=route, metodo=metodo)
+        for limite, cumulati in zip(DURATA_LIMITI, voce['bucket']):
+            righe.append(f"gestionale_richiesta_secondi_bucket{_etichette(**etichette, le=limite)} {cumulati}")
+        righe.append(f"gestionale_richiesta_secondi_bucket{_etichette(**etichette, le='+Inf')} "
+                     f"{sum(voce['stati'].values())}")
+        righe.append(f"gestionale_richiesta_secondi_sum{_etichette(**etichette)} {voce['secondi']:g}")
+        righe.append(f"gestionale_richiesta_secondi_count{_etichette(**etichette)} {sum(voce['stati'].values())}")
+
+    for nome, campo, descrizione in [
+        ('gestionale_sql_istruzioni_total', 'sql_istruzioni', "Istruzioni SQL eseguite"),
+        ('gestionale_sql_secondi_total', 'sql_secondi', "Tempo passato in SQLite"),
+        ('gestionale_sql_righe_total', 'sql_righe', "Righe lette dalle query"),
+        ('gestionale_template_secondi_total', 'template_secondi', "Tempo di rendering dei template"),
+    ]:
+        metrica(nome, 'counter', descrizione,
+                [(_etichette(route=route, metodo=metodo), voce[campo]) for (route, metodo), voce in voci])
+
+    metrica('gestionale_cache_costi_total', 'counter', "Letture dei riepiloghi costi per esito",
+            [(_etichette(esito=esito), n) for esito, n in sorted(cache.items())])
+    metrica('gestionale_pool_connessioni_libere', 'gauge', "Connessioni SQLite libere nel pool",
+            [('', libere)])
+    return Response("\n".join(righe) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/')
+def dashboard():
+    return render_template("dashboard.html")
+
+
+DISTINTE_PER_PAGINA = 50
+
+# Colonne ammesse per l'ordinamento dell'elenco distinte (mai interpolare input utente)
+ORDINAMENTI_DISTINTE = {
+    'codice': 'd.codice',
+    'descrizione': 'd.descrizione',
+    'costo': 'costo_totale',
+    'componenti': 'n_componenti',
+}
+ORDINAMENTI_PER_TOTALI = ('costo', 'componenti')
+RIEPILOGHI_PER_TRANSAZIONE = 50  # distinte ricalcolate per transazione di scrittura
+
+
+# Elenco paginato delle distinte con costo totale e numero componenti.
+# Totali e conteggi arrivano da riepilogo_costi: a regime sono sempre due query
+# (conteggio + pagina) e i componenti non vengono riaggregati. I riepiloghi
+# mancanti o invalidati si ricalcolano solo per le righe della pagina; solo
+# l'ordinamento per costo o componenti richiede quelli di tutte le distinte
+# filtrate, ricalcolati a blocchi di RIEPILOGHI_PER_TRANSAZIONE per non tenere
+# il lock di scrittura per tutto il ricalcolo.
+def elenco_distinte(c, filtro_codice='', ordina='codice', direzione='asc', pagina=1,
+                    per_pagina=DISTINTE_PER_PAGINA):
+    if ordina not in ORDINAMENTI_DISTINTE:
+        ordina = 'codice'
+    colonna = ORDINAMENTI_DISTINTE[ordina]
+    verso = 'DESC' if direzione == 'desc' else 'ASC'
+    filtro = f"%{filtro_codice}%"
+
+    c.execute('''
+        SELECT COUNT(*), json_group_array(d.id) FILTER (WHERE r.id_distinta IS NULL)
+        FROM distinte d
+        LEFT JOIN riepilogo_costi r ON r.id_distinta = d.id
+        WHERE d.codice LIKE ?
+    ''', (filtro,))
+    n_distinte, mancanti = c.fetchone()
+    mancanti = set(json.loads(mancanti))
+    calcolati = {}
+    if mancanti and ordina in ORDINAMENTI_PER_TOTALI:
+        da_calcolare = sorted(mancanti)
+        for inizio in range(0, len(da_calcolare), RIEPILOGHI_PER_TRANSAZIONE):
+            calcolati.update(calcola_riepiloghi(c.connection,
+                                                da_calcolare[inizio:inizio + RIEPILOGHI_PER_TRANSAZIONE]))
+
+    n_pagine = max(1, -(-n_distinte // per_pagina))
+    pagina = max(1, min(pagina, n_pagine))
+
+    c.execute(f'''
+        SELECT d.id, d.codice, d.descrizione,
+               ROUND(COALESCE(r.costo_totale, 0), 2) AS costo_totale,
+               COALESCE(r.n_componenti, 0) AS n_componenti
+        FROM distinte d
+        LEFT JOIN riepilogo_costi r ON r.id_distinta = d.id
+        WHERE d.codice LIKE ?
+        ORDER BY {colonna} {verso}, d.id {verso}
+        LIMIT ? OFFSET ?
+    ''', (filtro, per_pagina, (pagina - 1) * per_pagina))
+    righe = c.fetchall()
+    sulla_pagina = {riga[0] for riga in righe if riga[0] in mancanti and riga[0] not in calcolati}
+    if sulla_pagina:
+        calcolati.update(calcola_riepiloghi(c.connection, sulla_pagina))
+        righe = [riga[:3] + (round(calcolati[riga[0]].costo_totale, 2), calcolati[riga[0]].n_componenti)
+                 if riga[0] in sulla_pagina else riga for riga in righe]
+    conta_riepiloghi(hit=sum(1 for riga in righe if riga[0] not in mancanti), miss=len(mancanti & calcolati.keys()))
+    return righe, n_distinte
+
+
+@app.route('/distinte')
+def distinte():
+    filtro_codice = request.args.get('codice', '').strip()
+    ordina = request.args.get('ordina', 'codice')
+    direzione = request.args.get('dir', 'asc')
+    pagina = request.args.get('pagina', 1, type=int)
+
+    conn = get_db()
+    c = conn.cursor()
+    distinte, n_distinte = elenco_distinte(c, filtro_codice, ordina, direzione, pagina)
+
+    n_pagine = max(1, -(-n_distinte // DISTINTE_PER_PAGINA))
+    return render_template("lista_distinte.html",
+                           distinte=distinte,
+                           n_distinte=n_distinte,
+                           pagina=max(1, min(pagina, n_pagine)),
+                           n_pagine=n_pagine,
+                           filtro_codice=filtro_codice,
+                           ordina=ordina if ordina in ORDINAMENTI_DISTINTE else 'codice',
+                           direzione='desc' if direzione == 'desc' else 'asc')
+
+
+@app.route('/nuova-distinta', methods=['GET', 'POST'])
+def nuova_distinta():
+    if request.method == 'POST':
+        codice = request.form['codice']
+        descrizione = request.form['descrizione']
+
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("INSERT INTO distinte (codice, descrizione) VALUES (?, ?)", (codice, descrizione))
+        conn.commit()
+        return redirect(url_for('dashboard'))
+
+    return render_template("nuova_distinta.html")
+
+
+# Esplosione distinta multilivello
+#
+# Un componente di tipo Produzione puo' puntare a un'altra distinta
+# (componenti.id_sottodistinta). L'albero completo viene letto con una sola
+# CTE ricorsiva; il fabbisogno e il costo di ogni sottodistinta sono calcolati
+# una volta sola anche se compare sotto molti padri.
+
+class DistintaCiclica(ValueError):
+    pass
+
+
+class SottodistintaInesistente(ValueError):
+    pass
+
+
+Esplosione = namedtuple('Esplosione', [
+    'struttura',       # {id_distinta: [righe componente dirette]}
+    'componenti',      # {id_componente: riga} di tutto l'albero
+    'fabbisogni',      # {id_distinta: {id_componente foglia: qty per 1 pezzo}}
+    'costi',           # {id_distinta: costo per 1 pezzo con le sottodistinte}
+])
+
+
+# Righe: (id, id_distinta, macrozona, nome, codice, materiale, spessore, qty, costo, tipo, id_sottodistinta).
+# id_distinta puo' essere anche una lista: si carica l'unione degli alberi.
+def carica_struttura(c, id_distinta):
+    radici = [id_distinta] if isinstance(id_distinta, int) else list(id_distinta)
+    c.execute('''
+        WITH RECURSIVE albero(id) AS (
+            SELECT value FROM json_each(?)
+            UNION
+            SELECT c.id_sottodistinta
+            FROM componenti c
+            JOIN albero a ON c.id_distinta = a.id
+            WHERE c.id_sottodistinta IS NOT NULL
+        )
+        SELECT id, id_distinta, macrozona, nome, codice, materiale, spessore,
+               COALESCE(qty, 0), COALESCE(costo, 0), tipo, id_sottodistinta
+        FROM componenti
+        WHERE id_distinta IN (SELECT id FROM albero)
+        ORDER BY id
+    ''', (json.dumps(radici),))
+    struttura = {}
+    for riga in c.fetchall():
+        struttura.setdefault(riga[1], []).append(riga)
+    return struttura
+
+
+# id_distinta puo' essere una lista: le radici condividono la memoizzazione
+def esplodi_distinta(c, id_distinta):
+    struttura = carica_struttura(c, id_distinta)
+    fabbisogni = {}
+    costi = {}
+    in_corso = []
+
+    def visita(id_d):
+        if id_d in fabbisogni:
+            return
+        if id_d in in_corso:
+            percorso = in_corso[in_corso.index(id_d):] + [id_d]
+            raise DistintaCiclica("Ciclo tra le distinte " + " -> ".join(map(str, percorso)))
+        in_corso.append(id_d)
+        fabbisogno = {}
+        costo = 0.0
+        for riga in struttura.get(id_d, []):
+            id_comp, qty, costo_riga, id_sotto = riga[0], riga[7], riga[8], riga[10]
+            if id_sotto is not None:
+                visita(id_sotto)
+                for id_foglia, qty_foglia in fabbisogni[id_sotto].items():
+                    fabbisogno[id_foglia] = fabbisogno.get(id_foglia, 0) + qty * qty_foglia
+                costo += qty * costi[id_sotto]
+            else:
+                fabbisogno[id_comp] = fabbisogno.get(id_comp, 0) + qty
+                costo += qty * costo_riga
+        in_corso.pop()
+        fabbisogni[id_d] = fabbisogno
+        costi[id_d] = costo
+
+    for radice in ([id_distinta] if isinstance(id_distinta, int) else id_distinta):
+        visita(radice)
+    componenti = {riga[0]: riga for righe in struttura.values() for riga in righe}
+    return Esplosione(struttura, componenti, fabbisogni, costi)
+
+
+# Costo unitario effettivo di una riga: per le sottodistinte e' il costo esploso
+def costo_riga(esplosione, riga):
+    if riga[10] is not None:
+        return esplosione.costi[riga[10]]
+    return riga[8]
+
+
+# Fabbisogno piatto di componenti foglia per qty pezzi della distinta:
+# [(riga componente, qty per pezzo, qty totale)]
+def fabbisogno_esploso(esplosione, id_distinta, qty=1):
+    return [(esplosione.componenti[id_comp], qty_unitaria, qty_unitaria * qty)
+            for id_comp, qty_unitaria in esplosione.fabbisogni[id_distinta].items()]
+
+
+# Verifica che collegare id_sottodistinta sotto id_distinta non crei un ciclo
+def verifica_sottodistinta(c, id_distinta, id_sottodistinta):
+    if id_sottodistinta is None:
+        return
+    struttura = carica_struttura(c, id_sottodistinta)
+    raggiungibili = {id_sottodistinta} | set(struttura)
+    raggiungibili |= {riga[10] for righe in struttura.values() for riga in righe if riga[10] is not None}
+    if id_distinta in raggiungibili:
+        raise DistintaCiclica(f"La distinta {id_sottodistinta} contiene gia' la distinta {id_distinta}")
+
+
+# Id della sottodistinta dal codice inserito nel form (solo per i componenti di produzione)
+def leggi_sottodistinta(c, form):
+    codice = form.get('sottodistinta', '').strip()
+    if not codice or form.get('tipo') != 'Produzione':
+        return None
+    c.execute("SELECT id FROM distinte WHERE codice = ?", (codice,))
+    trovata = c.fetchone()
+    if not trovata:
+        raise SottodistintaInesistente(f"Sottodistinta {codice} inesistente")
+    return trovata[0]
+
+
+@app.errorhandler(DistintaCiclica)
+@app.errorhandler(SottodistintaInesistente)
+def errore_distinta(e):
+    return str(e), 400
+
+
+# Riepilogo costi per distinta
+#
+# Numero componenti, costo totale esploso e costi per macrozona sono salvati in
+# riepilogo_costi e letti da elenco e dettaglio senza riaggregare i componenti.
+# I trigger della migrazione 6 cancellano il riepilogo quando cambiano i
+# componenti di una distinta (anche da import o da altri processi) e risalgono
+# alle distinte che la usano come sottodistinta; il ricalcolo avviene alla
+# lettura successiva.
+
+Riepilogo = namedtuple('Riepilogo', ['n_componenti', 'costo_totale', 'macrozone'])
+
+_statistiche_riepiloghi = {'hit': 0, 'miss': 0}
+_statistiche_lock = threading.Lock()
+
+
+def conta_riepiloghi(hit=0, miss=0):
+    with _statistiche_lock:
+        _statistiche_riepiloghi['hit'] += hit
+        _statistiche_riepiloghi['miss'] += miss
+
+
+# Ricalcola e salva i riepiloghi delle distinte indicate (e delle loro sottodistinte).
+# Lettura e scrittura stanno nella stessa transazione: una modifica concorrente
+# non puo' essere sovrascritta da un riepilogo calcolato sui dati vecchi. Dentro
+# una transazione gia' aperta scrive in quella e lascia il commit al chiamante.
+def calcola_riepiloghi(conn, id_distinte):
+    riepiloghi = {}
+    propria = not conn.in_transaction
+    if propria:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        c = conn.cursor()
+        esplosione = esplodi_distinta(c, list(id_distinte))
+        for id_d, costo_totale in esplosione.costi.items():
+            righe = esplosione.struttura.get(id_d, [])
+            macrozone = {}
+            for riga in righe:
+                macrozone[riga[2]] = macrozone.get(riga[2], 0) + riga[7] * costo_riga(esplosione, riga)
+            riepiloghi[id_d] = Riepilogo(len(righe), costo_totale, list(macrozone.items()))
+        c.executemany('''
+            INSERT INTO riepilogo_costi (id_distinta, n_componenti, costo_totale, macrozone)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(id_distinta) DO UPDATE SET
+                n_componenti = excluded.n_componenti,
+                costo_totale = excluded.costo_totale,
+                macrozone = excluded.macrozone
+        ''', [(id_d, r.n_componenti, r.costo_totale, json.dumps(r.macrozone))
+              for id_d, r in riepiloghi.items()])
+        if propria:
+            conn.commit()
+    except Exception:
+        if propria:
+            conn.rollback()
+        raise
+    return riepiloghi
+
+
+# {id_distinta: Riepilogo} letti dalla tabella, ricalcolando solo quelli mancanti
+def riepiloghi_costi(conn, id_distinte):
+    c = conn.cursor()
+    c.execute('''
+        SELECT id_distinta, n_componenti, costo_totale, macrozone
+        FROM riepilogo_costi
+        WHERE id_distinta IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(id_distinte)),))
+    riepiloghi = {riga[0]: Riepilogo(riga[1], riga[2], [tuple(m) for m in json.loads(riga[3])])
+                  for riga in c.fetchall()}
+    mancanti = [id_d for id_d in id_distinte if id_d not in riepiloghi]
+    if mancanti:
+        calcolati = calcola_riepiloghi(conn, mancanti)
+        riepiloghi.update((id_d, calcolati[id_d]) for id_d in mancanti)
+    conta_riepiloghi(hit=len(id_distinte) - len(mancanti), miss=len(mancanti))
+    return riepiloghi
+
+
+@app.route('/api/cache-costi')
+def statistiche_cache_costi():
+    c = get_db().cursor()
+    c.execute("SELECT COUNT(*) FROM riepilogo_costi")
+    with _statistiche_lock:
+        statistiche = dict(_statistiche_riepiloghi)
+    totale = statistiche['hit'] + statistiche['miss']
+    return jsonify(**statistiche, righe=c.fetchone()[0],
+                   hit_ratio=round(statistiche['hit'] / totale, 4) if totale else None)
+
+
+@app.route('/distinta/<int:id_distinta>')
+def dettaglio_distinta(id_distinta):
+    conn = get_db()
+    c = conn.cursor()
+
+    # Recupera info distinta
+    c.execute("SELECT * FROM distinte WHERE id = ?", (id_distinta,))
+    distinta = c.fetchone()
+
+    if not distinta:
+        return "Distinta non trovata", 404
+
+    # Recupera componenti
+    c.execute("SELECT * FROM componenti WHERE id_distinta = ?", (id_distinta,))
+    componenti = c.fetchall()
+
+    # Costi dal riepilogo: le righe con sottodistinta valgono il costo della sottodistinta
+    id_sotto = {comp[12] for comp in componenti if comp[12] is not None}
+    riepiloghi = riepiloghi_costi(conn, [id_distinta, *id_sotto])
+    costi_righe = {comp[0]: riepiloghi[comp[12]].costo_totale if comp[12] is not None else (comp[9] or 0)
+                   for comp in componenti}
+    costo_totale = riepiloghi[id_distinta].costo_totale
+
+    # Calcola incidenza %
+    riassunto = []
+    for macrozona, costo in riepiloghi[id_distinta].macrozone:
+        incidenza = round((costo / costo_totale) * 100, 1) if costo_totale else 0
+        riassunto.append((macrozona, round(costo, 2), incidenza))
+
+    # Codici delle sottodistinte e fabbisogno piatto (solo se ci sono livelli)
+    sottodistinte = {}
+    fabbisogno = []
+    if id_sotto:
+        esplosione = esplodi_distinta(c, id_distinta)
+        c.execute("SELECT id, codice FROM distinte WHERE id IN (%s)" % ",".join("?" * len(esplosione.struttura)),
+                  list(esplosione.struttura))
+        sottodistinte = dict(c.fetchall())
+        fabbisogno = fabbisogno_esploso(esplosione, id_distinta)
+
+    return render_template(
+        "dettaglio_distinta.html",
+        distinta=distinta,
+        componenti=componenti,
+        riassunto=riassunto,
+        costo_totale=round(costo_totale, 2),
+        costi_righe=costi_righe,
+        sottodistinte=sottodistinte,
+        fabbisogno=fabbisogno,
+        geometrie=geometrie_distinta(c, id_distinta)
+    )
+
+# Esportazione Excel in streaming
+#
+# Il file .xlsx e' uno zip di XML: ogni foglio viene scritto nello zip man mano
+# che le righe arrivano dal cursore e i byte compressi vengono inviati subito al
+# client (transfer chunked, senza Content-Length). In memoria restano solo il
+# blocco di righe corrente e il buffer di compressione, qualunque sia la
+# dimensione della distinta o del catalogo.
+
+COLONNE_EXCEL = ['ID', 'Macrozona', 'Nome', 'Codice', 'Materiale', 'Spessore', 'QTY',
+                 'Lavorazioni', 'Costo', 'Costo totale', 'Tipo', 'File']
+QUERY_EXCEL = '''
+    SELECT id, macrozona, nome, codice, materiale, spessore, qty,
+           lavorazioni, costo, qty * costo, tipo, nome_file
+    FROM componenti
+    WHERE id_distinta = ?
+    ORDER BY id
+'''
+RIGHE_PER_BLOCCO = 500
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Caratteri di controllo non ammessi in XML 1.0
+_CARATTERI_NON_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+# Destinazione dello zip: accumula i byte scritti finche' il generatore non li invia.
+# Non ha tell()/seek(), quindi zipfile scrive in modalita' streaming.
+class _BufferStreaming:
+    def __init__(self):
+        self.blocchi = []
+
+    def write(self, dati):
+        self.blocchi.append(bytes(dati))
+        return len(dati)
+
+    def flush(self):
+        pass
+
+    def svuota(self):
+        dati = b''.join(self.blocchi)
+        self.blocchi = []
+        return dati
+
+
+def _cella_xml(valore):
+    if valore is None or valore == '':
+        return '<c/>'
+    if isinstance(valore, (int, float)) and not isinstance(valore, bool):
+        return f'<c><v>{valore!r}</v></c>'
+    testo = xml_escape(_CARATTERI_NON_XML.sub('', str(valore)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{testo}</t></is></c>'
+
+
+def _riga_xml(valori):
+    return '<row>' + ''.join(_cella_xml(v) for v in valori) + '</row>'
+
+
+# Nome foglio valido per Excel: max 31 caratteri, niente []:*?/\ e univoco
+def _nome_foglio(nome, usati):
+    base = re.sub(r'[\[\]:*?/\\]', '_', str(nome or 'Foglio'))[:31] or 'Foglio'
+    candidato, n = base, 1
+    while candidato.lower() in usati:
+        n += 1
+        suffisso = f" ({n})"
+        candidato = base[:31 - len(suffisso)] + suffisso
+    usati.add(candidato.lower())
+    return candidato
+
+
+# fogli: iterabile di (nome, intestazioni, righe); ritorna un generatore di byte
+def xlsx_streaming(fogli):
+    buffer = _BufferStreaming()
+    nomi = []
+    usati = set()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for numero, (nome, intestazioni, righe) in enumerate(fogli, 1):
+            nomi.append(_nome_foglio(nome, usati))
+            with zf.open(f'xl/worksheets/sheet{numero}.xml', 'w', force_zip64=True) as foglio:
+                foglio.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                             b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                             b'<sheetData>')
+                foglio.write(_riga_xml(intestazioni).encode('utf-8'))
+                blocco = []
+                for riga in righe:
+                    blocco.append(_riga_xml(riga))
+                    if len(blocco) >= RIGHE_PER_BLOCCO:
+                        foglio.write(''.join(blocco).encode('utf-8'))
+                        blocco = []
+                        yield buffer.svuota()
+                foglio.write(''.join(blocco).encode('utf-8'))
+                foglio.write(b'</sheetData></worksheet>')
+            yield buffer.svuota()
+
+        if not nomi:
+            nomi.append('Vuoto')
+            zf.writestr('xl/worksheets/sheet1.xml',
+                        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        '<sheetData/></worksheet>')
+
+        fogli_xml = ''.join(f'<sheet name="{xml_escape(nome, {chr(34): "&quot;"})}" sheetId="{i}" r:id="rId{i}"/>'
+                            for i, nome in enumerate(nomi, 1))
+        zf.writestr('xl/workbook.xml',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                    f'<sheets>{fogli_xml}</sheets></workbook>')
+        relazioni = ''.join(f'<Relationship Id="rId{i}" '
+                            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                            f'Target="worksheets/sheet{i}.xml"/>' for i in range(1, len(nomi) + 1))
+        zf.writestr('xl/_rels/workbook.xml.rels',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                    f'{relazioni}</Relationships>')
+        zf.writestr('_rels/.rels',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                    '<Relationship Id="rId1" '
+                    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+                    'Target="xl/workbook.xml"/></Relationships>')
+        tipi_fogli = ''.join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                             'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                             for i in range(1, len(nomi) + 1))
+        zf.writestr('[Content_Types].xml',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                    '<Default Extension="xml" ContentType="application/xml"/>'
+                    '<Override PartName="/xl/workbook.xml" '
+                    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                    f'{tipi_fogli}</Types>')
+    yield buffer.svuota()
+
+
+# Righe componenti di una distinta lette a blocchi dal cursore
+def righe_excel(c, id_distinta):
+    c.execute(QUERY_EXCEL, (id_distinta,))
+    while True:
+        blocco = c.fetchmany(RIGHE_PER_BLOCCO)
+        if not blocco:
+            return
+        yield from blocco
+
+
+def risposta_xlsx(fogli, nome_file):
+    return Response(stream_with_context(xlsx_streaming(fogli)), mimetype=MIMETYPE_XLSX,
+                    headers={'Content-Disposition': f'attachment; filename="{nome_file}"'})
+
+
+@app.route('/distinta/<int:id_distinta>/export_excel')
+def export_distinta_excel(id_distinta):
+    conn = get_db()
+    c = conn.cursor()
+
+    c.execute("SELECT codice FROM distinte WHERE id = ?", (id_distinta,))
+    distinta = c.fetchone()
+    if not distinta:
+        return "Distinta non trovata", 404
+
+    fogli = [('Componenti', COLONNE_EXCEL, righe_excel(c, id_distinta))]
+    return risposta_xlsx(fogli, f"distinta_{id_distinta}.xlsx")
+
+
+# Piu' distinte (parametro distinte=1,2,3) o tutto il catalogo filtrato per
+# codice, un foglio per distinta. Le distinte sono lette con un cursore e i
+# componenti con un secondo cursore, una distinta alla volta.
+@app.route('/distinte/export_excel')
+def export_catalogo_excel():
+    try:
+        id_distinte = leggi_id_distinte(request.args.get('distinte', ''))
+    except ValueError as e:
+        return str(e), 400
+    conn = get_db()
+    elenco = conn.cursor()
+    if id_distinte:
+        elenco.execute("SELECT id, codice FROM distinte WHERE id IN (SELECT value FROM json_each(?)) ORDER BY codice",
+                       (json.dumps(id_distinte),))
+    else:
+        elenco.execute("SELECT id, codice FROM distinte WHERE codice LIKE ? ORDER BY codice",
+                       (f"%{request.args.get('codice', '').strip()}%",))
+
+    def fogli():
+        componenti = conn.cursor()
+        for id_distinta, codice in elenco:
+            yield codice, COLONNE_EXCEL, righe_excel(componenti, id_distinta)
+
+    return risposta_xlsx(fogli(), "distinte.xlsx")
+
+# Esportazioni pesanti in background
+#
+# Il rendering (es. pisa.CreatePDF) gira in un pool di processi, cosi' non
+# occupa il thread della richiesta ne' il GIL degli altri utenti. Ogni job ha
+# come id l'hash SHA-256 del contenuto da esportare: una distinta invariata
+# produce lo stesso id, quindi il file gia' generato in EXPORT_FOLDER viene
+# riusato e un job identico gia' in corso non viene lanciato due volte.
+
+EXPORT_FOLDER = os.path.join('cache', 'export')
+os.makedirs(EXPORT_FOLDER, exist_ok=True)
+EXPORT_WORKERS = 2
+EXPORT_CACHE_MAX = 500  # file tenuti in cache, i piu' vecchi vengono eliminati
+
+_esecutore_export = None
+_jobs = {}  # id job -> {'stato', 'file', 'errore', 'nome_download'}
+_jobs_lock = threading.Lock()
+
+
+# Eseguita nel processo del pool: HTML -> byte del PDF
+def _rendi_pdf(html):
+    from xhtml2pdf import pisa
+
+    pdf = io.BytesIO()
+    esito = pisa.CreatePDF(io.StringIO(html), dest=pdf)
+    if esito.err:
+        raise RuntimeError(f"Errore nella generazione del PDF ({esito.err} errori)")
+    return pdf.getvalue()
+
+
+def _pool_export():
+    global _esecutore_export
+    if _esecutore_export is None:
+        _esecutore_export = ProcessPoolExecutor(max_workers=EXPORT_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+    return _esecutore_export
+
+
+def id_export(tipo, contenuto):
+    return f"{tipo}-{hashlib.sha256(contenuto.encode('utf-8')).hexdigest()}"
+
+
+# Avvia (se serve) il job e ne ritorna l'id. funzione(*argomenti) deve
+# ritornare i byte del file ed essere importabile dal processo del pool.
+def avvia_export(tipo, contenuto, estensione, nome_download, funzione, *argomenti):
+    id_job = id_export(tipo, contenuto)
+    percorso = os.path.join(EXPORT_FOLDER, f"{id_job}.{estensione}")
+    with _jobs_lock:
+        job = _jobs.get(id_job)
+        if job and job['stato'] == 'in corso':
+            return id_job
+        if os.path.exists(percorso):
+            _jobs[id_job] = {'stato': 'completato', 'file': percorso, 'errore': None, 'nome_download': nome_download}
+            os.utime(percorso)  # segna il file come usato di recente
+            return id_job
+        _jobs[id_job] = {'stato': 'in corso', 'file': percorso, 'errore': None, 'nome_download': nome_download}
+        try:
+            futuro = _pool_export().submit(funzione, *argomenti)
+        except Exception:
+            del _jobs[id_job]
+            raise
+    futuro.add_done_callback(lambda f: _completa_export(id_job, f))
+    return id_job
+
+
+def _completa_export(id_job, futuro):
+    with _jobs_lock:
+        percorso = _jobs[id_job]['file']
+    try:
+        dati = futuro.result()
+        temporaneo = percorso + '.tmp'
+        with open(temporaneo, 'wb') as f:
+            f.write(dati)
+        os.replace(temporaneo, percorso)
+        stato, errore = 'completato', None
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            # Un worker e' morto: il prossimo export ricrea il pool
+            global _esecutore_export
+            _esecutore_export = None
+        app.logger.exception("Export %s fallito", id_job)
+        stato, errore = 'errore', str(e)
+    with _jobs_lock:
+        _jobs[id_job].update(stato=stato, errore=errore)
+    _pulisci_cache_export()
+
+
+def _pulisci_cache_export():
+    file = [os.path.join(EXPORT_FOLDER, nome) for nome in os.listdir(EXPORT_FOLDER)
+            if not nome.endswith('.tmp')]
+    if len(file) <= EXPORT_CACHE_MAX:
+        return
+    file.sort(key=os.path.getmtime)
+    for percorso in file[:len(file) - EXPORT_CACHE_MAX]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(percorso)
+
+
+def stato_job(id_job):
+    with _jobs_lock:
+        job = dict(_jobs[id_job]) if id_job in _jobs else None
+    if job is None:
+        # Job di un processo precedente: basta che il file sia in cache
+        if not re.fullmatch(r'[a-z]+-[0-9a-f]{64}', id_job):
+            return None
+        file = [nome for nome in os.listdir(EXPORT_FOLDER)
+                if nome.startswith(id_job + '.') and not nome.endswith('.tmp')]
+        if not file:
+            return None
+        job = {'stato': 'completato', 'file': os.path.join(EXPORT_FOLDER, file[0]), 'errore': None,
+               'nome_download': file[0]}
+    return job
+
+
+def _html_pdf_distinta(c, id_distinta):
+    c.execute("SELECT 1 FROM distinte WHERE id = ?", (id_distinta,))
+    if c.fetchone() is None:
+        return None
+    c.execute("SELECT * FROM componenti WHERE id_distinta = ? ORDER BY id", (id_distinta,))
+    return render_template("pdf_distinta.html", id=id_distinta, componenti=c.fetchall())
+
+
+# Avvia il job PDF della distinta e ritorna lo stato in JSON
+@app.route('/distinta/<int:id_distinta>/export_pdf/job', methods=['POST'])
+def avvia_export_pdf(id_distinta):
+    c = get_db().cursor()
+    html = _html_pdf_distinta(c, id_distinta)
+    if html is None:
+        return jsonify(errore="Distinta non trovata"), 404
+    id_job = avvia_export('pdf', html, 'pdf', f"distinta_{id_distinta}.pdf", _rendi_pdf, html)
+    return stato_export(id_job)
+
+
+@app.route('/export/<id_job>')
+def stato_export(id_job):
+    job = stato_job(id_job)
+    if job is None:
+        return jsonify(errore="Job inesistente"), 404
+    return jsonify(id=id_job, stato=job['stato'], errore=job['errore'],
+                   stato_url=url_for('stato_export', id_job=id_job),
+                   download=url_for('scarica_export', id_job=id_job))
+
+
+@app.route('/export/<id_job>/download')
+def scarica_export(id_job):
+    job = stato_job(id_job)
+    if job is None:
+        return "Esportazione inesistente", 404
+    if job['stato'] != 'completato':
+        return f"Esportazione non pronta ({job['stato']})", 409
+    return send_file(os.path.abspath(job['file']), download_name=job['nome_download'], as_attachment=True)
+
+
+# Link "Stampa PDF": se il PDF e' gia' in cache lo scarica subito, altrimenti
+# mostra una pagina che avvia il job con una POST e ne attende la fine. La GET
+# non avvia nulla: link seguiti da crawler o prefetch non occupano il pool.
+@app.route('/distinta/<int:id_distinta>/export_pdf')
+def export_distinta_pdf(id_distinta):
+    c = get_db().cursor()
+    html = _html_pdf_distinta(c, id_distinta)
+    if html is None:
+        return "Distinta non trovata", 404
+    id_job = id_export('pdf', html)
+    job = stato_job(id_job)
+    if job and job['stato'] == 'completato':
+        return scarica_export(id_job)
+    return render_template("export_in_corso.html", id_distinta=id_distinta,
+                           stato=job['stato'] if job else 'in attesa')
+
+
+@app.route('/distinta/<int:id_distinta>/aggiungi-componente', methods=['GET', 'POST'])
+def aggiungi_componente(id_distinta):
+    if request.method == 'POST':
+        macrozona = request.form['macrozona']
+        nome = request.form['nome']
+        materiale = request.form['materiale']
+        spessore = request.form['spessore']
+        qty = request.form['qty']
+        lavorazioni = request.form['lavorazioni']
+        costo = request.form['costo']
+        tipo = request.form['tipo']
+        codice = f"{macrozona[:3].upper()}-{nome[:5].upper()}"
+
+        conn = get_db()
+        c = conn.cursor()
+        # Componente e revisione nella stessa transazione
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            id_sottodistinta = leggi_sottodistinta(c, request.form)
+            verifica_sottodistinta(c, id_distinta, id_sottodistinta)
+            c.execute('''
+                INSERT INTO componenti (
+                    id_distinta, macrozona, nome, codice, materiale,
+                    spessore, qty, lavorazioni, costo, tipo, id_sottodistinta
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (id_distinta, macrozona, nome, codice, materiale, spessore, qty, lavorazioni, costo, tipo,
+                  id_sottodistinta))
+            registra_revisione(conn, id_distinta, f"Aggiunto {codice}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return redirect(url_for('dettaglio_distinta', id_distinta=id_distinta))
+
+    return render_template("aggiungi_componente.html", id_distinta=id_distinta)
+
+# Importazione massiva di componenti
+#
+# Il file (.xlsx o .csv) viene letto a blocchi di IMPORT_BLOCCO righe: l'xlsx
+# con openpyxl in sola lettura, il csv con pandas a chunk. Ogni blocco e'
+# validato con operazioni vettoriali pandas e scritto con executemany in una
+# sua transazione, insieme alla revisione dei componenti cambiati. Le righe sono abbinate ai componenti della distinta per
+# codice: un componente gia' presente viene aggiornato solo se cambia qualche
+# valore, le colonne assenti dal file non vengono toccate.
+
+IMPORT_BLOCCO = 1000
+IMPORT_MAX_ERRORI = 1000  # errori riportati per riga, gli altri sono solo contati
+TIPI_COMPONENTE = ('Acquisto', 'Produzione')
+
+# Intestazioni accettate (minuscole, solo lettere) -> colonna. Le altre, es.
+# ID e Costo totale dell'export Excel, vengono ignorate.
+COLONNE_IMPORT = {
+    'macrozona': 'macrozona', 'nome': 'nome', 'codice': 'codice', 'materiale': 'materiale',
+    'spessore': 'spessore', 'qty': 'qty', 'qta': 'qty', 'quantita': 'qty',
+    'lavorazioni': 'lavorazioni', 'costo': 'costo', 'tipo': 'tipo', 'sottodistinta': 'sottodistinta',
+}
+COLONNE_OBBLIGATORIE = ('macrozona', 'nome', 'qty')
+CAMPI_TESTO = ['macrozona', 'nome', 'materiale', 'spessore', 'lavorazioni', 'tipo']
+
+EsitoImport = namedtuple('EsitoImport', ['inseriti', 'aggiornati', 'invariati', 'scartati', 'errori'])
+
+
+class ErroreImport(ValueError):
+    pass
+
+
+@app.errorhandler(ErroreImport)
+def errore_import(e):
+    return str(e), 400
+
+
+# Blocchi DataFrame di testo indicizzati col numero di riga nel foglio
+def _blocchi_xlsx(flusso):
+    cartella = load_workbook(flusso, read_only=True, data_only=True)
+    try:
+        righe = cartella.active.iter_rows(values_only=True)
+        intestazioni = next(righe, None) or ()
+        blocco, numeri = [], []
+        for numero, valori in enumerate(righe, start=2):
+            if all(v is None or str(v).strip() == '' for v in valori):
+                continue
+            blocco.append(valori)
+            numeri.append(numero)
+            if len(blocco) == IMPORT_BLOCCO:
+                yield pd.DataFrame(blocco, columns=intestazioni, index=numeri)
+                blocco, numeri = [], []
+        if blocco:
+            yield pd.DataFrame(blocco, columns=intestazioni, index=numeri)
+    finally:
+        cartella.close()
+
+
+def _blocchi_csv(flusso):
+    testo = io.TextIOWrapper(flusso, encoding='utf-8-sig', newline='')
+    inizio = 2
+    # sep=None: separatore riconosciuto dalla prima riga (virgola o punto e virgola)
+    for blocco in pd.read_csv(testo, sep=None, engine='python', dtype=str, keep_default_na=False,
+                              chunksize=IMPORT_BLOCCO):
+        blocco.index = range(inizio, inizio + len(blocco))
+        inizio += len(blocco)
+        yield blocco
+
+
+def blocchi_import(flusso, nome_file):
+    estensione = os.path.splitext(nome_file)[1].lower()
+    if estensione in ('.xlsx', '.xlsm'):
+        return _blocchi_xlsx(flusso)
+    if estensione in ('.csv', '.txt'):
+        return _blocchi_csv(flusso)
+    raise ErroreImport(f"Formato {estensione or 'sconosciuto'} non supportato: usare .xlsx o .csv")
+
+
+# Rinomina le colonne riconosciute e le converte in testo senza spazi.
+# Ritorna (dati, colonne presenti nel file).
+def _normalizza_blocco(blocco):
+    dati = pd.DataFrame(index=blocco.index)
+    for colonna in blocco.columns:
+        chiave = re.sub(r'[^a-z]', '', str(colonna).lower().replace('à', 'a'))
+        nome = COLONNE_IMPORT.get(chiave)
+        if nome and nome not in dati:
+            dati[nome] = blocco[colonna].fillna('').astype(str).str.strip()
+    presenti = set(dati.columns)
+    mancanti = [nome for nome in COLONNE_OBBLIGATORIE if nome not in presenti]
+    if mancanti:
+        raise ErroreImport("Colonne obbligatorie mancanti: " + ", ".join(mancanti))
+    for nome in set(COLONNE_IMPORT.values()) - presenti:
+        dati[nome] = ''
+    return dati, presenti
+
+
+# Validazione vettoriale di un blocco: ritorna i dati convertiti e la serie
+# degli errori (stringa vuota = riga valida, si riporta il primo errore)
+def valida_blocco(c, id_distinta, dati, codici_visti):
+    errori = pd.Series('', index=dati.index)
+
+    def segna(maschera, messaggio):
+        errori[maschera & (errori == '')] = messaggio
+
+    segna(dati['macrozona'] == '', "macrozona mancante")
+    segna(dati['nome'] == '', "nome mancante")
+
+    qty = pd.to_numeric(dati['qty'].str.replace(',', '.', regex=False), errors='coerce')
+    segna(qty.isna() | (qty < 0), "qty non valida")
+    costo = pd.to_numeric(dati['costo'].replace('', '0').str.replace(',', '.', regex=False), errors='coerce')
+    segna(costo.isna() | (costo < 0), "costo non valido")
+
+    tipo = dati['tipo'].str.capitalize().replace('', TIPI_COMPONENTE[0])
+    segna(~tipo.isin(TIPI_COMPONENTE), "tipo non valido (Acquisto o Produzione)")
+
+    # Stesso codice generato da aggiungi_componente quando il file non lo riporta
+    codice = dati['codice'].where(dati['codice'] != '',
+                                  dati['macrozona'].str[:3].str.upper() + '-' + dati['nome'].str[:5].str.upper())
+    segna(codice.duplicated() | codice.isin(codici_visti), "codice ripetuto nel file")
+    codici_visti.update(codice)
+
+    con_sotto = dati['sottodistinta'] != ''
+    segna(con_sotto & (tipo != 'Produzione'), "sottodistinta ammessa solo per i componenti di produzione")
+    id_sotto = pd.Series(np.nan, index=dati.index)
+    if con_sotto.any():
+        c.execute("SELECT codice, id FROM distinte WHERE codice IN (SELECT value FROM json_each(?))",
+                  (json.dumps(dati.loc[con_sotto, 'sottodistinta'].unique().tolist()),))
+        id_sotto = dati['sottodistinta'].map(dict(c.fetchall()))
+        segna(con_sotto & id_sotto.isna(), "sottodistinta inesistente")
+        for id_s in id_sotto.dropna().unique():
+            try:
+                verifica_sottodistinta(c, id_distinta, int(id_s))
+            except DistintaCiclica as e:
+                segna(id_sotto == id_s, str(e))
+
+    convertiti = dati.assign(codice=codice, qty=qty, costo=costo, tipo=tipo, id_sottodistinta=id_sotto)
+    return convertiti, errori
+
+
+# Importa i blocchi nella distinta; ritorna EsitoImport con gli errori [(riga, messaggio)]
+def importa_componenti(conn, id_distinta, blocchi, nota="Import"):
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, codice, macrozona, nome, materiale, spessore, lavorazioni, tipo,
+               COALESCE(qty, 0), COALESCE(costo, 0), id_sottodistinta
+        FROM componenti
+        WHERE id_distinta = ?
+    ''', (id_distinta,))
+    esistenti = pd.DataFrame(c.fetchall(), columns=['id', 'codice', *CAMPI_TESTO, 'qty', 'costo', 'id_sottodistinta'])
+    # Confronto senza spazi ai bordi, come i valori letti dal file
+    for col in ['codice', *CAMPI_TESTO]:
+        esistenti[col] = esistenti[col].fillna('').astype(str).str.strip()
+    esistenti[['qty', 'costo', 'id_sottodistinta']] = esistenti[['qty', 'costo', 'id_sottodistinta']].astype(float)
+    # Codici gia' duplicati nella distinta: non si sa quale riga aggiornare
+    ambigui = set(esistenti['codice'][esistenti['codice'].duplicated(keep=False)])
+    esistenti = esistenti.drop_duplicates('codice', keep=False).set_index('codice')
+
+    inseriti = aggiornati = invariati = scartati = 0
+    errori = []
+    codici_visti = set()
+    for blocco in blocchi:
+        dati, presenti = _normalizza_blocco(blocco)
+        dati, errori_blocco = valida_blocco(c, id_distinta, dati, codici_visti)
+        errori_blocco[dati['codice'].isin(ambigui) & (errori_blocco == '')] = \
+            "codice presente piu' volte nella distinta"
+
+        uniti = dati.join(esistenti, on='codice', rsuffix='_db')
+        nuovi = uniti['id'].isna()
+        # Le colonne assenti dal file mantengono il valore in archivio
+        assenti = [col for col in CAMPI_TESTO + ['costo'] if col not in presenti]
+        if 'sottodistinta' not in presenti:
+            assenti.append('id_sottodistinta')
+        for col in assenti:
+            uniti[col] = uniti[col].where(nuovi, uniti[col + '_db'])
+        cambiati = ~nuovi & (
+            (uniti[CAMPI_TESTO].values != uniti[[col + '_db' for col in CAMPI_TESTO]].values).any(axis=1)
+            | ~np.isclose(uniti['qty'], uniti['qty_db'])
+            | ~np.isclose(uniti['costo'], uniti['costo_db'])
+            | (uniti['id_sottodistinta'].fillna(-1) != uniti['id_sottodistinta_db'].fillna(-1)))
+
+        validi = errori_blocco == ''
+        valori = lambda righe: [
+            (*(getattr(r, col) for col in ['macrozona', 'nome', 'codice', 'materiale', 'spessore']),
+             float(r.qty), r.lavorazioni, float(r.costo), r.tipo,
+             None if pd.isna(r.id_sottodistinta) else int(r.id_sottodistinta))
+            for r in righe.itertuples()]
+        da_inserire = valori(uniti[validi & nuovi])
+        da_aggiornare = [riga + (int(id_c),) for riga, id_c in
+                         zip(valori(uniti[validi & cambiati]), uniti.loc[validi & cambiati, 'id'])]
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany('''
+                INSERT INTO componenti (
+                    macrozona, nome, codice, materiale, spessore, qty,
+                    lavorazioni, costo, tipo, id_sottodistinta, id_distinta
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [riga + (id_distinta,) for riga in da_inserire])
+            c.executemany('''
+                UPDATE componenti
+                SET macrozona=?, nome=?, codice=?, materiale=?, spessore=?,
+                    qty=?, lavorazioni=?, costo=?, tipo=?, id_sottodistinta=?
+                WHERE id=?
+            ''', da_aggiornare)
+            if da_inserire or da_aggiornare:
+                registra_revisione(conn, id_distinta, nota)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        inseriti += len(da_inserire)
+        aggiornati += len(da_aggiornare)
+        invariati += int((validi & ~nuovi & ~cambiati).sum())
+        scartati += int((~validi).sum())
+        if len(errori) < IMPORT_MAX_ERRORI:
+            errori.extend(errori_blocco[~validi].items())
+    return EsitoImport(inseriti, aggiornati, invariati, scartati, errori[:IMPORT_MAX_ERRORI])
+
+
+@app.route('/distinta/<int:id_distinta>/importa', methods=['GET', 'POST'])
+def importa_componenti_distinta(id_distinta):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM distinte WHERE id = ?", (id_distinta,))
+    distinta = c.fetchone()
+    if not distinta:
+        return "Distinta non trovata", 404
+
+    esito = None
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or not file.filename:
+            raise ErroreImport("Nessun file caricato")
+        inizio = time.perf_counter()
+        esito = importa_componenti(conn, id_distinta, blocchi_import(file.stream, file.filename),
+                                   nota=f"Import {file.filename}")
+        app.logger.info("Import %s nella distinta %d: %d inseriti, %d aggiornati, %d scartati in %.2fs",
+                        file.filename, id_distinta, esito.inseriti, esito.aggiornati, esito.scartati,
+                        time.perf_counter() - inizio)
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(esito._asdict() | {'errori': [{'riga': r, 'errore': e} for r, e in esito.errori]})
+
+    return render_template("importa_componenti.html", distinta=distinta, esito=esito)
+
+
+@app.cli.command('importa-componenti')
+@click.argument('codice_distinta')
+@click.argument('percorso', type=click.Path(exists=True, dir_okay=False))
+def comando_importa_componenti(codice_distinta, percorso):
+    """Importa o aggiorna i componenti di una distinta da un file .xlsx o .csv"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id FROM distinte WHERE codice = ?", (codice_distinta,))
+    distinta = c.fetchone()
+    if not distinta:
+        raise click.ClickException(f"Distinta {codice_distinta} inesistente")
+    try:
+        with open(percorso, 'rb') as flusso:
+            esito = importa_componenti(conn, distinta[0], blocchi_import(flusso, percorso),
+                                       nota=f"Import {os.path.basename(percorso)}")
+    except ErroreImport as e:
+        raise click.ClickException(str(e))
+    for riga, errore in esito.errori:
+        click.echo(f"Riga {riga}: {errore}", err=True)
+    click.echo(f"{esito.inseriti} inseriti, {esito.aggiornati} aggiornati, "
+               f"{esito.invariati} invariati, {esito.scartati} scartati")
+
+
+# Revisioni delle distinte
+#
+# Ogni scrittura sui componenti registra una revisione con i soli componenti
+# cambiati rispetto alla precedente (righe_revisione, valori JSON o NULL se il
+# componente e' stato rimosso). La prima revisione contiene tutti i componenti,
+# quindi lo stato di un componente a una revisione e' la sua ultima riga fino a
+# quella revisione. Ogni REVISIONI_SNAPSHOT revisioni si salva anche lo stato
+# completo: una revisione si ricostruisce dallo snapshot precedente applicando
+# al massimo REVISIONI_SNAPSHOT - 1 delta. Il confronto tra due revisioni legge
+# solo i componenti toccati tra le due.
+
+REVISIONI_SNAPSHOT = 10
+CAMPI_REVISIONE = ['macrozona', 'nome', 'codice', 'materiale', 'spessore', 'qty',
+                   'lavorazioni', 'costo', 'tipo', 'id_sottodistinta']
+_QTY, _COSTO = CAMPI_REVISIONE.index('qty'), CAMPI_REVISIONE.index('costo')
+
+Differenza = namedtuple('Differenza', [
+    'componenti',   # [(id_componente, 'aggiunto'|'rimosso'|'modificato', valori prima, valori dopo, campi cambiati)]
+    'macrozone',    # [(macrozona, delta qty, delta costo)]
+])
+
+
+# {id_componente: valori} della distinta alla revisione indicata
+def stato_revisione(c, id_distinta, numero):
+    c.execute('''
+        SELECT numero, snapshot FROM revisioni_distinta
+        WHERE id_distinta = ? AND numero <= ? AND snapshot IS NOT NULL
+        ORDER BY numero DESC
+        LIMIT 1
+    ''', (id_distinta, numero))
+    base = c.fetchone()
+    if base is None:
+        return {}
+    stato = {int(id_c): valori for id_c, valori in json.loads(base[1]).items()}
+    c.execute('''
+        SELECT rr.id_componente, rr.valori
+        FROM revisioni_distinta rv
+        JOIN righe_revisione rr ON rr.id_revisione = rv.id
+        WHERE rv.id_distinta = ? AND rv.numero > ? AND rv.numero <= ?
+        ORDER BY rv.numero
+    ''', (id_distinta, base[0], numero))
+    for id_c, valori in c.fetchall():
+        if valori is None:
+            stato.pop(id_c, None)
+        else:
+            stato[id_c] = json.loads(valori)
+    return stato
+
+
+# Registra una revisione se i componenti sono cambiati dall'ultima; ritorna il
+# numero della nuova revisione o None. Va chiamata dentro una transazione.
+def _salva_revisione(c, id_distinta, nota):
+    c.execute("SELECT COALESCE(MAX(numero), 0) FROM revisioni_distinta WHERE id_distinta = ?", (id_distinta,))
+    ultima = c.fetchone()[0]
+    precedente = stato_revisione(c, id_distinta, ultima) if ultima else {}
+    c.execute(f"SELECT id, {', '.join(CAMPI_REVISIONE)} FROM componenti WHERE id_distinta = ?", (id_distinta,))
+    # Passaggio da JSON per confrontare valori dello stesso tipo di quelli salvati
+    attuale = {riga[0]: json.loads(json.dumps(riga[1:])) for riga in c.fetchall()}
+
+    delta = [(id_c, json.dumps(valori)) for id_c, valori in attuale.items() if precedente.get(id_c) != valori]
+    delta += [(id_c, None) for id_c in precedente.keys() - attuale.keys()]
+    if not delta:
+        return None
+
+    numero = ultima + 1
+    snapshot = json.dumps(attuale) if (numero - 1) % REVISIONI_SNAPSHOT == 0 else None
+    c.execute('''
+        INSERT INTO revisioni_distinta (id_distinta, numero, data, nota, snapshot)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (id_distinta, numero, time.strftime('%Y-%m-%d %H:%M:%S'), nota, snapshot))
+    id_revisione = c.lastrowid
+    c.executemany("INSERT INTO righe_revisione (id_revisione, id_componente, valori) VALUES (?, ?, ?)",
+                  [(id_revisione, id_c, valori) for id_c, valori in delta])
+    return numero
+
+
+# Dentro una transazione gia' aperta (quella che ha scritto i componenti) la
+# revisione e' salvata in quella e il commit resta al chiamante
+def registra_revisione(conn, id_distinta, nota):
+    if conn.in_transaction:
+        return _salva_revisione(conn.cursor(), id_distinta, nota)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        numero = _salva_revisione(conn.cursor(), id_distinta, nota)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return numero
+
+
+# Valori dei componenti indicati alla revisione: per ognuno l'ultima riga fino a quella revisione
+def valori_alla_revisione(c, id_distinta, id_componenti, numero):
+    c.execute('''
+        SELECT rr.id_componente, rr.valori, MAX(rv.numero)
+        FROM righe_revisione rr
+        JOIN revisioni_distinta rv ON rv.id = rr.id_revisione
+        WHERE rr.id_componente IN (SELECT value FROM json_each(?))
+          AND rv.id_distinta = ? AND rv.numero <= ?
+        GROUP BY rr.id_componente
+    ''', (json.dumps(list(id_componenti)), id_distinta, numero))
+    return {id_c: json.loads(valori) for id_c, valori, _ in c.fetchall() if valori is not None}
+
+
+def confronta_revisioni(c, id_distinta, da, a):
+    c.execute('''
+        SELECT DISTINCT rr.id_componente
+        FROM revisioni_distinta rv
+        JOIN righe_revisione rr ON rr.id_revisione = rv.id
+        WHERE rv.id_distinta = ? AND rv.numero > ? AND rv.numero <= ?
+    ''', (id_distinta, min(da, a), max(da, a)))
+    toccati = [riga[0] for riga in c.fetchall()]
+    prima = valori_alla_revisione(c, id_distinta, toccati, da)
+    dopo = valori_alla_revisione(c, id_distinta, toccati, a)
+
+    componenti = []
+    macrozone = {}
+
+    def somma(valori, segno):
+        qty, costo = valori[_QTY] or 0, valori[_COSTO] or 0
+        zona = macrozone.setdefault(valori[0], [0, 0])
+        zona[0] += segno * qty
+        zona[1] += segno * qty * costo
+
+    for id_c in sorted(toccati):
+        vecchi, nuovi = prima.get(id_c), dopo.get(id_c)
+        if vecchi == nuovi:
+            continue
+        if vecchi is None:
+            stato, campi = 'aggiunto', []
+        elif nuovi is None:
+            stato, campi = 'rimosso', []
+        else:
+            stato = 'modificato'
+            campi = [campo for campo, v1, v2 in zip(CAMPI_REVISIONE, vecchi, nuovi) if v1 != v2]
+        if vecchi is not None:
+            somma(vecchi, -1)
+        if nuovi is not None:
+            somma(nuovi, 1)
+        componenti.append((id_c, stato, vecchi, nuovi, campi))
+
+    return Differenza(componenti, [(zona, qty, round(costo, 2)) for zona, (qty, costo) in macrozone.items()
+                                   if qty or round(costo, 2)])
+
+
+@app.route('/distinta/<int:id_distinta>/revisioni')
+def revisioni_distinta(id_distinta):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM distinte WHERE id = ?", (id_distinta,))
+    distinta = c.fetchone()
+    if not distinta:
+        return "Distinta non trovata", 404
+
+    c.execute('''
+        SELECT rv.numero, rv.data, rv.nota, rv.snapshot IS NOT NULL,
+               (SELECT COUNT(*) FROM righe_revisione rr WHERE rr.id_revisione = rv.id)
+        FROM revisioni_distinta rv
+        WHERE rv.id_distinta = ?
+        ORDER BY rv.numero DESC
+    ''', (id_distinta,))
+    revisioni = c.fetchall()
+
+    differenza = None
+    da = request.args.get('da', type=int)
+    a = request.args.get('a', type=int)
+    if da is not None and a is not None:
+        differenza = confronta_revisioni(c, id_distinta, da, a)
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(
+                da=da, a=a,
+                componenti=[{'id': id_c, 'stato': stato, 'campi': campi,
+                             'prima': dict(zip(CAMPI_REVISIONE, vecchi)) if vecchi else None,
+                             'dopo': dict(zip(CAMPI_REVISIONE, nuovi)) if nuovi else None}
+                            for id_c, stato, vecchi, nuovi, campi in differenza.componenti],
+                macrozone=[{'macrozona': zona, 'delta_qty': qty, 'delta_costo': costo}
+                           for zona, qty, costo in differenza.macrozone])
+
+    return render_template("revisioni_distinta.html", distinta=distinta, revisioni=revisioni,
+                           differenza=differenza, da=da, a=a, campi=CAMPI_REVISIONE)
+
+
+# Una revisione ricostruita, con il costo ai prezzi attuali dei componenti ancora esistenti
+@app.route('/distinta/<int:id_distinta>/revisione/<int:numero>')
+def revisione_distinta(id_distinta, numero):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT d.id, d.codice, d.descrizione, rv.numero, rv.data, rv.nota
+        FROM revisioni_distinta rv
+        JOIN distinte d ON d.id = rv.id_distinta
+        WHERE rv.id_distinta = ? AND rv.numero = ?
+    ''', (id_distinta, numero))
+    revisione = c.fetchone()
+    if not revisione:
+        return "Revisione non trovata", 404
+
+    stato = stato_revisione(c, id_distinta, numero)
+    c.execute("SELECT id, costo FROM componenti WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps(list(stato)),))
+    costi_attuali = dict(c.fetchall())
+    componenti = [(id_c, dict(zip(CAMPI_REVISIONE, valori)), costi_attuali.get(id_c))
+                  for id_c, valori in sorted(stato.items())]
+    costo_revisione = sum((v['qty'] or 0) * (v['costo'] or 0) for _, v, _ in componenti)
+    costo_oggi = sum((v['qty'] or 0) * (attuale if attuale is not None else v['costo'] or 0)
+                     for _, v, attuale in componenti)
+    return render_template("revisione_distinta.html", revisione=revisione, componenti=componenti,
+                           costo_revisione=round(costo_revisione, 2), costo_oggi=round(costo_oggi, 2))
+
+
+@app.route('/fornitori')
+def elenco_fornitori():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, nome, email, telefono, costo_ordine, ordine_minimo FROM fornitori")
+    fornitori = c.fetchall()
+    return render_template("fornitori.html", fornitori=fornitori, statistiche=statistiche_fornitori(c))
+
+# Nuovo Fornitore
+@app.route('/nuovo-fornitore', methods=['GET', 'POST'])
+def nuovo_fornitore():
+    if request.method == 'POST':
+        nome = request.form['nome'] 
+        indirizzo = request.form['indirizzo']
+        piva = request.form['piva']
+        email = request.form['email']
+        telefono = request.form['telefono']
+        iban = request.form['iban']
+        lavorazioni = request.form['lavorazioni']
+        try:
+            costo_ordine, ordine_minimo = leggi_condizioni_fornitore(request.form)
+        except ValueError as e:
+            return str(e), 400
+
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO fornitori (nome, indirizzo, piva, email, telefono, iban, lavorazioni, costo_ordine, ordine_minimo)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (nome, indirizzo, piva, email, telefono, iban, lavorazioni, costo_ordine, ordine_minimo))
+        conn.commit()
+        return redirect(url_for('elenco_fornitori'))
+
+    return render_template("nuovo_fornitore.html")
+
+
+# Costo fisso per ordine e ordine minimo dal form: vuoti valgono 0
+def leggi_condizioni_fornitore(form):
+    condizioni = []
+    for campo, descrizione in (('costo_ordine', "Costo per ordine"), ('ordine_minimo', "Ordine minimo")):
+        testo = (form.get(campo) or '').strip()
+        try:
+            valore = float(testo.replace(',', '.')) if testo else 0.0
+        except ValueError:
+            raise ValueError(f"{descrizione} non valido: {testo!r}")
+        if not math.isfinite(valore) or valore < 0:
+            raise ValueError(f"{descrizione} non valido: {testo!r}")
+        condizioni.append(valore)
+    return tuple(condizioni)
+
+
+# Condizioni d'ordine usate dalla scelta dei fornitori
+@app.route('/fornitore/<int:id_fornitore>/condizioni', methods=['POST'])
+def condizioni_fornitore(id_fornitore):
+    try:
+        costo_ordine, ordine_minimo = leggi_condizioni_fornitore(request.form)
+    except ValueError as e:
+        return str(e), 400
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("UPDATE fornitori SET costo_ordine = ?, ordine_minimo = ? WHERE id = ?",
+              (costo_ordine, ordine_minimo, id_fornitore))
+    if c.rowcount == 0:
+        return "Fornitore non trovato", 404
+    conn.commit()
+    return redirect(url_for('elenco_fornitori'))
+
+
+# Listini fornitori
+#
+# Un'offerta di un fornitore per un componente e' una versione di listino: le
+# righe con la stessa valido_dal, una per scaglione (qty_minima). Una versione
+# vale dalla sua data fino alla successiva. Il prezzo per (componente,
+# fornitore, qty, data) e' quello dello scaglione piu' alto non oltre qty
+# nell'ultima versione non successiva alla data (sotto il primo scaglione vale
+# il primo): con la chiave (id_componente, id_fornitore, valido_dal,
+# qty_minima) sono due discese nell'indice. prezzi_fornitori resta l'elenco
+# delle coppie componente-fornitore con il prezzo da 1 pezzo in vigore.
+
+LISTINO_DA_SEMPRE = '0001-01-01'  # versione iniziale, valida per qualunque data
+
+
+# "12,50" oppure "1: 12,50; 100: 11,80; 500: 11" -> [(qty_minima, prezzo)]
+def leggi_scaglioni(testo):
+    scaglioni = {}
+    for voce in re.split(r'[;\n]', testo or ''):
+        voce = voce.strip()
+        if not voce:
+            continue
+        qty, _, prezzo = voce.rpartition(':')
+        try:
+            qty = float(qty.replace(',', '.')) if qty.strip() else 1.0
+            prezzo = float(prezzo.replace(',', '.'))
+        except ValueError:
+            raise ValueError(f"Scaglione non valido: {voce!r} (atteso QTY: PREZZO)")
+        if qty <= 0 or prezzo < 0:
+            raise ValueError(f"Scaglione non valido: {voce!r}")
+        scaglioni[qty] = prezzo
+    if not scaglioni:
+        raise ValueError("Nessun prezzo indicato")
+    return sorted(scaglioni.items())
+
+
+# Scrive (o sostituisce) la versione di listino valida da `valido_dal` e
+# aggiorna il prezzo da 1 pezzo in vigore in prezzi_fornitori
+def registra_listino(c, id_componente, id_fornitore, scaglioni, valido_dal):
+    c.execute("DELETE FROM listini_fornitori WHERE id_componente = ? AND id_fornitore = ? AND valido_dal = ?",
+              (id_componente, id_fornitore, valido_dal))
+    c.executemany('''
+        INSERT INTO listini_fornitori (id_componente, id_fornitore, valido_dal, qty_minima, prezzo)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(id_componente, id_fornitore, valido_dal, qty, prezzo) for qty, prezzo in scaglioni])
+    prezzo, = prezzi_effettivi(c, [(id_componente, id_fornitore, 1)], datetime.now().strftime('%Y-%m-%d'))
+    c.execute('''
+        INSERT INTO prezzi_fornitori (id_componente, id_fornitore, prezzo)
+        VALUES (?, ?, ?)
+        ON CONFLICT (id_componente, id_fornitore) DO UPDATE SET prezzo = COALESCE(excluded.prezzo, prezzo)
+    ''', (id_componente, id_fornitore, prezzo))
+
+
+# Scaglioni [(qty_minima, prezzo)] della versione in vigore alla data ([] se non ce n'e')
+def scaglioni_in_vigore(c, id_componente, id_fornitore, data):
+    c.execute('''
+        SELECT qty_minima, prezzo
+        FROM listini_fornitori
+        WHERE id_componente = :id_componente AND id_fornitore = :id_fornitore
+          AND valido_dal = (SELECT MAX(valido_dal) FROM listini_fornitori
+                            WHERE id_componente = :id_componente AND id_fornitore = :id_fornitore
+                              AND valido_dal <= :data)
+        ORDER BY qty_minima
+    ''', {'id_componente': id_componente, 'id_fornitore': id_fornitore, 'data': data})
+    return c.fetchall()
 
-UPLOAD_FOLDER = os.path.join('static', 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-app = Flask(__name__)
-DB_NAME = "database.db"
+# Prezzo concordato per qty pezzi: nuova versione da `data` uguale a quella in
+# vigore, con il prezzo nuovo solo nello scaglione che vale per qty
+def concorda_prezzo(c, id_componente, id_fornitore, qty, prezzo, data):
+    scaglioni = dict(scaglioni_in_vigore(c, id_componente, id_fornitore, data))
+    scaglione = max((q for q in scaglioni if q <= qty), default=min(scaglioni, default=1.0))
+    scaglioni[scaglione] = prezzo
+    registra_listino(c, id_componente, id_fornitore, sorted(scaglioni.items()), data)
 
-# Inizializza il database alla prima esecuzione
-def init_db():
-    if not os.path.exists(DB_NAME):
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
 
-        # Tabella Distinte
-        c.execute('''
-            CREATE TABLE distinte (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codice TEXT NOT NULL,
-                descrizione TEXT
-            )
-        ''')
-
-        # Tabella Componenti
-        c.execute('''
-            CREATE TABLE componenti (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_distinta INTEGER,
-                macrozona TEXT,
-                nome TEXT,
-                codice TEXT,
-                materiale TEXT,
-                spessore TEXT,
-                qty REAL,
-                lavorazioni TEXT,
-                costo REAL,
-                tipo TEXT,
-                FOREIGN KEY (id_distinta) REFERENCES distinte(id)
-            )
-        ''')
-
-        # Tabella Fornitori
-        c.execute('''
-            CREATE TABLE fornitori (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL,
-                email TEXT,
-                telefono TEXT
-            )
-        ''')
-
-        # Tabella Prezzi Fornitori
-        c.execute('''
-            CREATE TABLE prezzi_fornitori (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_componente INTEGER,
-                id_fornitore INTEGER,
-                prezzo REAL,
-                FOREIGN KEY (id_componente) REFERENCES componenti(id),
-                FOREIGN KEY (id_fornitore) REFERENCES fornitori(id)
-            )
-        ''')
-        # Aggiungi queste righe alla funzione init_db() se non esistono già
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS magazzino (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_componente INTEGER NOT NULL,
-                giacenza REAL NOT NULL DEFAULT 0,
-                FOREIGN KEY (id_componente) REFERENCES componenti(id)
-            )
-        ''')
+# righe: [(id_componente, id_fornitore, qty)] -> [prezzo o None], nello stesso ordine
+def prezzi_effettivi(c, righe, data):
+    c.execute('''
+        WITH richieste AS (
+            SELECT key AS n, json_extract(value, '$[0]') AS id_componente,
+                   json_extract(value, '$[1]') AS id_fornitore, json_extract(value, '$[2]') AS qty
+            FROM json_each(:righe)
+        ), versioni AS (
+            SELECT r.*, (
+                SELECT v.valido_dal
+                FROM listini_fornitori v
+                WHERE v.id_componente = r.id_componente AND v.id_fornitore = r.id_fornitore
+                  AND v.valido_dal <= :data
+                ORDER BY v.valido_dal DESC
+                LIMIT 1
+            ) AS valido_dal
+            FROM richieste r
+        )
+        SELECT x.n, COALESCE((
+            SELECT l.prezzo
+            FROM listini_fornitori l
+            WHERE l.id_componente = x.id_componente AND l.id_fornitore = x.id_fornitore
+              AND l.valido_dal = x.valido_dal AND l.qty_minima <= x.qty
+            ORDER BY l.qty_minima DESC
+            LIMIT 1
+        ), (
+            SELECT l.prezzo
+            FROM listini_fornitori l
+            WHERE l.id_componente = x.id_componente AND l.id_fornitore = x.id_fornitore
+              AND l.valido_dal = x.valido_dal
+            ORDER BY l.qty_minima
+            LIMIT 1
+        ))
+        FROM versioni x
+    ''', {'righe': json.dumps([[id_comp, id_f, qty] for id_comp, id_f, qty in righe]), 'data': data})
+    prezzi = [None] * len(righe)
+    for n, prezzo in c.fetchall():
+        prezzi[n] = prezzo
+    return prezzi
 
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS produzioni (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_distinta INTEGER NOT NULL,
-                qty_prodotta INTEGER NOT NULL,
-                data_produzione TEXT NOT NULL,
-                numero_produzione TEXT,
-                FOREIGN KEY (id_distinta) REFERENCES distinte(id)
-            )
-        ''')
-        
-        # Testata ordini
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS ordini_fornitore (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                numero_ordine TEXT NOT NULL,
-                id_fornitore INTEGER NOT NULL,
-                data_ordine TEXT NOT NULL,
-                riferimento_oc TEXT,
-                FOREIGN KEY (id_fornitore) REFERENCES fornitori(id)
-            )
-        ''')
-
-        # Righe ordini
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS righe_ordine_fornitore (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_ordine INTEGER NOT NULL,
-                id_componente INTEGER NOT NULL,
-                qty INTEGER NOT NULL,
-                data_richiesta TEXT NOT NULL,
-                data_confermata TEXT,
-                data_consegna TEXT,
-                FOREIGN KEY (id_ordine) REFERENCES ordini_fornitore(id),
-                FOREIGN KEY (id_componente) REFERENCES componenti(id)
-            )
-        ''')
-        
-        # Tabella Clienti
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS clienti (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codice TEXT UNIQUE,  -- verrà generato automaticamente
-                ragione_sociale TEXT NOT NULL,
-                indirizzo TEXT,
-                email TEXT,
-                telefono TEXT,
-                iban TEXT,
-                persona_riferimento TEXT,
-                note TEXT
-            )
-        ''')
 
-        conn.commit()
-        conn.close()
-        
-@app.route('/')
-def dashboard():
-    return render_template("dashboard.html")
+# quantita: {id_componente: qty} -> [(id_componente, id_fornitore, prezzo)] per
+# ogni fornitore del componente, al prezzo dello scaglione di quella quantita'
+def prezzi_listino(c, quantita, data):
+    c.execute('''
+        SELECT pf.id_componente, pf.id_fornitore, pf.prezzo
+        FROM prezzi_fornitori pf
+        WHERE pf.id_componente IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(quantita)),))
+    coppie = c.fetchall()
+    prezzi = prezzi_effettivi(c, [(id_comp, id_f, quantita[id_comp]) for id_comp, id_f, _ in coppie], data)
+    return [(id_comp, id_f, prezzo if prezzo is not None else base)
+            for (id_comp, id_f, base), prezzo in zip(coppie, prezzi)
+            if (prezzo if prezzo is not None else base) is not None]
 
 
-@app.route('/distinte')
-def distinte():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# Ricerca componenti
+#
+# L'indice FTS5 cerca_componenti copre nome, codice, materiale, lavorazioni e
+# macrozona; ogni parola cercata vale come prefisso. Una parola che non e'
+# prefisso di nessun termine dell'indice viene sostituita dai termini del
+# vocabolario piu' vicini (distanza di modifica 1, 2 oltre i 7 caratteri),
+# scelti tra quelli di lunghezza simile che hanno abbastanza coppie di lettere
+# in comune. Le faccette contano i risultati per materiale, spessore e tipo.
+#
+# I codici sono divisi al trattino (COP-MANIG -> cop, manig), cosi' la parte
+# numerica di codici come DB-000123 finisce tra i numeri, che nel vocabolario
+# vengono prima delle lettere: le correzioni si cercano solo tra le parole
+# senza cifre, lette una volta e tenute in memoria finche' il database non
+# cambia. L'autocompletamento ordina per pertinenza solo se i risultati sono
+# pochi: bm25 su decine di migliaia di righe costa troppo, e per un prefisso
+# cosi' generico l'ordine conta poco.
 
-    # Recupera distinte
-    c.execute("SELECT * FROM distinte")
-    distinte_raw = c.fetchall()
+COLONNE_RICERCA = ['nome', 'codice', 'materiale', 'lavorazioni', 'macrozona']
+PESI_RICERCA = [5.0, 10.0, 1.0, 1.0, 1.0]  # bm25 per colonna: codice e nome pesano di piu'
+FACCETTE_RICERCA = ['materiale', 'spessore', 'tipo']
+RICERCA_PER_PAGINA = 50
+AUTOCOMPLETAMENTO_MAX = 20
+CORREZIONI_MAX = 5  # termini simili cercati al posto di una parola senza corrispondenze
+AUTOCOMPLETAMENTO_CANDIDATI = 2000  # oltre questi risultati l'autocompletamento non ordina per bm25
 
-    distinte = []
-    for d in distinte_raw:
-        id_distinta = d[0]
-        codice = d[1]
-        descrizione = d[2]
+RisultatoRicerca = namedtuple('RisultatoRicerca', [
+    'righe',       # [ComponenteTrovato] per pertinenza
+    'totale',      # risultati con i filtri applicati
+    'faccette',    # {campo: [(valore, n)]}, vuoto se non richieste
+    'correzioni',  # {parola: [termini usati al suo posto]}
+])
+ComponenteTrovato = namedtuple('ComponenteTrovato', [
+    'id', 'codice', 'nome', 'materiale', 'spessore', 'tipo', 'id_distinta', 'codice_distinta',
+])
 
-        # Calcola costo totale
-        c.execute("SELECT SUM(qty * costo) FROM componenti WHERE id_distinta = ?", (id_distinta,))
-        totale = c.fetchone()[0]
-        if totale is None:
-            totale = 0.0
 
-        # Conta i componenti
-        c.execute("SELECT COUNT(*) FROM componenti WHERE id_distinta = ?", (id_distinta,))
-        n_componenti = c.fetchone()[0]
+# Parole come le spezza il tokenizer dell'indice: minuscole, senza accenti
+def parole_ricerca(testo):
+    testo = unicodedata.normalize('NFKD', (testo or '').lower())
+    testo = ''.join(ch for ch in testo if not unicodedata.combining(ch))
+    return re.findall(r"[\w./]+", testo)
 
-        distinte.append((id_distinta, codice, descrizione, round(totale, 2), n_componenti))
 
-    conn.close()
-    return render_template("lista_distinte.html", distinte=distinte)
+# Distanza di Damerau-Levenshtein ristretta; oltre `massimo` ritorna massimo + 1
+def _distanza_modifica(a, b, massimo):
+    if abs(len(a) - len(b)) > massimo:
+        return massimo + 1
+    precedente2, precedente = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        corrente = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            corrente[j] = min(precedente[j] + 1, corrente[j - 1] + 1, precedente[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                corrente[j] = min(corrente[j], precedente2[j - 2] + 1)
+        if min(corrente) > massimo:
+            return massimo + 1
+        precedente2, precedente = precedente, corrente
+    return precedente[-1]
 
 
-@app.route('/nuova-distinta', methods=['GET', 'POST'])
-def nuova_distinta():
-    if request.method == 'POST':
-        codice = request.form['codice']
-        descrizione = request.form['descrizione']
+_parole_correzione = {}  # {DB_NAME: {lunghezza: [(termine, n_doc, coppie)]}}
+_parole_lock = threading.Lock()
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute("INSERT INTO distinte (codice, descrizione) VALUES (?, ?)", (codice, descrizione))
-        conn.commit()
-        conn.close()
-        return redirect(url_for('home'))
 
-    return render_template("nuova_distinta.html")
+# Parole del vocabolario senza cifre, per lunghezza, con le loro coppie di lettere.
+# Ogni connessione ricorda (PRAGMA data_version, total_changes) dell'ultima volta
+# che ha letto o convalidato le parole in memoria: data_version cambia quando
+# un'altra connessione, anche di un altro processo, conferma una transazione,
+# total_changes conta le scritture della connessione stessa. Se nessuno dei due
+# e' cambiato il database e' quello di allora e le parole in memoria, lette
+# dopo, valgono ancora; altrimenti si rileggono. Chi ha scritture non
+# confermate le rilegge solo per se'.
+def _parole_per_lunghezza(c):
+    conn = c.connection
+    c.execute("PRAGMA data_version")
+    versione = (DB_NAME, c.fetchone()[0], conn.total_changes)
+    with _parole_lock:
+        salvate = _parole_correzione.get(DB_NAME)
+        if salvate is not None and getattr(conn, 'versione_parole', None) == versione:
+            return salvate
+        parole = {}
+        c.execute("SELECT term, doc FROM cerca_componenti_termini WHERE term >= 'a'")
+        for termine, n_doc in c.fetchall():
+            if len(termine) >= 3 and not any(ch.isdigit() for ch in termine):
+                coppie = {termine[i:i + 2] for i in range(len(termine) - 1)}
+                parole.setdefault(len(termine), []).append((termine, n_doc, coppie))
+        if not conn.in_transaction and isinstance(conn, ConnessioneStrumentata):
+            _parole_correzione[DB_NAME] = parole
+            conn.versione_parole = versione
+        return parole
 
 
-@app.route('/distinta/<int:id_distinta>')
-def dettaglio_distinta(id_distinta):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# Termini del vocabolario vicini a `parola`, dal piu' vicino e piu' frequente
+def termini_simili(c, parola):
+    massimo = 1 if len(parola) <= 7 else 2
+    coppie = {parola[i:i + 2] for i in range(len(parola) - 1)}
+    # Ogni modifica cambia al piu' tre coppie (lo scambio di due lettere vicine)
+    soglia = len(coppie) - 3 * massimo
+    parole = _parole_per_lunghezza(c)
+    vicini = []
+    for lunghezza in range(len(parola) - massimo, len(parola) + massimo + 1):
+        for termine, n_doc, coppie_termine in parole.get(lunghezza, ()):
+            if len(coppie & coppie_termine) < soglia:
+                continue
+            distanza = _distanza_modifica(parola, termine, massimo)
+            if distanza <= massimo:
+                vicini.append((distanza, -n_doc, termine))
+    return [termine for _, _, termine in sorted(vicini)[:CORREZIONI_MAX]]
 
-    # Recupera info distinta
-    c.execute("SELECT * FROM distinte WHERE id = ?", (id_distinta,))
-    distinta = c.fetchone()
 
-    # Recupera componenti
-    c.execute("SELECT * FROM componenti WHERE id_distinta = ?", (id_distinta,))
-    componenti = c.fetchall()
+# Espressione MATCH per il testo cercato: (espressione o None, {parola: correzioni})
+def espressione_ricerca(c, testo):
+    parti = []
+    correzioni = {}
+    for parola in parole_ricerca(testo):
+        c.execute("SELECT 1 FROM cerca_componenti_termini WHERE term >= ? AND term < ? LIMIT 1",
+                  (parola, parola + '\U0010ffff'))
+        simili = termini_simili(c, parola) if c.fetchone() is None and len(parola) >= 3 else []
+        if simili:
+            correzioni[parola] = simili
+            parti.append('(' + ' OR '.join(f'"{termine}"' for termine in simili) + ')')
+        else:
+            parti.append(f'"{parola}"*')
+    return (' '.join(parti) or None), correzioni
 
-    # Calcola costi per macrozona
-    c.execute('''
-        SELECT macrozona, SUM(costo * qty)
-        FROM componenti
-        WHERE id_distinta = ?
-        GROUP BY macrozona
-    ''', (id_distinta,))
-    costi_macrozona = c.fetchall()
 
-    # Calcola costo totale
-    c.execute("SELECT SUM(costo * qty) FROM componenti WHERE id_distinta = ?", (id_distinta,))
-    costo_totale = c.fetchone()[0] or 0
+# filtri: {campo di FACCETTE_RICERCA: valore}; con `candidati` i risultati sono
+# ordinati per bm25 solo se non sono piu' di tanti, altrimenti per id
+def cerca_componenti(c, testo, filtri=None, limite=RICERCA_PER_PAGINA, offset=0, faccette=True, candidati=None):
+    espressione, correzioni = espressione_ricerca(c, testo)
+    if espressione is None:
+        return RisultatoRicerca([], 0, {}, {})
+    filtri = {campo: valore for campo, valore in (filtri or {}).items() if campo in FACCETTE_RICERCA and valore}
+    condizioni = ''.join(f" AND c.{campo} = :{campo}" for campo in filtri)
+    parametri = {'espressione': espressione, **filtri}
+    ordine = f"bm25(cerca_componenti, {', '.join(map(str, PESI_RICERCA))}), c.id"
+    if candidati is not None:
+        c.execute("SELECT 1 FROM cerca_componenti WHERE cerca_componenti MATCH ? LIMIT 1 OFFSET ?",
+                  (espressione, candidati))
+        if c.fetchone() is not None:
+            ordine = "cerca_componenti.rowid"
 
-    # Calcola incidenza %
-    riassunto = []
-    for macrozona, costo in costi_macrozona:
-        incidenza = round((costo / costo_totale) * 100, 1) if costo_totale else 0
-        riassunto.append((macrozona, round(costo, 2), incidenza))
+    c.execute(f'''
+        SELECT c.id, c.codice, c.nome, c.materiale, c.spessore, c.tipo, c.id_distinta, d.codice
+        FROM cerca_componenti
+        JOIN componenti c ON c.id = cerca_componenti.rowid
+        LEFT JOIN distinte d ON d.id = c.id_distinta
+        WHERE cerca_componenti MATCH :espressione{condizioni}
+        ORDER BY {ordine}
+        LIMIT :limite OFFSET :offset
+    ''', {**parametri, 'limite': limite, 'offset': offset})
+    righe = [ComponenteTrovato(*riga) for riga in c.fetchall()]
+    if not faccette:
+        return RisultatoRicerca(righe, None, {}, correzioni)
 
-    conn.close()
-    return render_template(
-        "dettaglio_distinta.html",
-        distinta=distinta,
-        componenti=componenti,
-        riassunto=riassunto,
-        costo_totale=round(costo_totale, 2)
-    )
+    # Una sola lettura dei risultati per tutte le faccette
+    c.execute(f'''
+        WITH trovati AS MATERIALIZED (
+            SELECT {', '.join(f"c.{campo}" for campo in FACCETTE_RICERCA)}
+            FROM cerca_componenti
+            JOIN componenti c ON c.id = cerca_componenti.rowid
+            WHERE cerca_componenti MATCH :espressione{condizioni}
+        )
+        {' UNION ALL '.join(f"SELECT '{campo}', {campo}, COUNT(*) FROM trovati GROUP BY {campo}"
+                            for campo in FACCETTE_RICERCA)}
+    ''', parametri)
+    conteggi = {campo: [] for campo in FACCETTE_RICERCA}
+    for campo, valore, n in c.fetchall():
+        conteggi[campo].append((valore, n))
+    for campo in conteggi:
+        conteggi[campo].sort(key=lambda voce: (-voce[1], str(voce[0])))
+    totale = sum(n for _, n in conteggi[FACCETTE_RICERCA[0]])
+    return RisultatoRicerca(righe, totale, conteggi, correzioni)
 
-@app.route('/distinta/<int:id_distinta>/export_excel')
-def export_distinta_excel(id_distinta):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
 
-    c.execute("SELECT * FROM componenti WHERE id_distinta = ?", (id_distinta,))
-    componenti = c.fetchall()
-    conn.close()
+@app.route('/componenti/cerca')
+def ricerca_componenti():
+    c = get_db().cursor()
+    testo = request.args.get('q', '').strip()
+    filtri = {campo: request.args.get(campo) for campo in FACCETTE_RICERCA if request.args.get(campo)}
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    risultato = cerca_componenti(c, testo, filtri, RICERCA_PER_PAGINA, (pagina - 1) * RICERCA_PER_PAGINA)
+    return render_template("ricerca_componenti.html", testo=testo, filtri=filtri, risultato=risultato,
+                           pagina=pagina, per_pagina=RICERCA_PER_PAGINA)
 
-    colonne = ['ID', 'ID Distinta', 'Macrozona', 'Nome', 'Codice', 'Materiale', 'Spessore', 'QTY', 'Lavorazioni', 'Costo', 'Tipo', 'File']
-    df = pd.DataFrame(componenti, columns=colonne)
 
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Componenti')
-    output.seek(0)
+# Autocompletamento per i campi componente dei form: solo i primi risultati, senza faccette
+@app.route('/api/componenti/cerca')
+def api_cerca_componenti():
+    inizio = time.perf_counter()
+    c = get_db().cursor()
+    filtri = {campo: request.args.get(campo) for campo in FACCETTE_RICERCA if request.args.get(campo)}
+    limite = min(max(request.args.get('limite', 10, type=int), 1), AUTOCOMPLETAMENTO_MAX)
+    risultato = cerca_componenti(c, request.args.get('q', ''), filtri, limite, faccette=False,
+                                 candidati=AUTOCOMPLETAMENTO_CANDIDATI)
+    tempi = [('ricerca', time.perf_counter() - inizio)]
+    risposta = jsonify(risultati=[r._asdict() for r in risultato.righe], correzioni=risultato.correzioni)
+    risposta.headers['Server-Timing'] = server_timing(tempi)
+    return risposta
 
-    return send_file(output, download_name=f"distinta_{id_distinta}.xlsx", as_attachment=True)
 
-@app.route('/distinta/<int:id_distinta>/export_pdf')
-def export_distinta_pdf(id_distinta):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# Dove usato
+#
+# Le distinte che usano un codice, un materiale (con o senza spessore) o i
+# componenti a listino di un fornitore. Gli impieghi diretti si leggono dagli
+# indici inversi su componenti e prezzi_fornitori; le distinte che li usano
+# tramite sottodistinte, a qualunque livello, dalla chiusura legami_distinte,
+# tenuta aggiornata dai trigger a ogni scrittura dei componenti. La quantita'
+# di un impiego indiretto e' quella diretta per il moltiplicatore del legame.
+#
+# La stessa lettura calcola l'impatto di una modifica di prezzo: un nuovo
+# prezzo unitario per un codice, o una variazione percentuale del costo dei
+# componenti trovati. Cambia solo il costo delle righe foglia: le righe con
+# sottodistinta valgono il costo esploso della sottodistinta.
 
-    c.execute("SELECT * FROM componenti WHERE id_distinta = ?", (id_distinta,))
-    componenti = c.fetchall()
-    conn.close()
+Impiego = namedtuple('Impiego', [
+    'id_distinta', 'codice', 'descrizione',
+    'righe',       # righe della distinta trovate direttamente (0 se solo tramite sottodistinte)
+    'qty',         # pezzi trovati in un pezzo della distinta, sottodistinte comprese
+    'variazione',  # variazione del costo di un pezzo per la modifica di prezzo (0 senza modifica)
+])
 
-    html = render_template_string("""
-        <h2>Distinta {{ id }}</h2>
-        <table border="1" cellspacing="0" cellpadding="4">
-            <thead>
-                <tr>
-                    <th>Macrozona</th>
-                    <th>Nome</th>
-                    <th>Materiale</th>
-                    <th>Spessore</th>
-                    <th>QTY</th>
-                    <th>Lavorazioni</th>
-                    <th>Costo</th>
-                </tr>
-            </thead>
-            <tbody>
-                {% for c in componenti %}
-                <tr>
-                    <td>{{ c[2] }}</td>
-                    <td>{{ c[3] }}</td>
-                    <td>{{ c[5] }}</td>
-                    <td>{{ c[6] }}</td>
-                    <td>{{ c[7] }}</td>
-                    <td>{{ c[8] }}</td>
-                    <td>{{ '%.2f'|format(c[9]) }}</td>
-                </tr>
-                {% endfor %}
-            </tbody>
-        </table>
-    """, id=id_distinta, componenti=componenti)
 
-    pdf = io.BytesIO()
-    pisa.CreatePDF(io.StringIO(html), dest=pdf)
-    pdf.seek(0)
+# (SELECT delle righe trovate, parametri, descrizione) dai parametri della richiesta
+def righe_dove_usato(args):
+    codice = (args.get('codice') or '').strip()
+    materiale = (args.get('materiale') or '').strip()
+    spessore = (args.get('spessore') or '').strip()
+    fornitore = (args.get('fornitore') or '').strip()
+    colonne = "c.id_distinta, c.qty, c.costo, c.id_sottodistinta"
+    if codice:
+        return (f"SELECT {colonne} FROM componenti c WHERE upper(trim(c.codice)) = upper(:codice)",
+                {'codice': codice}, f"codice {codice}")
+    if materiale:
+        if spessore:
+            return (f"SELECT {colonne} FROM componenti c WHERE c.materiale = :materiale AND c.spessore = :spessore",
+                    {'materiale': materiale, 'spessore': spessore}, f"materiale {materiale} {spessore}")
+        return (f"SELECT {colonne} FROM componenti c WHERE c.materiale = :materiale",
+                {'materiale': materiale}, f"materiale {materiale}")
+    if fornitore:
+        if not fornitore.isdigit():
+            raise ValueError("Fornitore non valido")
+        return (f"SELECT {colonne} FROM prezzi_fornitori pf JOIN componenti c ON c.id = pf.id_componente "
+                "WHERE pf.id_fornitore = :fornitore",
+                {'fornitore': int(fornitore)}, f"fornitore {fornitore}")
+    raise ValueError("Indicare un codice, un materiale o un fornitore")
 
-    return send_file(pdf, download_name=f"distinta_{id_distinta}.pdf", as_attachment=True)
-    
 
-@app.route('/distinta/<int:id_distinta>/aggiungi-componente', methods=['GET', 'POST'])
-def aggiungi_componente(id_distinta):
-    if request.method == 'POST':
-        macrozona = request.form['macrozona']
-        nome = request.form['nome']
-        materiale = request.form['materiale']
-        spessore = request.form['spessore']
-        qty = request.form['qty']
-        lavorazioni = request.form['lavorazioni']
-        costo = request.form['costo']
-        tipo = request.form['tipo']
-        codice = f"{macrozona[:3].upper()}-{nome[:5].upper()}"
+# (prezzo, variazione %) dai parametri; il nuovo prezzo ha senso solo per un codice
+def leggi_modifica_prezzo(args):
+    try:
+        prezzo = float(args['prezzo']) if (args.get('prezzo') or '').strip() else None
+        variazione = float(args['variazione']) if (args.get('variazione') or '').strip() else None
+    except ValueError:
+        raise ValueError("Prezzo o variazione non validi")
+    if prezzo is not None and not (args.get('codice') or '').strip():
+        raise ValueError("Il nuovo prezzo vale per un codice: per materiale e fornitore indicare la variazione %")
+    return prezzo, variazione
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO componenti (
-                id_distinta, macrozona, nome, codice, materiale,
-                spessore, qty, lavorazioni, costo, tipo
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (id_distinta, macrozona, nome, codice, materiale, spessore, qty, lavorazioni, costo, tipo))
-        conn.commit()
-        conn.close()
-        return redirect(url_for('dettaglio_distinta', id_distinta=id_distinta))
 
-    return render_template("aggiungi_componente.html", id_distinta=id_distinta)
+# [Impiego] per le righe di `righe_sql`, con la variazione di costo di un pezzo
+# di ogni distinta se e' indicato un nuovo prezzo o una variazione %
+def dove_usato(c, righe_sql, parametri, prezzo=None, variazione=None):
+    if prezzo is not None:
+        delta = ":prezzo - COALESCE(costo, 0)"
+    elif variazione is not None:
+        delta = "COALESCE(costo, 0) * :variazione / 100.0"
+    else:
+        delta = "0"
+    c.execute(f'''
+        WITH righe AS ({righe_sql}),
+        dirette AS (
+            SELECT id_distinta, COUNT(*) AS righe, TOTAL(COALESCE(qty, 0)) AS qty,
+                   TOTAL(CASE WHEN id_sottodistinta IS NULL THEN COALESCE(qty, 0) * ({delta}) END) AS variazione
+            FROM righe
+            GROUP BY id_distinta
+        ),
+        impieghi AS (
+            SELECT id_distinta, righe, qty, variazione FROM dirette
+            UNION ALL
+            SELECT l.id_antenato, 0, l.moltiplicatore * d.qty, l.moltiplicatore * d.variazione
+            FROM dirette d
+            JOIN legami_distinte l ON l.id_discendente = d.id_distinta
+        )
+        SELECT i.id_distinta, d.codice, d.descrizione, SUM(i.righe), SUM(i.qty), SUM(i.variazione)
+        FROM impieghi i
+        JOIN distinte d ON d.id = i.id_distinta
+        GROUP BY i.id_distinta
+        ORDER BY d.codice, i.id_distinta
+    ''', {**parametri, 'prezzo': prezzo, 'variazione': variazione})
+    return [Impiego(*riga) for riga in c.fetchall()]
 
-@app.route('/fornitori')
-def elenco_fornitori():
-    conn = sqlite3.connect(DB_NAME)
+
+@app.route('/dove-usato')
+def pagina_dove_usato():
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM fornitori")
+    c.execute("SELECT id, nome FROM fornitori ORDER BY nome")
     fornitori = c.fetchall()
-    conn.close()
-    return render_template("fornitori.html", fornitori=fornitori)
+    impieghi, descrizione, errore, costi = None, None, None, {}
+    prezzo = variazione = None
+    if any(request.args.get(campo) for campo in ('codice', 'materiale', 'fornitore')):
+        try:
+            righe_sql, parametri, descrizione = righe_dove_usato(request.args)
+            prezzo, variazione = leggi_modifica_prezzo(request.args)
+        except ValueError as e:
+            errore = str(e)
+        else:
+            impieghi = dove_usato(c, righe_sql, parametri, prezzo, variazione)
+            if prezzo is not None or variazione is not None:
+                costi = {id_d: r.costo_totale for id_d, r in
+                         riepiloghi_costi(conn, [i.id_distinta for i in impieghi]).items()}
+                impieghi.sort(key=lambda i: -abs(i.variazione))
+    return render_template("dove_usato.html", fornitori=fornitori, impieghi=impieghi, descrizione=descrizione,
+                           errore=errore, costi=costi, impatto=prezzo is not None or variazione is not None,
+                           parametri=request.args)
 
-# Nuovo Fornitore
-@app.route('/nuovo-fornitore', methods=['GET', 'POST'])
-def nuovo_fornitore():
-    if request.method == 'POST':
-        nome = request.form['nome'] 
-        indirizzo = request.form['indirizzo']
-        piva = request.form['piva']
-        email = request.form['email']
-        telefono = request.form['telefono']
-        iban = request.form['iban']
-        lavorazioni = request.form['lavorazioni']
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO fornitori (nome, indirizzo, piva, email, telefono, iban, lavorazioni)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (nome, indirizzo, piva, email, telefono, iban, lavorazioni))
-        conn.commit()
-        conn.close()
-        return redirect(url_for('elenco_fornitori'))
+@app.route('/api/dove-usato')
+def api_dove_usato():
+    try:
+        righe_sql, parametri, descrizione = righe_dove_usato(request.args)
+    except ValueError as e:
+        return jsonify(errore=str(e)), 400
+    impieghi = dove_usato(get_db().cursor(), righe_sql, parametri)
+    return jsonify(ricerca=descrizione, distinte=[{
+        'id': i.id_distinta,
+        'codice': i.codice,
+        'descrizione': i.descrizione,
+        'diretta': i.righe > 0,
+        'righe': i.righe,
+        'qty': i.qty,
+    } for i in impieghi])
 
-    return render_template("nuovo_fornitore.html")
+
+# Impatto di una modifica di prezzo su ogni distinta coinvolta, dalla piu' colpita
+@app.route('/api/impatto-prezzo')
+def api_impatto_prezzo():
+    try:
+        righe_sql, parametri, descrizione = righe_dove_usato(request.args)
+        prezzo, variazione = leggi_modifica_prezzo(request.args)
+    except ValueError as e:
+        return jsonify(errore=str(e)), 400
+    if prezzo is None and variazione is None:
+        return jsonify(errore="Indicare il nuovo prezzo o la variazione %"), 400
+    conn = get_db()
+    impieghi = dove_usato(conn.cursor(), righe_sql, parametri, prezzo, variazione)
+    riepiloghi = riepiloghi_costi(conn, [i.id_distinta for i in impieghi])
+    distinte = []
+    for i in sorted(impieghi, key=lambda i: -abs(i.variazione)):
+        attuale = riepiloghi[i.id_distinta].costo_totale
+        distinte.append({
+            'id': i.id_distinta,
+            'codice': i.codice,
+            'descrizione': i.descrizione,
+            'diretta': i.righe > 0,
+            'qty': i.qty,
+            'costo_attuale': round(attuale, 4),
+            'costo_nuovo': round(attuale + i.variazione, 4),
+            'variazione': round(i.variazione, 4),
+            'variazione_percentuale': round(i.variazione / attuale * 100, 2) if attuale else None,
+        })
+    return jsonify(ricerca=descrizione, prezzo=prezzo, variazione=variazione, distinte=distinte)
 
 
 @app.route('/componente/<int:id_componente>/fornitori', methods=['GET', 'POST'])
 def fornitori_componente(id_componente):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT nome FROM componenti WHERE id = ?", (id_componente,))
     componente = c.fetchone()
     c.execute("SELECT * FROM fornitori")
     fornitori = c.fetchall()
     c.execute('''
-        SELECT pf.id, f.nome, pf.prezzo
+        SELECT pf.id, f.nome, pf.prezzo, pf.id_fornitore
         FROM prezzi_fornitori pf
         JOIN fornitori f ON pf.id_fornitore = f.id
         WHERE pf.id_componente = ?
     ''', (id_componente,))
     fornitori_assoc = c.fetchall()
-    conn.close()
+    # Versioni di listino per fornitore, dalla piu' recente: [(valido_dal, [(qty_minima, prezzo)])]
+    c.execute('''
+        SELECT id_fornitore, valido_dal, qty_minima, prezzo
+        FROM listini_fornitori
+        WHERE id_componente = ?
+        ORDER BY id_fornitore, valido_dal DESC, qty_minima
+    ''', (id_componente,))
+    listini = {}
+    for (id_f, valido_dal), righe in itertools.groupby(c.fetchall(), key=lambda r: (r[0], r[1])):
+        listini.setdefault(id_f, []).append((valido_dal, [(qty, prezzo) for _, _, qty, prezzo in righe]))
     return render_template("fornitori_componente.html",
                            componente_nome=componente[0],
                            id_componente=id_componente,
                            fornitori=fornitori,
-                           fornitori_assoc=fornitori_assoc)
+                           fornitori_assoc=fornitori_assoc,
+                           statistiche=statistiche_fornitori(c, [a[3] for a in fornitori_assoc]),
+                           listini=listini, oggi=datetime.now().strftime('%Y-%m-%d'),
+                           da_sempre=LISTINO_DA_SEMPRE)
 
 @app.route('/componente/<int:id_componente>/aggiungi-prezzo', methods=['POST'])
 def aggiungi_prezzo_fornitore(id_componente):
-    id_fornitore = request.form['id_fornitore']
-    prezzo = request.form['prezzo']
+    # Prezzo da 1 pezzo piu' eventuali scaglioni: una nuova versione del listino
+    try:
+        id_fornitore = int(request.form['id_fornitore'])
+        scaglioni = leggi_scaglioni(f"1: {request.form['prezzo']}; {request.form.get('scaglioni', '')}")
+        valido_dal = request.form.get('valido_dal') or datetime.now().strftime('%Y-%m-%d')
+        datetime.strptime(valido_dal, '%Y-%m-%d')
+    except ValueError as e:
+        return str(e), 400
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''
-        INSERT INTO prezzi_fornitori (id_componente, id_fornitore, prezzo)
-        VALUES (?, ?, ?)
-    ''', (id_componente, id_fornitore, prezzo))
+    c.execute("SELECT 1 FROM fornitori WHERE id = ?", (id_fornitore,))
+    if c.fetchone() is None:
+        return "Fornitore non trovato", 404
+    registra_listino(c, id_componente, id_fornitore, scaglioni, valido_dal)
     conn.commit()
-    conn.close()
     return redirect(url_for('fornitori_componente', id_componente=id_componente))
     
 # Modifica Componenti    
     
 @app.route('/componente/<int:id_componente>/modifica', methods=['GET', 'POST'])
 def modifica_componente(id_componente):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     if request.method == 'POST':
         macrozona = request.form['macrozona']
@@ -407,71 +2964,706 @@ def modifica_componente(id_componente):
         tipo = request.form['tipo']
         codice = f"{macrozona[:3].upper()}-{nome[:5].upper()}"
 
-        c.execute('''
-            UPDATE componenti
-            SET macrozona=?, nome=?, codice=?, materiale=?, spessore=?,
-                qty=?, lavorazioni=?, costo=?, tipo=?
-            WHERE id=?
-        ''', (macrozona, nome, codice, materiale, spessore, qty, lavorazioni, costo, tipo, id_componente))
-        conn.commit()
-        # Recupera id_distinta per redirect
-        c.execute("SELECT id_distinta FROM componenti WHERE id = ?", (id_componente,))
-        id_distinta = c.fetchone()[0]
-        conn.close()
+        # Componente e revisione nella stessa transazione
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Recupera id_distinta per redirect e controllo cicli
+            c.execute("SELECT id_distinta FROM componenti WHERE id = ?", (id_componente,))
+            id_distinta = c.fetchone()[0]
+            id_sottodistinta = leggi_sottodistinta(c, request.form)
+            verifica_sottodistinta(c, id_distinta, id_sottodistinta)
+
+            c.execute('''
+                UPDATE componenti
+                SET macrozona=?, nome=?, codice=?, materiale=?, spessore=?,
+                    qty=?, lavorazioni=?, costo=?, tipo=?, id_sottodistinta=?
+                WHERE id=?
+            ''', (macrozona, nome, codice, materiale, spessore, qty, lavorazioni, costo, tipo,
+                  id_sottodistinta, id_componente))
+            registra_revisione(conn, id_distinta, f"Modificato {codice}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         return redirect(url_for('dettaglio_distinta', id_distinta=id_distinta))
 
     # GET: recupera i dati del componente
     c.execute("SELECT * FROM componenti WHERE id = ?", (id_componente,))
     comp = c.fetchone()
-    conn.close()
-    return render_template("modifica_componente.html", comp=comp)
+    c.execute("SELECT codice FROM distinte WHERE id = ?", (comp[12],))
+    sottodistinta = c.fetchone()
+    return render_template("modifica_componente.html", comp=comp,
+                           sottodistinta=sottodistinta[0] if sottodistinta else "")
     
-# AGGIUNTA IN main.py
-
-from flask import Flask, render_template, request, redirect, url_for
-import sqlite3
-
 # Simulazione
 @app.route("/simula/<int:id_distinta>", methods=['GET', 'POST'])
 
 def simula_distinta(id_distinta):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
+    c = conn.cursor()
+
+    # Recupera info sulla distinta
+    c.execute("SELECT codice FROM distinte WHERE id=?", (id_distinta,))
+    nome_distinta = c.fetchone()
+    if not nome_distinta:
+        return "Distinta non trovata", 404
+
+    # Default: quantità 1
+    qty = 1
+    risultati = []
+    costo_totale = 0
+
+    if request.method == 'POST':
+        try:
+            qty = int(request.form['qty'])
+        except:
+            qty = 1
+
+        # Fabbisogno esploso su tutti i livelli di sottodistinta; i componenti
+        # con listino costano il miglior prezzo fornitore allo scaglione di qty_tot
+        esplosione = esplodi_distinta(c, id_distinta)
+        fabbisogno = list(fabbisogno_esploso(esplosione, id_distinta, qty))
+        quantita = {riga[0]: qty_tot for riga, _, qty_tot in fabbisogno}
+        migliori = {}
+        for id_comp, _, prezzo in prezzi_listino(c, quantita, datetime.now().strftime('%Y-%m-%d')):
+            migliori[id_comp] = min(prezzo, migliori.get(id_comp, prezzo))
+        for riga, qty_singola, qty_tot in fabbisogno:
+            nome, costo_unitario = riga[3], migliori.get(riga[0], riga[8])
+            costo_tot = round(costo_unitario * qty_tot, 2)
+            costo_totale += costo_tot
+            risultati.append((nome, qty_singola, qty_tot, costo_unitario, costo_tot, riga[0] in migliori))
+
+    # Tabella scenari: stessi conti dell'API, per questa sola distinta
+    testo_quantita = request.form.get('quantita', '1, 10, 100, 1000, 10000')
+    testo_scenari = request.form.get('scenari', '')
+    tabella_scenari = None
+    errore_scenari = None
+    if request.method == 'POST' and 'scenari' in request.form:
+        try:
+            quantita = leggi_quantita(testo_quantita)
+            scenari = leggi_scenari(testo_scenari)
+            oggi = datetime.now().strftime('%Y-%m-%d')
+            materiali, B, scaglioni = matrice_costi_materiale(c, [id_distinta], oggi)
+            _, curve = simula_scenari(materiali, B, quantita, scenari, scaglioni)
+            tabella_scenari = ([nome for nome, _ in scenari], list(zip(quantita.tolist(), curve[0].T.tolist())))
+        except ValueError as e:
+            errore_scenari = str(e)
+
+    # Stima lamiere per qty pezzi
+    testo_formato = request.form.get('formato', '%gx%g' % FORMATO_LAMIERA)
+    testo_distanza = request.form.get('distanza', '%g' % DISTANZA_PEZZI)
+    lamiere = None
+    senza_disegno = []
+    errore_lamiere = None
+    if request.method == 'POST' and 'formato' in request.form:
+        try:
+            formato = leggi_formato(testo_formato)
+            distanza = float(testo_distanza.replace(',', '.'))
+            if distanza < 0:
+                raise ValueError("Distanza tra i pezzi negativa")
+            pezzi, senza_disegno = pezzi_lamiera(c, id_distinta, qty)
+            lamiere = stima_lamiere(pezzi, formato, distanza)
+        except ValueError as e:
+            errore_lamiere = str(e)
+
+    return render_template("simulazione.html", nome=nome_distinta[0], id_distinta=id_distinta, qty=qty, risultati=risultati, costo_totale=costo_totale,
+                           testo_quantita=testo_quantita, testo_scenari=testo_scenari,
+                           tabella_scenari=tabella_scenari, errore_scenari=errore_scenari,
+                           testo_formato=testo_formato, testo_distanza=testo_distanza,
+                           lamiere=lamiere, senza_disegno=senza_disegno, errore_lamiere=errore_lamiere)
+    
+# Simulazione vettoriale (NumPy)
+#
+# Il costo di ogni distinta viene scomposto per materiale, sottodistinte
+# comprese: B[d, m] = costo per pezzo della distinta d dovuto al materiale m.
+# Uno scenario e' un moltiplicatore per materiale, quindi i costi unitari di
+# tutte le distinte in tutti gli scenari sono B @ M.T e le curve di costo per
+# un vettore di quantita' si ottengono con un solo broadcast.
+#
+# I componenti a listino costano il miglior prezzo fornitore allo scaglione
+# della quantita' totale, come nella tabella della simulazione: B li conta al
+# prezzo sotto il primo scaglione, e ogni scaglione superiore e' una variazione
+# di B[d, m] che vale dalla quantita' di distinta in cui il fabbisogno del
+# componente raggiunge la soglia. Le variazioni, gia' moltiplicate per gli
+# scenari, si sommano in ordine di quantita' con un cumsum.
+
+SIMULAZIONE_MAX_VALORI = 2000000  # distinte x scenari x quantita' restituite in JSON
+
+
+def normalizza_materiale(materiale):
+    return (materiale or '').strip().upper()
+
+
+# Legami padre -> sottodistinta: {id_distinta: [(id_sottodistinta, qty)]}.
+# Sono poche righe, lette per intero dall'indice su id_sottodistinta.
+def legami_sottodistinte(c):
+    c.execute('''
+        SELECT id_distinta, id_sottodistinta, SUM(COALESCE(qty, 0))
+        FROM componenti
+        WHERE id_sottodistinta IS NOT NULL
+        GROUP BY id_distinta, id_sottodistinta
+    ''')
+    legami = {}
+    for id_d, id_sotto, qty in c.fetchall():
+        legami.setdefault(id_d, []).append((id_sotto, qty))
+    return legami
+
+
+# Ordine topologico (figli prima dei padri) delle distinte raggiungibili dalle radici
+def ordine_sottodistinte(legami, radici):
+    raggiungibili = set()
+    da_visitare = list(radici)
+    while da_visitare:
+        id_d = da_visitare.pop()
+        if id_d not in raggiungibili:
+            raggiungibili.add(id_d)
+            da_visitare.extend(sotto for sotto, _ in legami.get(id_d, []))
+
+    # Kahn: una distinta e' pronta quando tutte le sue sottodistinte lo sono
+    mancanti = {id_d: len(legami.get(id_d, [])) for id_d in raggiungibili}
+    padri = {}
+    for id_d in raggiungibili:
+        for sotto, _ in legami.get(id_d, []):
+            padri.setdefault(sotto, []).append(id_d)
+    pronte = [id_d for id_d, n in mancanti.items() if n == 0]
+    ordine = []
+    while pronte:
+        id_d = pronte.pop()
+        ordine.append(id_d)
+        for padre in padri.get(id_d, []):
+            mancanti[padre] -= 1
+            if mancanti[padre] == 0:
+                pronte.append(padre)
+    if len(ordine) != len(raggiungibili):
+        bloccate = sorted(id_d for id_d, n in mancanti.items() if n > 0)
+        raise DistintaCiclica(f"Ciclo tra le distinte {bloccate}")
+    return ordine
+
+
+# Scaglioni dei componenti a listino, uno per riga: quando il fabbisogno del
+# componente raggiunge `soglia`, il costo per pezzo della radice `distinta`
+# dovuto al materiale `materiale` cambia di `variazione`
+ScaglioniCosto = namedtuple('ScaglioniCosto', 'distinta materiale fabbisogno soglia variazione')
+
+
+# Componenti foglia con prezzi fornitore usati dalle radici, direttamente o
+# tramite sottodistinte: [(posizione radice, id componente, materiale, costo,
+# fabbisogno per pezzo della radice)]
+def componenti_a_listino(c, radici):
+    c.execute('''
+        WITH a_listino AS (
+            SELECT c.id, c.id_distinta, c.materiale, COALESCE(c.costo, 0) AS costo, COALESCE(c.qty, 0) AS qty
+            FROM componenti c
+            WHERE c.id_sottodistinta IS NULL AND c.id IN (SELECT id_componente FROM prezzi_fornitori)
+        ),
+        radici AS (SELECT key AS posizione, value AS id FROM json_each(?)),
+        impieghi AS (
+            SELECT r.posizione, a.id, a.materiale, a.costo, a.qty AS fabbisogno
+            FROM a_listino a
+            JOIN radici r ON r.id = a.id_distinta
+            UNION ALL
+            SELECT r.posizione, a.id, a.materiale, a.costo, l.moltiplicatore * a.qty
+            FROM a_listino a
+            JOIN legami_distinte l ON l.id_discendente = a.id_distinta
+            JOIN radici r ON r.id = l.id_antenato
+        )
+        SELECT posizione, id, materiale, costo, SUM(fabbisogno)
+        FROM impieghi
+        GROUP BY posizione, id
+        HAVING SUM(fabbisogno) > 0
+    ''', (json.dumps(radici),))
+    return c.fetchall()
+
+
+# Miglior prezzo fornitore dei componenti per fasce di quantita': DataFrame
+# (componente, soglia, prezzo) ordinato, con la fascia 0 (sotto il primo
+# scaglione) per ogni componente e prezzo NaN se il componente non ha prezzi.
+# Le soglie sono gli scaglioni delle versioni di listino in vigore alla data e
+# le regole quelle di prezzi_listino (sotto il primo scaglione vale il primo,
+# senza listino il prezzo di prezzi_fornitori), lette con una sola query invece
+# che una volta per soglia.
+def fasce_prezzo(c, id_componenti, data):
+    c.execute('''
+        SELECT pf.id_componente, pf.id, COALESCE(l.qty_minima, 0), COALESCE(l.prezzo, pf.prezzo)
+        FROM prezzi_fornitori pf
+        LEFT JOIN listini_fornitori l
+          ON l.id_componente = pf.id_componente AND l.id_fornitore = pf.id_fornitore AND l.valido_dal = (
+              SELECT MAX(v.valido_dal)
+              FROM listini_fornitori v
+              WHERE v.id_componente = pf.id_componente AND v.id_fornitore = pf.id_fornitore
+                AND v.valido_dal <= :data)
+        WHERE pf.id_componente IN (SELECT value FROM json_each(:componenti))
+          AND COALESCE(l.prezzo, pf.prezzo) IS NOT NULL
+    ''', {'componenti': json.dumps(list(id_componenti)), 'data': data})
+    offerte = pd.DataFrame(c.fetchall(), columns=['componente', 'offerta', 'qty', 'prezzo']).astype(
+        {'componente': np.int64, 'offerta': np.int64, 'qty': float, 'prezzo': float}).sort_values(['offerta', 'qty'])
+    soglie = pd.concat([pd.DataFrame({'componente': np.asarray(list(id_componenti), dtype=np.int64), 'soglia': 0.0}),
+                        offerte[['componente', 'qty']].rename(columns={'qty': 'soglia'})]).drop_duplicates()
+
+    # Prezzo di ogni offerta a ogni soglia del suo componente: l'ultimo
+    # scaglione non oltre la soglia, altrimenti il primo
+    prezzi = pd.merge_asof(
+        offerte[['componente', 'offerta']].drop_duplicates().merge(soglie, on='componente').sort_values('soglia'),
+        offerte[['offerta', 'qty', 'prezzo']].sort_values('qty'),
+        left_on='soglia', right_on='qty', by='offerta')
+    prezzi['prezzo'] = prezzi['prezzo'].fillna(prezzi['offerta'].map(offerte.groupby('offerta')['prezzo'].first()))
+    migliori = prezzi.groupby(['componente', 'soglia'], as_index=False)['prezzo'].min()
+    return soglie.merge(migliori, on=['componente', 'soglia'], how='left').sort_values(
+        ['componente', 'soglia'], ignore_index=True)
+
+
+# Ritorna (materiali, B, scaglioni) con B di forma (len(radici), len(materiali)).
+# I costi delle foglie sono gia' sommati per (distinta, materiale) in SQL; in
+# Python si scorrono solo i legami con le sottodistinte e i componenti a listino.
+def matrice_costi_materiale(c, radici, data):
+    legami = legami_sottodistinte(c)
+    ordine = ordine_sottodistinte(legami, radici)
+    posizione = {id_d: i for i, id_d in enumerate(ordine)}
+
+    c.execute('''
+        SELECT id_distinta, materiale, SUM(qty * costo)
+        FROM componenti
+        WHERE id_sottodistinta IS NULL AND id_distinta IN (SELECT value FROM json_each(?))
+        GROUP BY id_distinta, materiale
+    ''', (json.dumps(ordine),))
+    righe = [r for r in c.fetchall() if r[2]]
+    a_listino = componenti_a_listino(c, radici)
+
+    grezzi = sorted({r[1] for r in righe} | {r[2] for r in a_listino}, key=lambda m: (m is None, m or ''))
+    materiali = sorted({normalizza_materiale(m) for m in grezzi})
+    codice_materiale = {m: materiali.index(normalizza_materiale(m)) for m in grezzi}
+
+    B = np.zeros((len(ordine), len(materiali)))
+    if righe:
+        np.add.at(B,
+                  (np.fromiter((posizione[r[0]] for r in righe), dtype=np.intp, count=len(righe)),
+                   np.fromiter((codice_materiale[r[1]] for r in righe), dtype=np.intp, count=len(righe))),
+                  np.fromiter((r[2] for r in righe), dtype=float, count=len(righe)))
+
+    for id_d in ordine:
+        for sotto, qty in legami.get(id_d, []):
+            B[posizione[id_d]] += qty * B[posizione[sotto]]
+    B = B[[posizione[id_d] for id_d in radici]] if radici else np.zeros((0, len(materiali)))
+
+    # Componenti a listino: dal costo di anagrafica al prezzo sotto il primo
+    # scaglione, poi una variazione per ogni scaglione che cambia il prezzo
+    a_listino = pd.DataFrame(a_listino, columns=['posizione', 'componente', 'materiale', 'costo', 'fabbisogno'])
+    a_listino['m'] = np.fromiter((codice_materiale[m] for m in a_listino['materiale']), dtype=np.intp,
+                                 count=len(a_listino))
+    fasce = fasce_prezzo(c, a_listino['componente'].unique().tolist(), data)
+    costi = a_listino.drop_duplicates('componente').set_index('componente')['costo']
+    fasce['prezzo'] = fasce['prezzo'].fillna(fasce['componente'].map(costi))
+    fasce['variazione'] = fasce.groupby('componente')['prezzo'].diff()
+
+    primi = a_listino.merge(fasce[fasce['soglia'] == 0], on='componente')
+    np.add.at(B, (primi['posizione'].to_numpy(np.intp), primi['m'].to_numpy(np.intp)),
+              (primi['fabbisogno'] * (primi['prezzo'] - primi['costo'])).to_numpy(float))
+    salti = a_listino.merge(fasce[fasce['variazione'].fillna(0) != 0], on='componente')
+    scaglioni = ScaglioniCosto(salti['posizione'].to_numpy(np.intp), salti['m'].to_numpy(np.intp),
+                               salti['fabbisogno'].to_numpy(float), salti['soglia'].to_numpy(float),
+                               (salti['fabbisogno'] * salti['variazione']).to_numpy(float))
+    return materiali, B, scaglioni
+
+
+# scenari: [(nome, {materiale: moltiplicatore})]; '*' vale per tutti i materiali.
+# Ritorna (costi unitari (d, s, q), curve (d, s, q)): senza scaglioni il costo
+# unitario e' lo stesso per ogni quantita'.
+def simula_scenari(materiali, B, quantita, scenari, scaglioni=None):
+    indice = {m: i for i, m in enumerate(materiali)}
+    M = np.ones((len(scenari), len(materiali)))
+    for s, (_, moltiplicatori) in enumerate(scenari):
+        if '*' in moltiplicatori:
+            M[s, :] = moltiplicatori['*']
+        for materiale, fattore in moltiplicatori.items():
+            i = indice.get(normalizza_materiale(materiale))
+            if i is not None:
+                M[s, i] = fattore
+    quantita = np.asarray(quantita, dtype=float)
+    unitari = np.repeat((B @ M.T)[:, :, np.newaxis], len(quantita), axis=2)
+
+    if scaglioni is not None and len(scaglioni.soglia) and len(quantita):
+        # Prima quantita' (in ordine crescente) da cui vale ogni scaglione, con
+        # lo stesso confronto di prezzi_effettivi: fabbisogno * qty >= soglia
+        ordine = np.argsort(quantita, kind='stable')
+        crescenti = quantita[ordine]
+        inizio = np.searchsorted(crescenti, scaglioni.soglia / scaglioni.fabbisogno)
+        precedente = crescenti[np.maximum(inizio - 1, 0)]
+        inizio -= (inizio > 0) & (scaglioni.fabbisogno * precedente >= scaglioni.soglia)
+        successiva = crescenti[np.minimum(inizio, len(crescenti) - 1)]
+        inizio += (inizio < len(crescenti)) & (scaglioni.fabbisogno * successiva < scaglioni.soglia)
+
+        variazioni = np.zeros((B.shape[0], len(scenari), len(crescenti) + 1))
+        np.add.at(variazioni,
+                  (scaglioni.distinta[:, np.newaxis], np.arange(len(scenari))[np.newaxis, :], inizio[:, np.newaxis]),
+                  scaglioni.variazione[:, np.newaxis] * M[:, scaglioni.materiale].T)
+        unitari[:, :, ordine] += np.cumsum(variazioni[:, :, :-1], axis=2)
+
+    curve = unitari * quantita[np.newaxis, np.newaxis, :]
+    return unitari, curve
+
+
+# Righe del form: "Acciaio +8%: S235 +8%, AISI304 +8%" (oppure "* +5%" per tutti)
+def leggi_scenari(testo):
+    scenari = [('Base', {})]
+    for riga in (testo or '').splitlines():
+        if not riga.strip():
+            continue
+        nome, _, voci = riga.partition(':') if ':' in riga else (riga, '', riga)
+        moltiplicatori = {}
+        for voce in voci.split(','):
+            parti = voce.strip().rsplit(None, 1)
+            if len(parti) != 2 or not parti[1].endswith('%'):
+                raise ValueError(f"Voce di scenario non valida: {voce.strip()!r}")
+            moltiplicatori[parti[0] if parti[0] == '*' else normalizza_materiale(parti[0])] = \
+                1 + float(parti[1].rstrip('%')) / 100
+        scenari.append((nome.strip(), moltiplicatori))
+    return scenari
+
+
+# Moltiplicatori dal JSON: {"Acciaio +8%": {"S235": 1.08, "AISI304": 1.08}}
+def leggi_scenari_json(scenari):
+    letti = [('Base', {})]
+    for nome, moltiplicatori in scenari.items():
+        if not isinstance(moltiplicatori, dict) or not all(
+                isinstance(f, (int, float)) and not isinstance(f, bool) for f in moltiplicatori.values()):
+            raise ValueError(f"Scenario non valido: {nome!r} (atteso {{materiale: moltiplicatore}})")
+        letti.append((nome, moltiplicatori))
+    return letti
+
+
+# "1, 10, 100" oppure "1-10000" / "1-10000:10" (da-a:passo). Gli intervalli sono
+# contati prima di essere generati: oltre SIMULAZIONE_MAX_VALORI e' un errore
+def leggi_quantita(testo):
+    parti = []
+    n_quantita = 0
+    for voce in (testo or '').split(','):
+        voce = voce.strip()
+        if not voce:
+            continue
+        try:
+            if '-' in voce:
+                intervallo, _, passo = voce.partition(':')
+                da, a = (int(x) for x in intervallo.split('-', 1))
+                passo = int(passo or 1)
+                if passo < 1:
+                    raise ValueError
+                parti.append((da, a + 1, passo))
+                n_quantita += len(range(da, a + 1, passo))
+            else:
+                parti.append(int(voce))
+                n_quantita += 1
+        except ValueError:
+            raise ValueError(f"Quantita' non valida: {voce!r}")
+        if n_quantita > SIMULAZIONE_MAX_VALORI:
+            raise ValueError(f"Troppe quantita' richieste (oltre {SIMULAZIONE_MAX_VALORI})")
+    if not n_quantita:
+        raise ValueError("Quantita' non valide")
+    quantita = np.concatenate([np.arange(*p) if isinstance(p, tuple) else [p] for p in parti])
+    if quantita.min() < 1:
+        raise ValueError("Quantita' non valide")
+    return quantita
+
+
+# Id delle distinte: "3, 7, 12" dal form o dalla query string, oppure una lista JSON
+def leggi_id_distinte(valore):
+    if not valore:
+        return []
+    voci = valore.split(',') if isinstance(valore, str) else valore
+    if not isinstance(voci, list):
+        raise ValueError("Distinte non valide")
+    id_distinte = []
+    for voce in voci:
+        if isinstance(voce, bool) or not isinstance(voce, (int, str)):
+            raise ValueError(f"Id distinta non valido: {voce!r}")
+        if isinstance(voce, str) and not voce.strip():
+            continue
+        try:
+            id_distinte.append(int(voce))
+        except ValueError:
+            raise ValueError(f"Id distinta non valido: {voce.strip()!r}")
+    return id_distinte
+
+
+@app.route('/api/simulazione', methods=['GET', 'POST'])
+def api_simulazione():
+    dati = request.get_json(silent=True) or {}
+
+    def parametri(nome, default=None):
+        return dati.get(nome, request.values.get(nome, default))
+
+    try:
+        quantita = parametri('quantita', '1')
+        if isinstance(quantita, list):
+            quantita = ','.join(map(str, quantita))
+        quantita = leggi_quantita(str(quantita))
+        scenari = parametri('scenari')
+        if isinstance(scenari, dict):
+            scenari = leggi_scenari_json(scenari)
+        elif scenari is None or isinstance(scenari, str):
+            scenari = leggi_scenari(scenari)
+        else:
+            raise ValueError("Scenari non validi")
+        id_distinte = leggi_id_distinte(parametri('distinte'))
+    except ValueError as e:
+        return jsonify(errore=str(e)), 400
+
+    conn = get_db()
     c = conn.cursor()
+    if id_distinte:
+        c.execute("SELECT id, codice FROM distinte WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id",
+                  (json.dumps(id_distinte),))
+    else:
+        c.execute("SELECT id, codice FROM distinte ORDER BY id")
+    distinte = c.fetchall()
+
+    n_valori = len(distinte) * len(scenari) * len(quantita)
+    if n_valori > SIMULAZIONE_MAX_VALORI:
+        return jsonify(errore=f"Troppi valori richiesti ({n_valori}): ridurre distinte, scenari o quantita'"), 400
+
+    radici = [d[0] for d in distinte]
+    materiali, B, scaglioni = matrice_costi_materiale(c, radici, datetime.now().strftime('%Y-%m-%d'))
+    unitari, curve = simula_scenari(materiali, B, quantita, scenari, scaglioni)
+
+    return jsonify(
+        quantita=quantita.tolist(),
+        scenari=[nome for nome, _ in scenari],
+        distinte=[{
+            'id': id_d,
+            'codice': codice,
+            'costo_unitario': np.round(unitari[i], 4).tolist(),
+            'curve': np.round(curve[i], 2).tolist(),
+        } for i, (id_d, codice) in enumerate(distinte)],
+    )
+
+
+# Stima lamiere (nesting a ripiani)
+#
+# I pezzi in lamiera di una distinta esplosa sono i componenti foglia con un
+# disegno DXF indicizzato: il rettangolo di ingombro del disegno e' il pezzo da
+# disporre. Per ogni coppia (materiale, spessore) i rettangoli sono ordinati per
+# altezza decrescente e disposti a ripiani sul formato del foglio (first-fit
+# decreasing height, con rotazione di 90 gradi se il pezzo non entra disteso).
+# I pezzi uguali sono disposti tutti insieme: lo spazio libero di ripiani e
+# fogli e' un array NumPy e il first-fit di n pezzi e' una somma cumulata,
+# quindi il tempo dipende dai codici distinti e non dalle quantita'. La stima e'
+# prudente (il nesting reale incastra anche i contorni); lo sfrido e' calcolato
+# sull'area netta dei disegni rispetto all'area dei fogli usati.
+
+FORMATO_LAMIERA = (3000.0, 1500.0)  # mm
+DISTANZA_PEZZI = 5.0  # mm tra due pezzi (taglio + ponticello)
+BORDO_LAMIERA = 10.0  # mm di bordo non utilizzabile
+
+StimaLamiera = namedtuple('StimaLamiera', [
+    'materiale', 'spessore', 'n_pezzi', 'n_fogli', 'area_pezzi', 'area_fogli', 'sfrido', 'fuori_formato',
+])
+
+
+# "15/10" -> 1.5, "1,5" -> 1.5, "3" -> 3.0; None se non e' uno spessore (es. "M6")
+def leggi_spessore(testo):
+    testo = (testo or '').strip().lower().removesuffix('mm').strip().replace(',', '.')
+    numeratore, barra, denominatore = testo.partition('/')
+    try:
+        spessore = float(numeratore) / (float(denominatore) if barra else 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return spessore if spessore > 0 else None
+
+
+# "3000x1500" -> (3000.0, 1500.0), lato lungo per primo
+def leggi_formato(testo):
+    parti = (testo or '').lower().replace('×', 'x').split('x')
+    try:
+        lati = sorted((float(p.replace(',', '.')) for p in parti), reverse=True)
+    except ValueError:
+        lati = []
+    if len(lati) != 2 or lati[1] <= 0:
+        raise ValueError(f"Formato lamiera non valido: {testo!r}")
+    return tuple(lati)
+
+
+# pezzi: [(larghezza, altezza, quantita)] in mm. Ritorna (n_fogli, indici dei pezzi fuori formato).
+def impacca_rettangoli(pezzi, formato=FORMATO_LAMIERA, distanza=DISTANZA_PEZZI, bordo=BORDO_LAMIERA):
+    L = formato[0] - 2 * bordo + distanza  # ogni pezzo occupa il suo lato + distanza
+    H = formato[1] - 2 * bordo + distanza
+    disposti = []
+    fuori_formato = []
+    for i, (larghezza, altezza, quantita) in enumerate(pezzi):
+        lungo, corto = max(larghezza, altezza) + distanza, min(larghezza, altezza) + distanza
+        if lungo <= L and corto <= H:
+            disposti.append((lungo, corto, quantita))
+        elif corto <= L and lungo <= H:
+            disposti.append((corto, lungo, quantita))
+        else:
+            fuori_formato.append(i)
+    disposti.sort(key=lambda p: (p[1], p[0]), reverse=True)
+
+    fogli = np.zeros(0)  # altezza libera di ogni foglio aperto
+    ripiani = np.zeros(0)  # larghezza libera di ogni ripiano, in ordine di apertura
+    for w, h, n in disposti:
+        # I ripiani aperti sono tutti alti almeno h (pezzi ordinati per altezza decrescente)
+        n = _riempi_first_fit(ripiani, w, math.ceil(n))
+        if not n:
+            continue
+
+        # Righe nuove nei fogli aperti, poi nei fogli nuovi che servono
+        per_riga = int(L // w)
+        righe = math.ceil(n / per_riga)
+        mancanti = _riempi_first_fit(fogli, h, righe)
+        if mancanti:
+            per_foglio = int(H // h)
+            nuovi = math.ceil(mancanti / per_foglio)
+            fogli = np.concatenate([fogli, np.full(nuovi, H - per_foglio * h)])
+            fogli[-1] = H - (mancanti - (nuovi - 1) * per_foglio) * h
+        ripiani = np.concatenate([ripiani, np.full(righe, L - per_riga * w)])
+        ripiani[-1] = L - (n - (righe - 1) * per_riga) * w
+    return len(fogli), fuori_formato
+
+
+# Dispone fino a n elementi di misura data negli spazi liberi, ognuno nel primo
+# che ha posto (come uno alla volta, ma in un solo passaggio). Ritorna quanti ne restano.
+def _riempi_first_fit(liberi, misura, n):
+    capienza = liberi // misura
+    cumulata = np.cumsum(capienza)
+    if not len(cumulata) or cumulata[-1] <= n:
+        liberi -= capienza * misura
+        return n - int(cumulata[-1]) if len(cumulata) else n
+    j = int(np.searchsorted(cumulata, n))
+    liberi[:j] -= capienza[:j] * misura
+    liberi[j] -= (n - (cumulata[j - 1] if j else 0)) * misura
+    return 0
+
+
+# Pezzi in lamiera di qty pezzi della distinta, con l'ingombro del disegno:
+# [(riga componente, qty totale, GeometriaDxf)] e le righe senza disegno
+def pezzi_lamiera(c, id_distinta, qty=1):
+    esplosione = esplodi_distinta(c, id_distinta)
+    fabbisogno = fabbisogno_esploso(esplosione, id_distinta, qty)
+    c.execute(f'''
+        SELECT k.id, {', '.join('g.' + campo for campo in GeometriaDxf._fields)}
+        FROM componenti k
+        JOIN geometrie_dxf g ON g.hash = k.file
+        WHERE k.id IN (SELECT value FROM json_each(?)) AND g.errore IS NULL AND g.larghezza > 0
+    ''', (json.dumps([riga[0] for riga, _, _ in fabbisogno]),))
+    geometrie = {riga[0]: GeometriaDxf(*riga[1:]) for riga in c.fetchall()}
+    pezzi, senza_disegno = [], []
+    for riga, _, qty_totale in fabbisogno:
+        if riga[0] in geometrie:
+            pezzi.append((riga, qty_totale, geometrie[riga[0]]))
+        elif leggi_spessore(riga[6]) is not None and qty_totale:
+            senza_disegno.append(riga)
+    return pezzi, senza_disegno
+
+
+# [StimaLamiera] per (materiale, spessore), ordinate per materiale
+def stima_lamiere(pezzi, formato=FORMATO_LAMIERA, distanza=DISTANZA_PEZZI, bordo=BORDO_LAMIERA):
+    gruppi = {}
+    for riga, qty, geometria in pezzi:
+        if qty > 0:
+            chiave = (normalizza_materiale(riga[5]), leggi_spessore(riga[6]))
+            gruppi.setdefault(chiave, []).append((geometria.larghezza, geometria.altezza, qty, geometria.area))
+    stime = []
+    for (materiale, spessore), rettangoli in sorted(gruppi.items(), key=lambda g: (g[0][0], g[0][1] or 0)):
+        n_fogli, fuori = impacca_rettangoli([r[:3] for r in rettangoli], formato, distanza, bordo)
+        fuori = set(fuori)
+        area_pezzi = sum(r[2] * r[3] for i, r in enumerate(rettangoli) if i not in fuori)
+        area_fogli = n_fogli * formato[0] * formato[1]
+        stime.append(StimaLamiera(materiale, spessore, sum(math.ceil(r[2]) for r in rettangoli), n_fogli,
+                                  area_pezzi, area_fogli, 1 - area_pezzi / area_fogli if area_fogli else 0.0,
+                                  sum(math.ceil(rettangoli[i][2]) for i in fuori)))
+    return stime
+
+
+# Archivio allegati a indirizzamento per contenuto
+#
+# Ogni file e' salvato una sola volta in BLOB_FOLDER/ab/cd/<sha256>, qualunque
+# sia il nome con cui viene caricato: componenti.file contiene l'hash e
+# componenti.nome_file il nome originale. L'hash e' calcolato mentre il file
+# viene scritto su un temporaneo, senza tenerlo in memoria. I riferimenti sono
+# contati da trigger su componenti.file; pulisci_allegati elimina i blob senza
+# riferimenti. Caricamento e pulizia pubblicano ed eliminano i blob tenendo il
+# lock di scrittura del database, quindi non possono incrociarsi.
+
+BLOB_FOLDER = 'allegati'
+BLOB_BLOCCO = 1024 * 1024
+BLOB_MAX_AGE = 365 * 24 * 3600  # il contenuto di un hash non cambia mai
+BLOB_TEMPORANEI_MAX_AGE = 3600  # temporanei di upload interrotti
+
+
+def percorso_blob(hash_file):
+    return os.path.join(BLOB_FOLDER, hash_file[:2], hash_file[2:4], hash_file)
+
+
+# Copia il flusso in un temporaneo calcolando l'hash: (hash, dimensione, temporaneo)
+def scrivi_temporaneo(flusso):
+    cartella = os.path.join(BLOB_FOLDER, 'tmp')
+    os.makedirs(cartella, exist_ok=True)
+    sha = hashlib.sha256()
+    dimensione = 0
+    fd, temporaneo = tempfile.mkstemp(dir=cartella)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while blocco := flusso.read(BLOB_BLOCCO):
+                sha.update(blocco)
+                f.write(blocco)
+                dimensione += len(blocco)
+    except BaseException:
+        os.remove(temporaneo)
+        raise
+    return sha.hexdigest(), dimensione, temporaneo
+
 
-    # Recupera info sulla distinta
-    c.execute("SELECT codice FROM distinte WHERE id=?", (id_distinta,))
-    nome_distinta = c.fetchone()
-    if not nome_distinta:
-        return "Distinta non trovata", 404
+# Sposta il temporaneo nell'archivio, o lo scarta se il contenuto c'e' gia'
+def pubblica_blob(temporaneo, hash_file):
+    destinazione = percorso_blob(hash_file)
+    if os.path.exists(destinazione):
+        os.remove(temporaneo)
+        return
+    os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+    os.replace(temporaneo, destinazione)
 
-    # Default: quantità 1
-    qty = 1
-    risultati = []
-    costo_totale = 0
 
-    if request.method == 'POST':
-        try:
-            qty = int(request.form['qty'])
-        except:
-            qty = 1
+def registra_blob(c, hash_file, dimensione):
+    c.execute('''
+        INSERT INTO allegati (hash, dimensione, creato) VALUES (?, ?, ?)
+        ON CONFLICT(hash) DO NOTHING
+    ''', (hash_file, dimensione, time.strftime('%Y-%m-%d %H:%M:%S')))
 
-        # Recupera componenti
-        c.execute("""
-            SELECT nome, qty, costo
-            FROM componenti
-            WHERE id_distinta = ?
-        """, (id_distinta,))
-        componenti = c.fetchall()
 
-        for nome, qty_singola, costo_unitario in componenti:
-            qty_tot = qty_singola * qty
-            costo_tot = round(costo_unitario * qty_tot, 2)
-            costo_totale += costo_tot
-            risultati.append((nome, qty_singola, qty_tot, costo_unitario, costo_tot))
+# Elimina i blob senza riferimenti, i file dell'archivio non registrati (es.
+# commit fallito dopo la pubblicazione) e i temporanei vecchi. Ritorna i byte liberati.
+def pulisci_allegati(conn):
+    liberati = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        c = conn.cursor()
+        c.execute("SELECT hash, dimensione FROM allegati WHERE riferimenti <= 0")
+        orfani = c.fetchall()
+        c.execute("DELETE FROM allegati WHERE riferimenti <= 0")
+        c.execute("DELETE FROM geometrie_dxf WHERE hash NOT IN (SELECT hash FROM allegati)")
+        c.execute("SELECT hash FROM allegati")
+        registrati = {riga[0] for riga in c.fetchall()}
+        for hash_file, dimensione in orfani:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(percorso_blob(hash_file))
+                liberati += dimensione
+        for cartella, _, nomi in os.walk(BLOB_FOLDER):
+            temporanei = os.path.basename(cartella) == 'tmp'
+            for nome in nomi:
+                percorso = os.path.join(cartella, nome)
+                if temporanei:
+                    if time.time() - os.path.getmtime(percorso) < BLOB_TEMPORANEI_MAX_AGE:
+                        continue
+                elif nome in registrati:
+                    continue
+                liberati += os.path.getsize(percorso)
+                os.remove(percorso)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return liberati
+
 
-    conn.close()
-    return render_template("simulazione.html", nome=nome_distinta[0], id_distinta=id_distinta, qty=qty, risultati=risultati, costo_totale=costo_totale)
-    
 @app.route('/componente/<int:id_componente>/carica-file/<int:id_distinta>', methods=['POST'])
 def carica_file_componente(id_componente, id_distinta):
     if 'file' not in request.files:
@@ -481,59 +3673,505 @@ def carica_file_componente(id_componente, id_distinta):
     if file.filename == '':
         return "Nome file vuoto", 400
 
-    if file:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-
-        # Aggiorna la riga del componente con il nome del file
-        conn = sqlite3.connect(DB_NAME)
+    hash_file, dimensione, temporaneo = scrivi_temporaneo(file.stream)
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
         c = conn.cursor()
-        c.execute("UPDATE componenti SET file = ? WHERE id = ?", (filename, id_componente))
+        registra_blob(c, hash_file, dimensione)
+        # Aggiorna la riga del componente con l'hash e il nome del file
+        c.execute("UPDATE componenti SET file = ?, nome_file = ? WHERE id = ?",
+                  (hash_file, secure_filename(file.filename) or hash_file, id_componente))
+        pubblica_blob(temporaneo, hash_file)
         conn.commit()
-        conn.close()
+    except Exception:
+        conn.rollback()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporaneo)
+        raise
 
+    if file.filename.lower().endswith('.dxf'):
+        indicizza_dxf(conn, hash_file)
     return redirect(url_for('dettaglio_distinta', id_distinta=id_distinta))
 
-@app.route('/ordini-fornitore')
-def elenco_ordini_fornitore():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
 
+# Il nome nel percorso serve solo al browser (nome del download e tipo MIME).
+# ETag = hash del contenuto; send_file gestisce If-None-Match e Range.
+@app.route('/allegati/<hash_file>/<path:nome>')
+def scarica_allegato(hash_file, nome):
+    percorso = percorso_blob(hash_file)
+    if not re.fullmatch(r'[0-9a-f]{64}', hash_file) or not os.path.isfile(percorso):
+        return "Allegato non trovato", 404
+    risposta = send_file(os.path.abspath(percorso), download_name=nome, conditional=True,
+                         etag=hash_file, max_age=BLOB_MAX_AGE)
+    risposta.cache_control.immutable = True
+    return risposta
+
+
+@app.cli.command('pulisci-allegati')
+def comando_pulisci_allegati():
+    """Elimina gli allegati non piu' usati da nessun componente"""
+    liberati = pulisci_allegati(get_db())
+    click.echo(f"Liberati {liberati / 1024 / 1024:.1f} MB")
+
+
+# Geometria dei disegni DXF
+#
+# Il parser legge il DXF ASCII una coppia (codice, valore) alla volta e passa
+# avanti un'entita' geometrica della sezione ENTITIES alla volta: blocchi,
+# oggetti e tabelle, che sono quasi tutto il file, vengono scorsi senza essere
+# conservati. Archi, cerchi, ellissi e polilinee con bulge sono approssimati da
+# spezzate (DXF_PASSO_ARCO) per il riquadro e l'area; le lunghezze degli archi
+# sono esatte. Di ogni entita' restano solo riquadro, somma di Gauss (area) ed
+# estremi: i tratti aperti vengono concatenati per estremi comuni sommando le
+# aree parziali. Ogni contorno chiuso e' un pezzo o un foro a seconda di quanti
+# contorni piu' grandi ne contengono il riquadro, cercati con una scansione per
+# x crescente. Le metriche sono salvate in geometrie_dxf per hash del file,
+# quindi si ricalcolano solo per un contenuto nuovo o se cambia DXF_VERSIONE.
+
+DXF_VERSIONE = 2
+DXF_PASSO_ARCO = math.radians(5)
+DXF_TOLLERANZA = 2  # decimali (mm) per considerare coincidenti due estremi
+# $INSUNITS -> mm (0 = senza unita', si assumono mm)
+DXF_UNITA = {0: 1.0, 1: 25.4, 2: 304.8, 4: 1.0, 5: 10.0, 6: 1000.0}
+DXF_ENTITA = {'LINE', 'ARC', 'CIRCLE', 'LWPOLYLINE', 'POLYLINE', 'ELLIPSE', 'SPLINE'}
+
+GeometriaDxf = namedtuple('GeometriaDxf', [
+    'min_x', 'min_y', 'larghezza', 'altezza', 'lunghezza_taglio', 'area',
+    'n_pezzi', 'n_fori', 'n_entita', 'n_ignorate',
+])
+
+
+class ErroreDxf(ValueError):
+    pass
+
+
+# (codice, valore) dal file binario aperto. Si divide solo su \n: i testi
+# possono contenere caratteri che str.splitlines() tratterebbe come a capo.
+def coppie_dxf(flusso):
+    prima = flusso.readline()
+    if prima.startswith(b'AutoCAD Binary DXF'):
+        raise ErroreDxf("DXF binario non supportato")
+    righe = itertools.chain([prima], flusso)
+    for codice, valore in zip(righe, righe):
+        try:
+            yield int(codice), valore.strip().decode('latin-1')
+        except ValueError:
+            raise ErroreDxf(f"Codice di gruppo non valido: {codice[:20]!r}")
+
+
+# Entita' geometriche come (tipo, [(codice, valore)]), una alla volta; VERTEX e
+# SEQEND sono raccolti nella POLYLINE che li precede. In `letto` restano
+# $INSUNITS e il numero di entita' geometriche e di quelle ignorate.
+def entita_dxf(flusso, letto):
+    letto.update(unita=0, entita=0, ignorate=0)
+    sezione = None
+    variabile = None
+    corrente = None
+    for codice, valore in coppie_dxf(flusso):
+        if codice == 0:
+            if corrente is not None and corrente[0] == 'POLYLINE' and valore == 'VERTEX':
+                corrente[1].append((0, valore))
+                continue
+            if corrente is not None:
+                letto['entita'] += 1
+                yield corrente
+                corrente = None
+            if valore == 'ENDSEC':
+                sezione = None
+            elif sezione == 'ENTITIES' and valore in DXF_ENTITA:
+                corrente = (valore, [])
+            elif sezione == 'ENTITIES' and valore != 'SEQEND':
+                letto['ignorate'] += 1
+        elif codice == 2 and sezione is None:
+            sezione = valore
+        elif sezione == 'HEADER':
+            if codice == 9:
+                variabile = valore
+            elif variabile == '$INSUNITS' and codice == 70:
+                letto['unita'] = int(valore)
+        elif corrente is not None:
+            corrente[1].append((codice, valore))
+
+
+def _valori(coppie, *codici):
+    trovati = dict(coppie)
+    return [float(trovati.get(codice, 0)) for codice in codici]
+
+
+def _punti_arco(cx, cy, r, a0, sweep):
+    n = max(1, math.ceil(abs(sweep) / DXF_PASSO_ARCO))
+    return [(cx + r * math.cos(a0 + sweep * i / n), cy + r * math.sin(a0 + sweep * i / n)) for i in range(n + 1)]
+
+
+# Spezzata con bulge: [(x, y, bulge)] -> (punti, lunghezza)
+def _punti_polilinea(vertici, chiusa):
+    if chiusa and vertici:
+        vertici = vertici + [vertici[0]]
+    punti = [vertici[0][:2]] if vertici else []
+    lunghezza = 0.0
+    for (x1, y1, bulge), (x2, y2, _) in zip(vertici, vertici[1:]):
+        corda = math.hypot(x2 - x1, y2 - y1)
+        if not bulge or not corda:
+            punti.append((x2, y2))
+            lunghezza += corda
+            continue
+        angolo = 4 * math.atan(bulge)
+        r = corda / (2 * math.sin(abs(angolo) / 2))
+        # Centro a distanza r*cos(angolo/2) dal punto medio, a sinistra per bulge positivo
+        d = r * math.cos(angolo / 2) * (1 if bulge > 0 else -1)
+        mx, my = (x1 + x2) / 2, (y1 + y2) / 2
+        cx, cy = mx - d * (y2 - y1) / corda, my + d * (x2 - x1) / corda
+        punti.extend(_punti_arco(cx, cy, r, math.atan2(y1 - cy, x1 - cx), angolo)[1:])
+        lunghezza += r * abs(angolo)
+    return punti, lunghezza
+
+
+# Entita' -> (punti, chiusa, lunghezza)
+def _tratti_dxf(entita):
+    for tipo, coppie in entita:
+        if tipo == 'LINE':
+            x1, y1, x2, y2 = _valori(coppie, 10, 20, 11, 21)
+            yield [(x1, y1), (x2, y2)], False, math.hypot(x2 - x1, y2 - y1)
+        elif tipo == 'CIRCLE':
+            cx, cy, r = _valori(coppie, 10, 20, 40)
+            yield _punti_arco(cx, cy, r, 0, 2 * math.pi)[:-1], True, 2 * math.pi * r
+        elif tipo == 'ARC':
+            cx, cy, r, a0, a1 = _valori(coppie, 10, 20, 40, 50, 51)
+            sweep = math.radians((a1 - a0) % 360 or 360)
+            yield _punti_arco(cx, cy, r, math.radians(a0), sweep), False, r * sweep
+        elif tipo == 'ELLIPSE':
+            cx, cy, ax, ay, rapporto = _valori(coppie, 10, 20, 11, 21, 40)
+            trovati = dict(coppie)
+            t0, t1 = float(trovati.get(41, 0)), float(trovati.get(42, 2 * math.pi))
+            sweep = (t1 - t0) % (2 * math.pi) or 2 * math.pi
+            n = max(8, math.ceil(sweep / DXF_PASSO_ARCO))
+            punti = []
+            for i in range(n + 1):
+                t = t0 + sweep * i / n
+                u, v = math.cos(t), rapporto * math.sin(t)
+                punti.append((cx + ax * u - ay * v, cy + ay * u + ax * v))
+            lunghezza = sum(math.dist(p, q) for p, q in zip(punti, punti[1:]))
+            chiusa = math.isclose(sweep, 2 * math.pi)
+            yield (punti[:-1] if chiusa else punti), chiusa, lunghezza
+        elif tipo == 'LWPOLYLINE':
+            vertici = []
+            chiusa = False
+            for codice, valore in coppie:
+                if codice == 10:
+                    vertici.append([float(valore), 0.0, 0.0])
+                elif codice == 20 and vertici:
+                    vertici[-1][1] = float(valore)
+                elif codice == 42 and vertici:
+                    vertici[-1][2] = float(valore)
+                elif codice == 70:
+                    chiusa = bool(int(valore) & 1)
+            punti, lunghezza = _punti_polilinea([tuple(v) for v in vertici], chiusa)
+            if punti:
+                yield (punti[:-1] if chiusa else punti), chiusa, lunghezza
+        elif tipo == 'POLYLINE':
+            # Testata fino al primo VERTEX, poi un vertice per ogni VERTEX
+            vertici = []
+            chiusa = False
+            flag_testata = 0
+            for codice, valore in coppie:
+                if codice == 0:
+                    vertici.append([0.0, 0.0, 0.0])
+                elif not vertici:
+                    if codice == 70:
+                        flag_testata = int(valore)
+                elif codice in (10, 20, 42):
+                    vertici[-1][(10, 20, 42).index(codice)] = float(valore)
+            if flag_testata & (16 | 64):  # mesh e polyface: non sono profili di taglio
+                continue
+            chiusa = bool(flag_testata & 1)
+            punti, lunghezza = _punti_polilinea([tuple(v) for v in vertici], chiusa)
+            if punti:
+                yield (punti[:-1] if chiusa else punti), chiusa, lunghezza
+        elif tipo == 'SPLINE':
+            # Approssimata con i punti di passaggio, o con i punti di controllo se mancano
+            trovati = {10: [], 20: [], 11: [], 21: []}
+            flag = 0
+            for codice, valore in coppie:
+                if codice in trovati:
+                    trovati[codice].append(float(valore))
+                elif codice == 70:
+                    flag = int(valore)
+            xs, ys = (trovati[11], trovati[21]) if trovati[11] else (trovati[10], trovati[20])
+            punti = list(zip(xs, ys))
+            if len(punti) < 2:
+                continue
+            chiusa = bool(flag & 1)
+            lunghezza = sum(math.dist(p, q) for p, q in zip(punti, punti[1:] + (punti[:1] if chiusa else [])))
+            yield punti, chiusa, lunghezza
+
+
+# Termine della somma di Gauss (shoelace) per il lato p -> q
+def _lato(p, q):
+    return p[0] * q[1] - q[0] * p[1]
+
+
+# Riquadro (min_x, min_y, max_x, max_y) e somma di Gauss dei lati della spezzata
+def _riquadro_e_somma(punti):
+    xs, ys = [p[0] for p in punti], [p[1] for p in punti]
+    return (min(xs), min(ys), max(xs), max(ys)), sum(_lato(p, q) for p, q in zip(punti, punti[1:]))
+
+
+def _unisci_riquadri(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+# Concatena i tratti aperti (inizio, fine, riquadro, somma, n_punti) per
+# estremi comuni: ritorna i contorni chiusi come (riquadro, area, n_vertici)
+def _contorni(aperti):
+    chiave = lambda p: (round(p[0], DXF_TOLLERANZA), round(p[1], DXF_TOLLERANZA))
+    nodi = {}
+    for i, (inizio, fine, _, _, _) in enumerate(aperti):
+        nodi.setdefault(chiave(inizio), []).append(i)
+        nodi.setdefault(chiave(fine), []).append(i)
+    usati = set()
+    contorni = []
+    for i, (inizio, ultimo, riquadro, somma, n_punti) in enumerate(aperti):
+        if i in usati:
+            continue
+        usati.add(i)
+        partenza, corrente = chiave(inizio), chiave(ultimo)
+        while corrente != partenza:
+            successivo = next((j for j in nodi[corrente] if j not in usati), None)
+            if successivo is None:
+                break
+            usati.add(successivo)
+            da, a, riquadro_tratto, somma_tratto, n_tratto = aperti[successivo]
+            if chiave(da) != corrente:
+                da, a, somma_tratto = a, da, -somma_tratto
+            riquadro = _unisci_riquadri(riquadro, riquadro_tratto)
+            somma += _lato(ultimo, da) + somma_tratto
+            n_punti += n_tratto - 1
+            corrente, ultimo = chiave(a), a
+        else:
+            # L'ultimo punto coincide con il primo
+            contorni.append((riquadro, abs(somma + _lato(ultimo, inizio)) / 2, n_punti - 1))
+    return contorni
+
+
+# Profondita' di annidamento di ogni contorno (riquadro, area, ...): quanti
+# contorni di area maggiore ne contengono il riquadro. I contorni sono scorsi
+# per min_x crescente e quelli il cui riquadro finisce prima escono dagli attivi
+# (heap su max_x): ognuno si confronta solo con i contorni che lo coprono in x.
+def _profondita(contorni):
+    ordine = sorted(range(len(contorni)), key=lambda i: (contorni[i][0][0], -contorni[i][0][2], -contorni[i][1]))
+    attivi = []
+    profondita = [0] * len(contorni)
+    for i in ordine:
+        (x0, y0, x1, y1), area = contorni[i][:2]
+        while attivi and attivi[0][0] < x0:
+            heapq.heappop(attivi)
+        profondita[i] = sum(1 for fine_x, j in attivi
+                            if fine_x >= x1 and contorni[j][1] > area
+                            and contorni[j][0][1] <= y0 and contorni[j][0][3] >= y1)
+        heapq.heappush(attivi, (x1, i))
+    return profondita
+
+
+def analizza_dxf(flusso):
+    letto = {}
+    riquadro = None
+    lunghezza = 0.0
+    contorni = []
+    aperti = []
+    for punti, chiusa, lunghezza_tratto in _tratti_dxf(entita_dxf(flusso, letto)):
+        lunghezza += lunghezza_tratto
+        riquadro_tratto, somma = _riquadro_e_somma(punti)
+        riquadro = riquadro_tratto if riquadro is None else _unisci_riquadri(riquadro, riquadro_tratto)
+        if chiusa:
+            contorni.append((riquadro_tratto, abs(somma + _lato(punti[-1], punti[0])) / 2, len(punti)))
+        elif len(punti) > 1:
+            aperti.append((punti[0], punti[-1], riquadro_tratto, somma, len(punti)))
+    if riquadro is None:
+        return GeometriaDxf(None, None, 0.0, 0.0, 0.0, 0.0, 0, 0, letto['entita'], letto['ignorate'])
+    scala = DXF_UNITA.get(letto['unita'], 1.0)
+
+    # Profondita' pari = pezzo, dispari = foro
+    contorni = [c for c in contorni + _contorni(aperti) if c[2] >= 3]
+    area = 0.0
+    n_pezzi = n_fori = 0
+    for (_, area_contorno, _), profondita in zip(contorni, _profondita(contorni)):
+        if profondita % 2:
+            n_fori += 1
+            area -= area_contorno
+        else:
+            n_pezzi += 1
+            area += area_contorno
+
+    min_x, min_y, max_x, max_y = riquadro
+    return GeometriaDxf(min_x * scala, min_y * scala, (max_x - min_x) * scala, (max_y - min_y) * scala,
+                        lunghezza * scala, area * scala * scala, n_pezzi, n_fori, letto['entita'], letto['ignorate'])
+
+
+# Calcola e salva la geometria di un allegato (anche l'errore, per non riprovare a ogni richiesta)
+def _salva_geometria(c, hash_file):
+    geometria, errore = None, None
+    try:
+        with open(percorso_blob(hash_file), 'rb') as flusso:
+            geometria = analizza_dxf(flusso)
+    except (OSError, ErroreDxf, ValueError, ZeroDivisionError) as e:
+        errore = str(e) or e.__class__.__name__
+    valori = geometria or GeometriaDxf(*[None] * len(GeometriaDxf._fields))
+    c.execute(f'''
+        INSERT OR REPLACE INTO geometrie_dxf (hash, versione, {', '.join(GeometriaDxf._fields)}, errore, calcolato)
+        VALUES (?, ?, {', '.join('?' * len(GeometriaDxf._fields))}, ?, ?)
+    ''', (hash_file, DXF_VERSIONE, *valori, errore, time.strftime('%Y-%m-%d %H:%M:%S')))
+    return geometria
+
+
+# Allegati DXF senza geometria o calcolati con una versione precedente del parser
+def dxf_da_indicizzare(c):
     c.execute('''
-        SELECT o.id, o.numero_ordine, f.nome, o.data_ordine, o.riferimento_oc
+        SELECT DISTINCT c.file
+        FROM componenti c
+        LEFT JOIN geometrie_dxf g ON g.hash = c.file
+        WHERE c.file IS NOT NULL AND lower(c.nome_file) LIKE '%.dxf'
+          AND (g.hash IS NULL OR g.versione < ?)
+    ''', (DXF_VERSIONE,))
+    return [riga[0] for riga in c.fetchall()]
+
+
+def indicizza_dxf(conn, hash_file):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM geometrie_dxf WHERE hash = ? AND versione = ?", (hash_file, DXF_VERSIONE))
+    if c.fetchone():
+        return
+    _salva_geometria(c, hash_file)
+    conn.commit()
+
+
+# {hash: GeometriaDxf} degli allegati dei componenti di una distinta
+def geometrie_distinta(c, id_distinta):
+    c.execute(f'''
+        SELECT g.hash, {', '.join('g.' + campo for campo in GeometriaDxf._fields)}
+        FROM geometrie_dxf g
+        WHERE g.errore IS NULL
+          AND g.hash IN (SELECT file FROM componenti WHERE id_distinta = ? AND file IS NOT NULL)
+    ''', (id_distinta,))
+    return {riga[0]: GeometriaDxf(*riga[1:]) for riga in c.fetchall()}
+
+
+@app.cli.command('indicizza-dxf')
+def comando_indicizza_dxf():
+    """Calcola la geometria dei DXF non ancora indicizzati"""
+    conn = get_db()
+    for hash_file in dxf_da_indicizzare(conn.cursor()):
+        indicizza_dxf(conn, hash_file)
+        click.echo(hash_file)
+
+
+ORDINI_PER_PAGINA = 50
+
+SEMAFORI = {'rosso': '🔴', 'giallo': '🟡', 'verde': '🟢'}
+
+# Stato di un ordine dalle sue righe con qty > 0: verde se tutte hanno la data
+# di consegna, giallo se tutte hanno la data confermata, altrimenti rosso.
+# Le date vuote sono salvate come '' oppure NULL.
+SQL_STATO_ORDINE = '''
+    (SELECT CASE
+                WHEN COALESCE(SUM(COALESCE(r.data_consegna, '') = ''), 0) = 0 THEN 'verde'
+                WHEN COALESCE(SUM(COALESCE(r.data_confermata, '') = ''), 0) = 0 THEN 'giallo'
+                ELSE 'rosso'
+            END
+     FROM righe_ordine_fornitore r
+     WHERE r.id_ordine = o.id AND r.qty > 0)
+'''
+
+
+# Una pagina di ordini dal piu' recente, con paginazione a chiave su
+# (data_ordine, id): dopo/prima sono la chiave dell'ultima/prima riga della
+# pagina corrente. Lo stato e' calcolato solo per le righe lette dall'indice,
+# finche' la pagina non e' piena. Ritorna (righe, altre_dopo, altre_prima).
+def elenco_ordini(c, id_fornitore=None, stato=None, dal=None, al=None, dopo=None, prima=None,
+                  per_pagina=ORDINI_PER_PAGINA):
+    condizioni, parametri = [], []
+    if id_fornitore:
+        condizioni.append("o.id_fornitore = ?")
+        parametri.append(id_fornitore)
+    if dal:
+        condizioni.append("o.data_ordine >= ?")
+        parametri.append(dal)
+    if al:
+        condizioni.append("o.data_ordine <= ?")
+        parametri.append(al)
+    if stato in SEMAFORI:
+        condizioni.append(f"{SQL_STATO_ORDINE} = ?")
+        parametri.append(stato)
+    indietro = prima is not None
+    if indietro:
+        condizioni.append("(o.data_ordine, o.id) > (?, ?)")
+        parametri.extend(prima)
+    elif dopo is not None:
+        condizioni.append("(o.data_ordine, o.id) < (?, ?)")
+        parametri.extend(dopo)
+    verso = 'ASC' if indietro else 'DESC'
+
+    c.execute(f'''
+        SELECT o.id, o.numero_ordine, f.nome, o.data_ordine, o.riferimento_oc, {SQL_STATO_ORDINE} AS stato
         FROM ordini_fornitore o
         JOIN fornitori f ON o.id_fornitore = f.id
-        ORDER BY o.data_ordine DESC
-    ''')
-    ordini_base = c.fetchall()
+        {"WHERE " + " AND ".join(condizioni) if condizioni else ""}
+        ORDER BY o.data_ordine {verso}, o.id {verso}
+        LIMIT ?
+    ''', (*parametri, per_pagina + 1))
+    righe = c.fetchall()
+    altre = len(righe) > per_pagina
+    righe = righe[:per_pagina]
+    if indietro:
+        return righe[::-1], True, altre
+    return righe, altre, dopo is not None
 
-    ordini = []
-    for o in ordini_base:
-        id_ordine = o[0]
 
-        c.execute('''
-            SELECT data_confermata, data_consegna
-            FROM righe_ordine_fornitore
-            WHERE id_ordine = ? AND qty > 0
-        ''', (id_ordine,))
-        righe = c.fetchall()
+# "2025-08-01_123" -> ("2025-08-01", 123)
+def leggi_chiave_ordine(testo):
+    if not testo:
+        return None
+    data, _, id_ordine = testo.rpartition('_')
+    if not data or not id_ordine.isdigit():
+        return None
+    return data, int(id_ordine)
+
 
-        semaforo = "🔴"
-        if all(r[1] for r in righe if r):  # tutte le data_consegna sono compilate
-            semaforo = "🟢"
-        elif all(r[0] for r in righe if r):  # tutte le data_confermata sono compilate
-            semaforo = "🟡"
+@app.route('/ordini-fornitore')
+def elenco_ordini_fornitore():
+    conn = get_db()
+    c = conn.cursor()
 
-        ordini.append(o + (semaforo,))  # aggiunge lo stato al record
+    filtri = {
+        'fornitore': request.args.get('fornitore', type=int),
+        'stato': request.args.get('stato', ''),
+        'dal': request.args.get('dal', '').strip(),
+        'al': request.args.get('al', '').strip(),
+    }
+    righe, altre_dopo, altre_prima = elenco_ordini(
+        c, filtri['fornitore'], filtri['stato'], filtri['dal'], filtri['al'],
+        dopo=leggi_chiave_ordine(request.args.get('dopo')),
+        prima=leggi_chiave_ordine(request.args.get('prima')))
+    ordini = [riga[:5] + (SEMAFORI[riga[5]],) for riga in righe]
 
-    conn.close()
-    return render_template("ordini_fornitore.html", ordini=ordini)
+    c.execute("SELECT id, nome FROM fornitori ORDER BY nome")
+    fornitori = c.fetchall()
+
+    parametri = {chiave: valore for chiave, valore in filtri.items() if valore}
+    pagina_dopo = pagina_prima = None
+    if ordini and altre_dopo:
+        pagina_dopo = url_for('elenco_ordini_fornitore', dopo=f"{ordini[-1][3]}_{ordini[-1][0]}", **parametri)
+    if ordini and altre_prima:
+        pagina_prima = url_for('elenco_ordini_fornitore', prima=f"{ordini[0][3]}_{ordini[0][0]}", **parametri)
+
+    return render_template("ordini_fornitore.html", ordini=ordini, fornitori=fornitori, filtri=filtri,
+                           semafori=SEMAFORI, pagina_dopo=pagina_dopo, pagina_prima=pagina_prima,
+                           prima_pagina=url_for('elenco_ordini_fornitore', **parametri))
 
 
 @app.route('/ordine-fornitore/<int:id_ordine>')
 def dettaglio_ordine_fornitore(id_ordine):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
     # Testata ordine (aggiungo anche id_fornitore per la query dei prezzi)
@@ -544,10 +4182,11 @@ def dettaglio_ordine_fornitore(id_ordine):
         WHERE o.id = ?
     ''', (id_ordine,))
     ordine = c.fetchone()
+    if not ordine:
+        return "Ordine non trovato", 404
 
     id_fornitore = ordine[6]  # serve per ottenere i prezzi corretti
 
-    
     c.execute('''
         SELECT 
             c.nome, 
@@ -556,20 +4195,21 @@ def dettaglio_ordine_fornitore(id_ordine):
             r.data_confermata, 
             r.data_consegna, 
             c.file,
-            COALESCE(pf.prezzo, 0) AS prezzo_unitario,
-            COALESCE(pf.prezzo, 0) * r.qty AS costo_totale
+            c.nome_file,
+            c.id
         FROM righe_ordine_fornitore r
         JOIN componenti c ON r.id_componente = c.id
-        LEFT JOIN prezzi_fornitori pf ON pf.id_componente = c.id AND pf.id_fornitore = ?
         WHERE r.id_ordine = ? AND r.qty > 0
-    ''', (id_fornitore, id_ordine))
-
+    ''', (id_ordine,))
     righe = c.fetchall()
 
+    # Prezzo del listino in vigore alla data dell'ordine, allo scaglione della quantita' della riga
+    prezzi = prezzi_effettivi(c, [(r[7], id_fornitore, r[1]) for r in righe], ordine[4])
+    righe = [(*r[:6], prezzo or 0, (prezzo or 0) * r[1], r[6]) for r, prezzo in zip(righe, prezzi)]
+
     # Calcolo il totale ordine
     totale_ordine = sum([r[7] for r in righe])
 
-    conn.close()
     return render_template("dettaglio_ordine_fornitore.html",
                            ordine=ordine,
                            righe=righe,
@@ -577,84 +4217,832 @@ def dettaglio_ordine_fornitore(id_ordine):
                            totale_ordine=totale_ordine)
         
     
-from datetime import datetime
-from flask import request
-
 @app.route('/genera-ordine/<int:id_distinta>', methods=['GET', 'POST'])
 def genera_ordine_fornitore(id_distinta):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'GET':
         # Mostra il form per inserire la quantità da produrre
         c.execute("SELECT codice FROM distinte WHERE id = ?", (id_distinta,))
         nome_distinta = c.fetchone()
-        conn.close()
         return render_template("genera_ordine_fornitore.html", id_distinta=id_distinta, nome_distinta=nome_distinta[0] if nome_distinta else "")
 
-    # POST: Riceve la quantità da produrre
+    # POST: Riceve la quantità da produrre; si ordina solo il fabbisogno netto,
+    # prima in anteprima con i fornitori proposti e poi, confermato, per davvero
     qty_produzione = int(request.form['qty_produzione'])
     data_ordine = datetime.now().strftime('%Y-%m-%d')
+    try:
+        entro, giorni_disponibili, fisse = leggi_vincoli_ordine(request.form, data_ordine)
+    except ValueError as e:
+        return str(e), 400
+    richieste = [(id_distinta, qty_produzione)]
 
-    # Recupera componenti della distinta
-    c.execute("SELECT id, qty FROM componenti WHERE id_distinta = ?", (id_distinta,))
-    componenti = c.fetchall()
+    if request.form.get('azione') != 'conferma':
+        mancanti = {f.id_componente: f.netto for f in fabbisogno_netto(c, richieste) if f.netto > 0}
+        allocazione = alloca_fornitori(c, mancanti, giorni_disponibili)
+        c.execute("SELECT codice FROM distinte WHERE id = ?", (id_distinta,))
+        nome_distinta = c.fetchone()
+        return render_template("genera_ordine_fornitore.html", id_distinta=id_distinta,
+                               nome_distinta=nome_distinta[0] if nome_distinta else "",
+                               qty_produzione=qty_produzione, entro=entro, allocazione=allocazione,
+                               assegnazione=assegnazione_json(allocazione))
 
-    # Raggruppa per fornitore
-    fornitori_componenti = {}
-    for id_comp, qty_singola in componenti:
-        qty_totale = qty_singola * qty_produzione
-        c.execute('''
-            SELECT id_fornitore, prezzo FROM prezzi_fornitori
-            WHERE id_componente = ?
-            ORDER BY prezzo ASC
-            LIMIT 1
-        ''', (id_comp,))
-        fornitore = c.fetchone()
-        if fornitore:
-            id_fornitore, _ = fornitore
-            fornitori_componenti.setdefault(id_fornitore, []).append((id_comp, qty_totale))
-
-    # Crea un ordine per ogni fornitore
-    for id_fornitore, comp_list in fornitori_componenti.items():
-        numero_ordine = f"ORD-{datetime.now().strftime('%Y%m%d%H%M%S')}-{id_fornitore}"
-        riferimento_oc = f"OC-{id_distinta}"
-
-        # Testata ordine
-        c.execute('''
+    ordini, tempi = ordina_fabbisogno_netto(conn, richieste, f"OC-{id_distinta}", data_ordine,
+                                            giorni_disponibili, fisse)
+
+    app.logger.info("genera_ordine_fornitore distinta %d: %d righe, %d ordini (%s)",
+                    id_distinta, sum(map(len, ordini.values())), len(ordini),
+                    ", ".join(f"{fase} {secondi * 1000:.1f} ms" for fase, secondi in tempi))
+    risposta = redirect(url_for('elenco_ordini_fornitore'))
+    risposta.headers['Server-Timing'] = server_timing(tempi)
+    return risposta
+
+
+# Campi dei form che generano ordini: data entro cui serve la merce (-> giorni
+# disponibili da oggi) e la scelta dei fornitori mostrata in anteprima.
+def leggi_vincoli_ordine(form, oggi):
+    entro = form.get('entro') or None
+    giorni_disponibili = None
+    if entro:
+        try:
+            giorni_disponibili = (datetime.strptime(entro, '%Y-%m-%d') - datetime.strptime(oggi, '%Y-%m-%d')).days
+        except ValueError:
+            raise ValueError(f"Data non valida: {entro!r}")
+    try:
+        fisse = {int(id_comp): int(id_f) for id_comp, id_f in json.loads(form.get('assegnazione') or '{}').items()}
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Assegnazione dei fornitori non valida")
+    return entro, giorni_disponibili, fisse
+
+
+def assegnazione_json(allocazione):
+    return json.dumps({r.id_componente: r.id_fornitore for r in allocazione.righe})
+
+
+# Fornitore più economico per ogni componente: {id_componente: id_fornitore}.
+# Gli id passano come un unico parametro JSON, qualunque sia il loro numero;
+# a parita' di prezzo vince il fornitore con il tempo medio di consegna piu' breve.
+def fornitori_piu_economici(c, id_componenti):
+    c.execute('''
+        SELECT id_componente, id_fornitore
+        FROM (
+            SELECT pf.id_componente, pf.id_fornitore,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY pf.id_componente
+                       ORDER BY pf.prezzo ASC, s.giorni_consegna / NULLIF(s.n_consegne, 0) ASC NULLS LAST,
+                                pf.id_fornitore ASC
+                   ) AS posizione
+            FROM prezzi_fornitori pf
+            LEFT JOIN statistiche_fornitori s ON s.id_fornitore = pf.id_fornitore
+            WHERE pf.id_componente IN (SELECT value FROM json_each(?))
+        )
+        WHERE posizione = 1
+    ''', (json.dumps(list(id_componenti)),))
+    return dict(c.fetchall())
+
+
+# Numerazione degli ordini fornitore
+#
+# I numeri sono progressivi per anno (ORD-2025-000123) e li assegna il
+# contatore della serie in numeratori, incrementato dentro la transazione di
+# scrittura che inserisce gli ordini. SQLite ammette un solo scrittore per
+# volta, anche tra processi diversi, quindi due richieste non possono ricevere
+# lo stesso valore e un rollback restituisce i numeri presi. Non serve un lock
+# dell'applicazione: il contatore lo tocca solo chi sta gia' scrivendo e i
+# lettori non aspettano. Gli ordini generati insieme prendono un intervallo
+# di numeri con una sola istruzione. L'indice unico su numero_ordine
+# (migrazione 18) protegge anche dai numeri modificati a mano.
+
+NUMERO_ORDINE = "ORD-{anno}-{progressivo:06d}"
+NUMERO_ORDINE_AUTOMATICO = re.compile(r'ORD-\d{4}-\d{6}')
+
+
+# n numeri per ordini con data data_ordine; va chiamata in una transazione di scrittura
+def alloca_numeri_ordine(c, data_ordine, n=1):
+    anno = data_ordine[:4]
+    c.execute('''
+        INSERT INTO numeratori (serie, ultimo) VALUES (?, ?)
+        ON CONFLICT (serie) DO UPDATE SET ultimo = ultimo + excluded.ultimo
+        RETURNING ultimo
+    ''', (f"ordini-{anno}", n))
+    ultimo = c.fetchall()[0][0]
+    return [NUMERO_ORDINE.format(anno=anno, progressivo=p) for p in range(ultimo - n + 1, ultimo + 1)]
+
+
+# Scrive testate e righe degli ordini fornitore in un'unica transazione breve
+# (quella del chiamante, se ne ha gia' aperta una).
+# ordini: {id_fornitore: [(id_componente, qty), ...]}. Ritorna i tempi per fase.
+def scrivi_ordini_fornitore(conn, ordini, riferimento_oc, data_ordine):
+    tempi = []
+    if not ordini:
+        if conn.in_transaction:
+            conn.commit()
+        return tempi
+    c = conn.cursor()
+
+    inizio = time.perf_counter()
+    if not conn.in_transaction:
+        c.execute("BEGIN IMMEDIATE")
+    try:
+        # Con il lock di scrittura preso, gli id nuovi sono tutti oltre l'ultimo esistente
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM ordini_fornitore")
+        ultimo_id = c.fetchone()[0]
+        numeri = alloca_numeri_ordine(c, data_ordine, len(ordini))
+        c.executemany('''
             INSERT INTO ordini_fornitore (numero_ordine, id_fornitore, data_ordine, riferimento_oc)
             VALUES (?, ?, ?, ?)
-        ''', (numero_ordine, id_fornitore, data_ordine, riferimento_oc))
-        id_ordine = c.lastrowid
+        ''', [(numero, id_fornitore, data_ordine, riferimento_oc)
+              for numero, id_fornitore in zip(numeri, ordini)])
+        c.execute("SELECT id_fornitore, id FROM ordini_fornitore WHERE id > ?", (ultimo_id,))
+        id_ordini = dict(c.fetchall())
+        tempi.append(('testate', time.perf_counter() - inizio))
 
-        # Righe ordine
-        for id_comp, qty in comp_list:
-            c.execute('''
-                INSERT INTO righe_ordine_fornitore (id_ordine, id_componente, qty, data_richiesta)
-                VALUES (?, ?, ?, ?)
-            ''', (id_ordine, id_comp, qty, data_ordine))
+        inizio = time.perf_counter()
+        c.executemany('''
+            INSERT INTO righe_ordine_fornitore (id_ordine, id_componente, qty, data_richiesta)
+            VALUES (?, ?, ?, ?)
+        ''', [(id_ordini[id_fornitore], id_comp, qty, data_ordine)
+              for id_fornitore, righe in ordini.items()
+              for id_comp, qty in righe])
+        tempi.append(('righe', time.perf_counter() - inizio))
 
-    conn.commit()
-    conn.close()
-    return redirect(url_for('elenco_ordini_fornitore'))
+        inizio = time.perf_counter()
+        conn.commit()
+        tempi.append(('commit', time.perf_counter() - inizio))
+    except Exception:
+        conn.rollback()
+        raise
+    return tempi
+
+
+# Fabbisogno netto (MRP)
+#
+# Il fabbisogno lordo di una o piu' richieste di produzione (id_distinta, qty)
+# e' la somma delle esplosioni; la giacenza di magazzino e le righe d'ordine
+# non ancora consegnate lo coprono in quest'ordine. Il netting e' un'unica query
+# su tutti i componenti richiesti, non una lettura per componente: i lordi
+# passano come JSON e giacenze e ordini aperti sono sommati per componente dagli
+# indici della migrazione 11. Solo il netto diventa ordine fornitore.
+
+Fabbisogno = namedtuple('Fabbisogno', [
+    'id_componente', 'codice', 'nome', 'lordo', 'giacenza', 'in_ordine', 'netto',
+])
+
+
+# Lordo per componente foglia: {id_componente: qty} per tutte le richieste insieme
+def fabbisogno_lordo(c, richieste):
+    radici = sorted({id_distinta for id_distinta, _ in richieste})
+    if not radici:
+        return {}
+    esplosione = esplodi_distinta(c, radici)
+    lordo = {}
+    for id_distinta, qty in richieste:
+        for id_comp, qty_unitaria in esplosione.fabbisogni[id_distinta].items():
+            lordo[id_comp] = lordo.get(id_comp, 0) + qty_unitaria * qty
+    return lordo
+
+
+# [Fabbisogno] per codice componente; richieste: [(id_distinta, qty)]
+def fabbisogno_netto(c, richieste):
+    lordo = fabbisogno_lordo(c, richieste)
+    c.execute('''
+        WITH lordi(id_componente, lordo) AS (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+        ),
+        giacenze AS (
+            SELECT id_componente, SUM(giacenza) AS giacenza
+            FROM magazzino
+            WHERE id_componente IN (SELECT id_componente FROM lordi)
+            GROUP BY id_componente
+        ),
+        aperti AS (
+            SELECT id_componente, SUM(qty) AS in_ordine
+            FROM righe_ordine_fornitore
+            WHERE id_componente IN (SELECT id_componente FROM lordi)
+              AND COALESCE(data_consegna, '') = '' AND qty > 0
+            GROUP BY id_componente
+        )
+        SELECT l.id_componente, k.codice, k.nome, l.lordo,
+               COALESCE(g.giacenza, 0), COALESCE(a.in_ordine, 0),
+               MAX(l.lordo - COALESCE(g.giacenza, 0) - COALESCE(a.in_ordine, 0), 0)
+        FROM lordi l
+        JOIN componenti k ON k.id = l.id_componente
+        LEFT JOIN giacenze g ON g.id_componente = l.id_componente
+        LEFT JOIN aperti a ON a.id_componente = l.id_componente
+        ORDER BY k.codice, l.id_componente
+    ''', (json.dumps([[id_comp, qty] for id_comp, qty in lordo.items() if qty > 0]),))
+    return [Fabbisogno(*riga) for riga in c.fetchall()]
+
+
+# Ordina il netto delle richieste ai fornitori scelti da alloca_fornitori()
+# (fisse: la scelta gia' mostrata in anteprima). Il netting avviene
+# con il lock di scrittura gia' preso: due esecuzioni contemporanee non possono
+# ordinare due volte la stessa mancanza. Ritorna (ordini scritti, tempi per fase).
+def ordina_fabbisogno_netto(conn, richieste, riferimento_oc, data_ordine, giorni_disponibili=None, fisse=None):
+    c = conn.cursor()
+    tempi = []
+    inizio = time.perf_counter()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        tempi.append(('lock', time.perf_counter() - inizio))
+
+        inizio = time.perf_counter()
+        mancanti = {f.id_componente: f.netto for f in fabbisogno_netto(c, richieste) if f.netto > 0}
+        tempi.append(('netting', time.perf_counter() - inizio))
+
+        inizio = time.perf_counter()
+        ordini = {}
+        for riga in alloca_fornitori(c, mancanti, giorni_disponibili, fisse).righe:
+            ordini.setdefault(riga.id_fornitore, []).append((riga.id_componente, riga.qty))
+        tempi.append(('fornitori', time.perf_counter() - inizio))
+
+        tempi += scrivi_ordini_fornitore(conn, ordini, riferimento_oc, data_ordine)
+    except Exception:
+        conn.rollback()
+        raise
+    return ordini, tempi
+
+
+# Righe del form: "CODICE_DISTINTA QTY" -> [(id_distinta, qty)]
+def leggi_richieste(c, testo):
+    voci = []
+    for riga in (testo or '').splitlines():
+        if not riga.strip():
+            continue
+        parti = riga.strip().rsplit(None, 1)
+        try:
+            qty = float(parti[1].replace(',', '.')) if len(parti) == 2 else None
+        except ValueError:
+            qty = None
+        if qty is None or qty <= 0:
+            raise ValueError(f"Richiesta non valida: {riga.strip()!r} (atteso CODICE QUANTITA)")
+        voci.append((parti[0], qty))
+    c.execute("SELECT codice, MIN(id) FROM distinte WHERE codice IN (SELECT value FROM json_each(?)) GROUP BY codice",
+              (json.dumps([codice for codice, _ in voci]),))
+    id_distinte = dict(c.fetchall())
+    sconosciute = sorted({codice for codice, _ in voci if codice not in id_distinte})
+    if sconosciute:
+        raise ValueError("Distinte inesistenti: " + ", ".join(sconosciute))
+    return [(id_distinte[codice], qty) for codice, qty in voci]
+
+
+# Produzioni da oggi in poi: (id, codice distinta, qty, data, numero, id_distinta)
+def produzioni_pianificate(c, dal):
+    c.execute('''
+        SELECT p.id, d.codice, p.qty_prodotta, p.data_produzione, p.numero_produzione, p.id_distinta
+        FROM produzioni p
+        JOIN distinte d ON d.id = p.id_distinta
+        WHERE p.data_produzione >= ?
+        ORDER BY p.data_produzione, p.id
+    ''', (dal,))
+    return c.fetchall()
+
+
+@app.route('/mrp', methods=['GET', 'POST'])
+def fabbisogno_materiali():
+    conn = get_db()
+    c = conn.cursor()
+    oggi = datetime.now().strftime('%Y-%m-%d')
+    azione = request.form.get('azione', '')
+
+    if azione == 'pianifica':
+        try:
+            (id_distinta, qty), = leggi_richieste(c, f"{request.form['codice']} {request.form['qty']}")
+            if not qty.is_integer():
+                raise ValueError(f"Quantita' da produrre non intera: {request.form['qty'].strip()}")
+        except ValueError as e:
+            return str(e), 400
+        qty = int(qty)  # produzioni.qty_prodotta e' INTEGER
+        c.execute('''
+            INSERT INTO produzioni (id_distinta, qty_prodotta, data_produzione, numero_produzione)
+            VALUES (?, ?, ?, ?)
+        ''', (id_distinta, qty, request.form.get('data') or oggi, request.form.get('numero', '').strip() or None))
+        conn.commit()
+        return redirect(url_for('fabbisogno_materiali'))
+
+    produzioni = produzioni_pianificate(c, oggi)
+    testo_richieste = request.form.get('richieste', '')
+    if request.method == 'POST':
+        selezionate = set(request.form.getlist('produzione', type=int))
+    else:
+        selezionate = {p[0] for p in produzioni}
+
+    fabbisogno = None
+    allocazione = None
+    errore = None
+    entro = request.form.get('entro', '')
+    if request.method == 'POST':
+        try:
+            richieste = leggi_richieste(c, testo_richieste)
+            entro, giorni_disponibili, fisse = leggi_vincoli_ordine(request.form, oggi)
+        except ValueError as e:
+            errore = str(e)
+        else:
+            richieste += [(p[5], p[2]) for p in produzioni if p[0] in selezionate]
+            if azione == 'ordina':
+                ordini, tempi = ordina_fabbisogno_netto(conn, richieste, f"MRP-{oggi}", oggi,
+                                                        giorni_disponibili, fisse)
+                app.logger.info("fabbisogno_materiali: %d richieste, %d righe, %d ordini (%s)",
+                                len(richieste), sum(map(len, ordini.values())), len(ordini),
+                                ", ".join(f"{fase} {secondi * 1000:.1f} ms" for fase, secondi in tempi))
+                risposta = redirect(url_for('elenco_ordini_fornitore'))
+                risposta.headers['Server-Timing'] = server_timing(tempi)
+                return risposta
+            fabbisogno = fabbisogno_netto(c, richieste)
+            allocazione = alloca_fornitori(c, {f.id_componente: f.netto for f in fabbisogno if f.netto > 0},
+                                           giorni_disponibili)
+
+    c.execute("SELECT codice FROM distinte ORDER BY codice")
+    distinte = [riga[0] for riga in c.fetchall()]
+    return render_template("fabbisogno_materiali.html", produzioni=produzioni, selezionate=selezionate,
+                           testo_richieste=testo_richieste, fabbisogno=fabbisogno, allocazione=allocazione,
+                           assegnazione=assegnazione_json(allocazione) if allocazione else '',
+                           entro=entro or '', errore=errore, distinte=distinte, oggi=oggi)
+
+
+# Statistiche fornitori
+#
+# Aggregati mantenuti dai trigger della migrazione 13 (statistiche_fornitori e
+# istogramma consegne_fornitore): lettura in una query, senza storico.
+
+StatisticheFornitore = namedtuple('StatisticheFornitore', [
+    'n_consegne',        # righe consegnate con data richiesta valida
+    'lead_medio',        # giorni medi da richiesta a consegna
+    'mediana',           # giorni, dall'istogramma
+    'p90',               # giorni entro cui arriva il 90% delle consegne
+    'puntualita',        # quota consegnata entro la data confermata, None senza conferme
+    'n_conferme',
+    'ritardo_conferma',  # giorni medi da richiesta a data confermata
+])
+
+
+# {id_fornitore: StatisticheFornitore}, tutti i fornitori con storico o solo `ids`
+def statistiche_fornitori(c, ids=None):
+    filtro = "IN (SELECT value FROM json_each(:ids))" if ids is not None else "IS NOT NULL"
+    c.execute(f'''
+        WITH cumulate AS (
+            SELECT id_fornitore, giorni,
+                   SUM(n) OVER (PARTITION BY id_fornitore ORDER BY giorni) AS cumulata,
+                   SUM(n) OVER (PARTITION BY id_fornitore) AS totale
+            FROM consegne_fornitore
+            WHERE n > 0 AND id_fornitore {filtro}
+        ), percentili AS (
+            SELECT id_fornitore,
+                   MIN(giorni) FILTER (WHERE cumulata >= 0.5 * totale) AS mediana,
+                   MIN(giorni) FILTER (WHERE cumulata >= 0.9 * totale) AS p90
+            FROM cumulate
+            GROUP BY id_fornitore
+        )
+        SELECT s.id_fornitore, s.n_consegne, s.giorni_consegna, p.mediana, p.p90,
+               s.n_verificabili, s.n_puntuali, s.n_conferme, s.giorni_conferma
+        FROM statistiche_fornitori s
+        LEFT JOIN percentili p ON p.id_fornitore = s.id_fornitore
+        WHERE s.id_fornitore {filtro}
+    ''', {'ids': json.dumps(list(ids)) if ids is not None else None})
+    statistiche = {}
+    for id_f, n_consegne, giorni, mediana, p90, verificabili, puntuali, n_conferme, giorni_conferma in c.fetchall():
+        if not n_consegne and not n_conferme:
+            continue
+        statistiche[id_f] = StatisticheFornitore(
+            int(n_consegne),
+            giorni / n_consegne if n_consegne else None,
+            mediana, p90,
+            puntuali / verificabili if verificabili else None,
+            int(n_conferme),
+            giorni_conferma / n_conferme if n_conferme else None,
+        )
+    return statistiche
+
+
+# Scelta dei fornitori sull'intero fabbisogno
+#
+# Un fornitore usato costa costo_ordine (spedizione, gestione) piu' il valore
+# delle sue righe, portato almeno a ordine_minimo. Si parte dal prezzo minimo
+# per componente e si migliora finche' il costo totale scende: prima chiudendo,
+# aprendo o scambiando fornitori (ogni riga al piu' economico tra quelli usati),
+# poi spostando singole righe dove costano meno in quel momento.
+# Con una data di consegna richiesta si escludono i fornitori troppo lenti,
+# salvo che il componente non abbia alternative (la riga resta in ritardo).
+
+RigaAllocata = namedtuple('RigaAllocata', [
+    'id_componente', 'codice', 'nome', 'qty', 'id_fornitore', 'prezzo', 'prezzo_minimo', 'in_ritardo',
+])
+OrdineProposto = namedtuple('OrdineProposto', [
+    'id_fornitore', 'nome', 'n_righe', 'valore', 'costo_ordine', 'integrazione', 'totale', 'giorni_consegna',
+])
+AllocazioneFornitori = namedtuple('AllocazioneFornitori', [
+    'righe',             # [RigaAllocata] per fornitore e codice
+    'ordini',            # [OrdineProposto] per fornitore
+    'costo',             # totale con costi d'ordine e minimi
+    'costo_prezzo_minimo',  # stesso conteggio scegliendo solo il prezzo minimo
+    'senza_fornitore',   # {id_componente} senza alcun prezzo
+])
+
+
+def _costo_fornitori(costi, assegnazione, fissi, minimi):
+    righe = np.arange(len(assegnazione))
+    valori = np.bincount(assegnazione, weights=costi[righe, assegnazione], minlength=len(fissi))
+    aperti = np.bincount(assegnazione, minlength=len(fissi)) > 0
+    return float(np.sum(np.where(aperti, fissi + np.maximum(valori, minimi), 0)))
+
+
+# Costo totale di piu' assegnazioni insieme, una per colonna di `prove`
+def _costo_candidati(prove, costi_prove, fissi, minimi):
+    m = len(fissi)
+    k = prove.shape[1]
+    indici = (prove + np.arange(k) * m).ravel()
+    valori = np.bincount(indici, weights=costi_prove.ravel(), minlength=k * m).reshape(k, m)
+    aperti = np.bincount(indici, minlength=k * m).reshape(k, m) > 0
+    return np.where(aperti, fissi + np.maximum(valori, minimi), 0).sum(axis=1)
+
+
+# costi: matrice righe x fornitori (inf dove il fornitore non ha prezzo; ogni
+# riga ne ha almeno uno). Ritorna l'indice del fornitore scelto per ogni riga.
+def ottimizza_fornitori(costi, fissi, minimi, max_passate=100):
+    n, m = costi.shape
+    righe = np.arange(n)
+    assegnazione = np.argmin(costi, axis=1)
+    costo = _costo_fornitori(costi, assegnazione, fissi, minimi)
+    # Miglior prezzo e secondo miglior prezzo su tutti i fornitori, per le righe
+    # che chiudendo un fornitore non hanno alternative tra quelli usati
+    ordine = np.argsort(costi, axis=1)[:, :2]
+    if m == 1:
+        ordine = np.hstack([ordine, ordine])
+    costi_ordinati = costi[righe[:, None], ordine]
+    if m == 1:
+        costi_ordinati[:, 1] = np.inf
+
+    for _ in range(max_passate):
+        # Mosse sull'insieme dei fornitori usati: chiuderne uno, aprirne uno o
+        # scambiarli; ogni riga va al fornitore usato con il prezzo piu' basso
+        aperti = np.bincount(assegnazione, minlength=m) > 0
+        costi_aperti = np.where(aperti, costi, np.inf)
+        primo = np.argmin(costi_aperti, axis=1)
+        costo_primo = costi_aperti[righe, primo]
+        costi_aperti[righe, primo] = np.inf
+        secondo = np.argmin(costi_aperti, axis=1)
+        costo_secondo = costi_aperti[righe, secondo]
+        chiusi = np.flatnonzero(~aperti)
+        migliore = None
+        for f in [None, *np.flatnonzero(aperti)]:
+            if f is None:
+                senza_f, costo_senza_f = primo, costo_primo
+            else:
+                senza_f = np.where(primo == f, secondo, primo)
+                costo_senza_f = np.where(primo == f, costo_secondo, costo_primo)
+            # Una colonna per candidato: solo chiusura di f, oppure f scambiato con g
+            # (o g aperto in piu' se f e' None); le righe rimaste senza fornitore
+            # vanno al loro piu' economico in assoluto, aprendolo
+            prove = np.where(costi[:, chiusi] < costo_senza_f[:, None], chiusi, senza_f[:, None])
+            costi_prove = np.minimum(costi[:, chiusi], costo_senza_f[:, None])
+            if f is not None:
+                prove = np.hstack([senza_f[:, None], prove])
+                costi_prove = np.hstack([costo_senza_f[:, None], costi_prove])
+            if not prove.shape[1]:
+                continue
+            altro = (ordine[:, 0] == f).astype(int)
+            scoperte = ~np.isfinite(costi_prove)
+            prove = np.where(scoperte, ordine[righe, altro][:, None], prove)
+            costi_prove = np.where(scoperte, costi_ordinati[righe, altro][:, None], costi_prove)
+            totali = _costo_candidati(prove, costi_prove, fissi, minimi)
+            totali[~np.isfinite(costi_prove).all(axis=0)] = np.inf
+            k = int(np.argmin(totali))
+            if totali[k] < costo - 1e-9 and (migliore is None or totali[k] < migliore[0]):
+                migliore = (float(totali[k]), prove[:, k].copy())
+        if migliore is not None:
+            costo, assegnazione = migliore
+            continue
+
+        # Spostamento di singole righe, valutato per tutte insieme e applicato
+        # una alla volta: qui contano anche i minimi d'ordine non raggiunti
+        migliorato = False
+        valori = np.bincount(assegnazione, weights=costi[righe, assegnazione], minlength=m)
+        conteggi = np.bincount(assegnazione, minlength=m)
+        attuali = np.maximum(valori, minimi)
+        proprio = costi[righe, assegnazione]
+        risparmio = np.where(conteggi[assegnazione] == 1, fissi[assegnazione] + attuali[assegnazione],
+                             attuali[assegnazione] - np.maximum(valori[assegnazione] - proprio, minimi[assegnazione]))
+        aggiunta = np.where(conteggi > 0, np.maximum(valori + costi, minimi) - attuali,
+                            fissi + np.maximum(costi, minimi))
+        aggiunta[righe, assegnazione] = np.inf
+        delta = aggiunta.min(axis=1) - risparmio
+        for i in np.flatnonzero(delta < -1e-9)[np.argsort(delta[delta < -1e-9])]:
+            f = assegnazione[i]
+            attuali = np.maximum(valori, minimi)
+            if conteggi[f] == 1:
+                risparmio_i = fissi[f] + attuali[f]
+            else:
+                risparmio_i = attuali[f] - max(valori[f] - costi[i, f], minimi[f])
+            aggiunta_i = np.where(conteggi > 0, np.maximum(valori + costi[i], minimi) - attuali,
+                                  fissi + np.maximum(costi[i], minimi))
+            aggiunta_i[f] = np.inf
+            g = int(np.argmin(aggiunta_i))
+            if aggiunta_i[g] - risparmio_i < -1e-9:
+                valori[f] -= costi[i, f]
+                conteggi[f] -= 1
+                valori[g] += costi[i, g]
+                conteggi[g] += 1
+                assegnazione[i] = g
+                migliorato = True
+        costo = _costo_fornitori(costi, assegnazione, fissi, minimi)
+        if not migliorato:
+            break
+    return assegnazione
+
+
+# mancanti: {id_componente: qty}, prezzate allo scaglione del listino di oggi.
+# fisse: {id_componente: id_fornitore} gia' decise (l'anteprima confermata),
+# rispettate finche' il prezzo esiste.
+# giorni_disponibili: giorni entro cui deve arrivare la merce, None senza vincolo.
+def alloca_fornitori(c, mancanti, giorni_disponibili=None, fisse=None):
+    fisse = fisse or {}
+    prezzi = prezzi_listino(c, mancanti, datetime.now().strftime('%Y-%m-%d'))
+    id_componenti = sorted({id_comp for id_comp, _, _ in prezzi})
+    senza_fornitore = set(mancanti) - set(id_componenti)
+    if not prezzi:
+        return AllocazioneFornitori([], [], 0.0, 0.0, senza_fornitore)
+
+    c.execute('''
+        SELECT f.id, f.nome, f.costo_ordine, f.ordine_minimo
+        FROM fornitori f
+        WHERE f.id IN (SELECT value FROM json_each(?))
+        ORDER BY f.id
+    ''', (json.dumps(sorted({id_f for _, id_f, _ in prezzi})),))
+    fornitori = c.fetchall()
+    id_fornitori = [f[0] for f in fornitori]
+    fissi = np.array([f[2] or 0.0 for f in fornitori], dtype=float)
+    minimi = np.array([f[3] or 0.0 for f in fornitori], dtype=float)
+    tempi, predefinito = tempi_consegna(c)
+    giorni = np.array([tempi[f].giorni if f in tempi else predefinito for f in id_fornitori])
+
+    riga_di = {id_comp: i for i, id_comp in enumerate(id_componenti)}
+    colonna_di = {id_f: j for j, id_f in enumerate(id_fornitori)}
+    prezzo = np.full((len(id_componenti), len(id_fornitori)), np.inf)
+    for id_comp, id_f, p in prezzi:
+        if id_f in colonna_di:
+            prezzo[riga_di[id_comp], colonna_di[id_f]] = p
+    qty = np.array([mancanti[id_comp] for id_comp in id_componenti], dtype=float)
+    costi = prezzo * qty[:, None]
+
+    # Fornitori esclusi: troppo lenti (se c'e' un'alternativa) o diversi da quello gia' scelto
+    ammessi = np.isfinite(costi)
+    if giorni_disponibili is not None:
+        in_tempo = ammessi & (giorni <= giorni_disponibili)
+        ammessi = np.where(in_tempo.any(axis=1)[:, None], in_tempo, ammessi)
+    for id_comp, id_f in fisse.items():
+        if id_comp in riga_di and id_f in colonna_di and np.isfinite(costi[riga_di[id_comp], colonna_di[id_f]]):
+            ammessi[riga_di[id_comp]] = False
+            ammessi[riga_di[id_comp], colonna_di[id_f]] = True
+    costi_ammessi = np.where(ammessi, costi, np.inf)
+
+    assegnazione = ottimizza_fornitori(costi_ammessi, fissi, minimi)
+    righe = np.arange(len(id_componenti))
+    costo = _costo_fornitori(costi, assegnazione, fissi, minimi)
+    costo_prezzo_minimo = _costo_fornitori(costi, np.argmin(costi, axis=1), fissi, minimi)
+
+    c.execute("SELECT id, codice, nome FROM componenti WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps(id_componenti),))
+    anagrafica = {id_comp: (codice, nome) for id_comp, codice, nome in c.fetchall()}
+    in_ritardo = giorni[assegnazione] > giorni_disponibili if giorni_disponibili is not None \
+        else np.zeros(len(righe), dtype=bool)
+    allocate = sorted((
+        RigaAllocata(id_comp, *anagrafica.get(id_comp, (None, None)), float(qty[i]),
+                     id_fornitori[assegnazione[i]], float(prezzo[i, assegnazione[i]]),
+                     float(prezzo[i].min()), bool(in_ritardo[i]))
+        for i, id_comp in enumerate(id_componenti)
+    ), key=lambda r: (r.id_fornitore, r.codice or '', r.id_componente))
+
+    valori = np.bincount(assegnazione, weights=costi[righe, assegnazione], minlength=len(id_fornitori))
+    conteggi = np.bincount(assegnazione, minlength=len(id_fornitori))
+    ordini = [
+        OrdineProposto(id_fornitori[j], fornitori[j][1], int(conteggi[j]), float(valori[j]), float(fissi[j]),
+                       float(max(minimi[j] - valori[j], 0.0)),
+                       float(fissi[j] + max(valori[j], minimi[j])), int(giorni[j]))
+        for j in np.flatnonzero(conteggi)
+    ]
+    return AllocazioneFornitori(allocate, ordini, costo, costo_prezzo_minimo, senza_fornitore)
+
+
+# Piano approvvigionamenti a periodi
+#
+# Le produzioni dell'orizzonte sono esplose e il lordo di ogni componente e'
+# sommato per periodo (settimana o mese) in una matrice componenti x periodi.
+# Giacenza e righe aperte (attese alla data confermata, o alla data richiesta
+# piu' il tempo di consegna del fornitore) coprono il lordo in ordine di tempo:
+# con le somme cumulate lungo i periodi, la mancanza cumulata e'
+# max(0, lordo - giacenza - arrivi) e il suo massimo progressivo e' quanto
+# deve essere arrivato entro ogni periodo. Gli ordini pianificati sono gli
+# incrementi, anticipati del tempo di consegna del fornitore piu' economico.
+# Il tempo di consegna e' la mediana dei giorni tra data richiesta e data
+# consegna nello storico del fornitore, letta dall'istogramma delle consegne.
+
+PIANO_MESI = 12
+PIANO_PERIODI = {'settimana': 'W-SUN', 'mese': 'M'}
+TEMPO_CONSEGNA_PREDEFINITO = 14  # giorni, per i fornitori senza storico
+PIANO_RIGHE_PAGINA = 500  # righe mostrate nella pagina; il JSON le ha tutte
+
+TempoConsegna = namedtuple('TempoConsegna', ['giorni', 'campioni'])
+OrdinePianificato = namedtuple('OrdinePianificato', [
+    'id_componente', 'codice', 'nome', 'id_fornitore', 'data_ordine', 'data_fabbisogno', 'qty', 'in_ritardo',
+])
+PianoApprovvigionamenti = namedtuple('PianoApprovvigionamenti', [
+    'periodi',        # [pd.Period] dell'orizzonte
+    'ordini',         # [OrdinePianificato] per data ordine
+    'matrice',        # DataFrame codice x periodo dell'ordine, qty da ordinare
+    'tempi_consegna', # {id_fornitore: TempoConsegna}
+    'predefinito',    # giorni per i fornitori senza storico
+])
+
+
+# ({id_fornitore: TempoConsegna}, giorni per i fornitori senza storico)
+def tempi_consegna(c):
+    tempi = {id_f: TempoConsegna(s.mediana, s.n_consegne)
+             for id_f, s in statistiche_fornitori(c).items() if s.n_consegne}
+    # Mediana complessiva: istogramma sommato su tutti i fornitori
+    c.execute('''
+        SELECT MIN(giorni) FROM (
+            SELECT giorni, SUM(SUM(n)) OVER (ORDER BY giorni) AS cumulata, SUM(SUM(n)) OVER () AS totale
+            FROM consegne_fornitore
+            WHERE n > 0
+            GROUP BY giorni
+        )
+        WHERE cumulata >= 0.5 * totale
+    ''')
+    mediana = c.fetchone()[0]
+    return tempi, mediana if mediana is not None else TEMPO_CONSEGNA_PREDEFINITO
+
+
+def piano_approvvigionamenti(c, dal, mesi=PIANO_MESI, periodo='settimana'):
+    frequenza = PIANO_PERIODI[periodo]
+    inizio = pd.Timestamp(dal)
+    fine = inizio + pd.DateOffset(months=mesi)
+    periodi = pd.period_range(inizio, fine - pd.Timedelta(days=1), freq=frequenza)
+    tempi, predefinito = tempi_consegna(c)
+
+    c.execute('''
+        SELECT id_distinta, qty_prodotta, data_produzione
+        FROM produzioni
+        WHERE data_produzione >= ? AND data_produzione < ?
+    ''', (inizio.strftime('%Y-%m-%d'), fine.strftime('%Y-%m-%d')))
+    produzioni = pd.DataFrame(c.fetchall(), columns=['id_distinta', 'qty', 'data'])
+    vuoto = PianoApprovvigionamenti(list(periodi), [], pd.DataFrame(columns=list(periodi)), tempi, predefinito)
+    if produzioni.empty:
+        return vuoto
+
+    # Lordo: produzioni x fabbisogno unitario delle distinte, sommato per (componente, periodo)
+    esplosione = esplodi_distinta(c, sorted(produzioni['id_distinta'].unique().tolist()))
+    unitari = pd.DataFrame(
+        [(id_d, id_comp, qty) for id_d in produzioni['id_distinta'].unique().tolist()
+         for id_comp, qty in esplosione.fabbisogni[id_d].items()],
+        columns=['id_distinta', 'id_componente', 'qty_unitaria'])
+    lordo = produzioni.merge(unitari, on='id_distinta')
+    if lordo.empty:
+        return vuoto
+    lordo['lordo'] = lordo['qty'] * lordo['qty_unitaria']
+    lordo['periodo'] = pd.to_datetime(lordo['data']).dt.to_period(frequenza)
+    G = lordo.pivot_table(index='id_componente', columns='periodo', values='lordo', aggfunc='sum', fill_value=0)
+    G = G.reindex(columns=periodi, fill_value=0)
+    componenti = G.index.tolist()
+    parametro = json.dumps(componenti)
+
+    c.execute('''
+        SELECT id_componente, SUM(giacenza)
+        FROM magazzino
+        WHERE id_componente IN (SELECT value FROM json_each(?))
+        GROUP BY id_componente
+    ''', (parametro,))
+    giacenze = pd.Series(dict(c.fetchall()), dtype=float).reindex(componenti, fill_value=0).to_numpy()
+
+    # Arrivi attesi delle righe aperte; quelli gia' in ritardo contano dal primo periodo
+    c.execute('''
+        SELECT r.id_componente, r.qty, o.id_fornitore, NULLIF(r.data_confermata, ''), r.data_richiesta
+        FROM righe_ordine_fornitore r
+        JOIN ordini_fornitore o ON o.id = r.id_ordine
+        WHERE r.id_componente IN (SELECT value FROM json_each(?))
+          AND COALESCE(r.data_consegna, '') = '' AND r.qty > 0
+    ''', (parametro,))
+    aperti = pd.DataFrame(c.fetchall(), columns=['id_componente', 'qty', 'id_fornitore', 'confermata', 'richiesta'])
+    R = np.zeros(G.shape)
+    if not aperti.empty:
+        ritardo = aperti['id_fornitore'].map(lambda f: tempi[f].giorni if f in tempi else predefinito)
+        attesa = pd.to_datetime(aperti['confermata'], errors='coerce').fillna(
+            pd.to_datetime(aperti['richiesta'], errors='coerce') + pd.to_timedelta(ritardo, unit='D'))
+        attesa = attesa.fillna(inizio).clip(lower=inizio)
+        aperti['periodo'] = attesa.dt.to_period(frequenza)
+        arrivi = aperti.pivot_table(index='id_componente', columns='periodo', values='qty', aggfunc='sum', fill_value=0)
+        R = arrivi.reindex(index=componenti, columns=periodi, fill_value=0).to_numpy(dtype=float)
+
+    # Quanto deve essere arrivato entro ogni periodo, poi gli incrementi
+    mancanza = np.cumsum(G.to_numpy(dtype=float), axis=1) - giacenze[:, np.newaxis] - np.cumsum(R, axis=1)
+    coperto = np.maximum.accumulate(np.maximum(mancanza, 0), axis=1)
+    da_ordinare = np.diff(coperto, axis=1, prepend=0)
+    righe, colonne = np.nonzero(da_ordinare > 1e-9)
+
+    componenti = np.array(componenti)
+    fornitori = fornitori_piu_economici(c, componenti[np.unique(righe)].tolist())
+    c.execute("SELECT id, codice, nome FROM componenti WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps(componenti[np.unique(righe)].tolist()),))
+    anagrafica = {riga[0]: riga[1:] for riga in c.fetchall()}
+
+    piano = pd.DataFrame({
+        'id_componente': componenti[righe],
+        'data_fabbisogno': pd.Series(periodi[colonne].start_time).clip(lower=inizio),
+        'qty': da_ordinare[righe, colonne],
+    })
+    piano['id_fornitore'] = piano['id_componente'].map(fornitori)
+    giorni = piano['id_fornitore'].map(lambda f: tempi[f].giorni if f in tempi else predefinito)
+    piano['data_ordine'] = piano['data_fabbisogno'] - pd.to_timedelta(giorni, unit='D')
+    piano['in_ritardo'] = piano['data_ordine'] < inizio
+    piano = piano.sort_values(['data_ordine', 'id_componente'])
+
+    id_componenti = piano['id_componente'].tolist()
+    ordini = list(map(OrdinePianificato._make, zip(
+        id_componenti,
+        (anagrafica[id_comp][0] for id_comp in id_componenti),
+        (anagrafica[id_comp][1] for id_comp in id_componenti),
+        (fornitori.get(id_comp) for id_comp in id_componenti),
+        piano['data_ordine'].dt.date.tolist(),
+        piano['data_fabbisogno'].dt.date.tolist(),
+        piano['qty'].tolist(),
+        piano['in_ritardo'].tolist(),
+    )))
+    piano['codice'] = [anagrafica[id_comp][0] or str(id_comp) for id_comp in id_componenti]
+    piano['periodo'] = piano['data_ordine'].clip(lower=inizio).dt.to_period(frequenza)
+    matrice = piano.pivot_table(index='codice', columns='periodo', values='qty', aggfunc='sum', fill_value=0)
+    return PianoApprovvigionamenti(list(periodi), ordini, matrice.reindex(columns=periodi, fill_value=0),
+                                   tempi, predefinito)
+
+
+@app.route('/piano-approvvigionamenti')
+def piano_approvvigionamenti_pagina():
+    conn = get_db()
+    c = conn.cursor()
+    dal = request.args.get('dal') or datetime.now().strftime('%Y-%m-%d')
+    mesi = min(max(request.args.get('mesi', PIANO_MESI, type=int), 1), 36)
+    periodo = request.args.get('periodo', 'settimana')
+    if periodo not in PIANO_PERIODI:
+        periodo = 'settimana'
+    try:
+        pd.Timestamp(dal)
+    except ValueError:
+        return "Data non valida", 400
+
+    inizio = time.perf_counter()
+    piano = piano_approvvigionamenti(c, dal, mesi, periodo)
+    tempi = [('piano', time.perf_counter() - inizio)]
+
+    c.execute("SELECT id, nome FROM fornitori ORDER BY nome")
+    nomi_fornitori = dict(c.fetchall())
+    if request.accept_mimetypes.best == 'application/json':
+        risposta = jsonify(
+            periodi=[str(p) for p in piano.periodi],
+            tempi_consegna={id_f: t._asdict() for id_f, t in piano.tempi_consegna.items()},
+            tempo_predefinito=piano.predefinito,
+            ordini=[dict(o._asdict(), data_ordine=o.data_ordine.isoformat(),
+                         data_fabbisogno=o.data_fabbisogno.isoformat()) for o in piano.ordini],
+        )
+    else:
+        risposta = Response(render_template(
+            "piano_approvvigionamenti.html", piano=piano, fornitori=nomi_fornitori,
+            dal=dal, mesi=mesi, periodo=periodo, periodi_disponibili=list(PIANO_PERIODI),
+            righe_pagina=PIANO_RIGHE_PAGINA))
+    risposta.headers['Server-Timing'] = server_timing(tempi)
+    return risposta
+
+
+# Valore dell'header Server-Timing da una lista di (fase, secondi) o (fase, secondi, descrizione)
+def server_timing(tempi):
+    return ", ".join(f"{fase};dur={voce[0] * 1000:.2f}" + (f';desc="{voce[1]}"' if len(voce) > 1 else '')
+                     for fase, *voce in tempi)
 
 
 @app.route('/ordine-fornitore/<int:id_ordine>/modifica', methods=['GET', 'POST'])
 def modifica_ordine_fornitore(id_ordine):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'POST':
-        numero_ordine = request.form['numero_ordine']
+        numero_ordine = request.form['numero_ordine'].strip()
         riferimento_oc = request.form['riferimento_oc']
         data_ordine = request.form['data_ordine']
 
+        # I numeri nel formato automatico li assegna solo il contatore
+        c.execute("SELECT numero_ordine FROM ordini_fornitore WHERE id = ?", (id_ordine,))
+        attuale = c.fetchone()
+        if attuale and numero_ordine != attuale[0] and NUMERO_ORDINE_AUTOMATICO.fullmatch(numero_ordine):
+            return f"I numeri come {numero_ordine} sono assegnati automaticamente", 400
+
         # Aggiorna testata ordine
-        c.execute('''
-            UPDATE ordini_fornitore
-            SET numero_ordine = ?, riferimento_oc = ?, data_ordine = ?
-            WHERE id = ?
-        ''', (numero_ordine, riferimento_oc, data_ordine, id_ordine))
+        try:
+            c.execute('''
+                UPDATE ordini_fornitore
+                SET numero_ordine = ?, riferimento_oc = ?, data_ordine = ?
+                WHERE id = ?
+            ''', (numero_ordine, riferimento_oc, data_ordine, id_ordine))
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            return f"Il numero d'ordine {numero_ordine} e' gia' usato", 400
 
         # Aggiorna righe ordine
         righe = request.form.getlist('riga_id')
@@ -671,7 +5059,6 @@ def modifica_ordine_fornitore(id_ordine):
             ''', (qtys[i], date_richiesta[i], date_confermata[i], date_consegna[i], righe[i]))
 
         conn.commit()
-        conn.close()
         return redirect(url_for('dettaglio_ordine_fornitore', id_ordine=id_ordine))
 
     # GET: carica dati ordine e righe
@@ -689,21 +5076,19 @@ def modifica_ordine_fornitore(id_ordine):
     ''', (id_ordine,))
     righe = c.fetchall()
 
-    conn.close()
     return render_template("modifica_ordine_fornitore.html", id_ordine=id_ordine, testata=testata, righe=righe)
 
 @app.route('/ordine-fornitore/<int:id_ordine>/riga/<int:id_riga>/elimina', methods=['POST'])
 def elimina_riga_ordine(id_ordine, id_riga):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("DELETE FROM righe_ordine_fornitore WHERE id = ?", (id_riga,))
     conn.commit()
-    conn.close()
     return redirect(url_for('modifica_ordine_fornitore', id_ordine=id_ordine))
 
 @app.route('/ordine-fornitore/<int:id_ordine>/elimina', methods=['POST'])
 def elimina_ordine_fornitore(id_ordine):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
     # Elimina righe ordine collegate
@@ -712,67 +5097,65 @@ def elimina_ordine_fornitore(id_ordine):
     c.execute("DELETE FROM ordini_fornitore WHERE id = ?", (id_ordine,))
 
     conn.commit()
-    conn.close()
     return redirect(url_for('elenco_ordini_fornitore'))
 
 @app.route('/ordine-fornitore/manuale', methods=['GET', 'POST'])
 def crea_ordine_manuale():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'POST':
-        # Nuovo fornitore o esistente
-        id_fornitore = request.form.get('fornitore_esistente')
-        if id_fornitore == 'nuovo':
-            nome = request.form['nome_nuovo']
-            email = request.form['email_nuovo']
-            telefono = request.form['telefono_nuovo']
-            c.execute('INSERT INTO fornitori (nome, email, telefono) VALUES (?, ?, ?)', (nome, email, telefono))
-            id_fornitore = c.lastrowid
-        else:
-            id_fornitore = int(id_fornitore)
-
-        numero_ordine = f"ORD-{datetime.now().strftime('%Y%m%d%H%M%S')}"
         data_ordine = datetime.now().strftime('%Y-%m-%d')
         riferimento_oc = request.form['riferimento_oc']
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Nuovo fornitore o esistente
+            id_fornitore = request.form.get('fornitore_esistente')
+            if id_fornitore == 'nuovo':
+                nome = request.form['nome_nuovo']
+                email = request.form['email_nuovo']
+                telefono = request.form['telefono_nuovo']
+                c.execute('INSERT INTO fornitori (nome, email, telefono) VALUES (?, ?, ?)', (nome, email, telefono))
+                id_fornitore = c.lastrowid
+            else:
+                id_fornitore = int(id_fornitore)
 
-        # Crea ordine
-        c.execute('''
-            INSERT INTO ordini_fornitore (numero_ordine, id_fornitore, data_ordine, riferimento_oc)
-            VALUES (?, ?, ?, ?)
-        ''', (numero_ordine, id_fornitore, data_ordine, riferimento_oc))
-        id_ordine = c.lastrowid
-
-        # Righe ordine
-        componenti = request.form.getlist('componente[]')
-        qtys = request.form.getlist('qty[]')
-        prezzi = request.form.getlist('prezzo[]')
-        data_richiesta = data_ordine
-
-        for comp_id, qty, prezzo in zip(componenti, qtys, prezzi):
-            if not comp_id or int(qty) <= 0:
-                continue
+            # Crea ordine
+            numero_ordine, = alloca_numeri_ordine(c, data_ordine)
             c.execute('''
-                INSERT INTO righe_ordine_fornitore (id_ordine, id_componente, qty, data_richiesta)
+                INSERT INTO ordini_fornitore (numero_ordine, id_fornitore, data_ordine, riferimento_oc)
                 VALUES (?, ?, ?, ?)
-            ''', (id_ordine, int(comp_id), int(qty), data_richiesta))
-            # salva anche il prezzo
-            c.execute('''
-                INSERT OR REPLACE INTO prezzi_fornitori (id_componente, id_fornitore, prezzo)
-                VALUES (?, ?, ?)
-            ''', (int(comp_id), int(id_fornitore), float(prezzo)))
+            ''', (numero_ordine, id_fornitore, data_ordine, riferimento_oc))
+            id_ordine = c.lastrowid
 
-        conn.commit()
-        conn.close()
+            # Righe ordine
+            componenti = request.form.getlist('componente[]')
+            qtys = request.form.getlist('qty[]')
+            prezzi = request.form.getlist('prezzo[]')
+            data_richiesta = data_ordine
+
+            for comp_id, qty, prezzo in zip(componenti, qtys, prezzi):
+                if not comp_id or int(qty) <= 0:
+                    continue
+                c.execute('''
+                    INSERT INTO righe_ordine_fornitore (id_ordine, id_componente, qty, data_richiesta)
+                    VALUES (?, ?, ?, ?)
+                ''', (id_ordine, int(comp_id), int(qty), data_richiesta))
+                # Il prezzo concordato entra nel listino da oggi, solo se diverso da quello in vigore
+                prezzo = float(prezzo)
+                in_vigore, = prezzi_effettivi(c, [(int(comp_id), id_fornitore, int(qty))], data_ordine)
+                if in_vigore is None or not math.isclose(in_vigore, prezzo):
+                    concorda_prezzo(c, int(comp_id), id_fornitore, int(qty), prezzo, data_ordine)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         return redirect(url_for('elenco_ordini_fornitore'))
 
-    # GET: carica fornitori esistenti e componenti
+    # GET: carica fornitori esistenti; i componenti si cercano con /api/componenti/cerca
     c.execute("SELECT id, nome FROM fornitori")
     fornitori = c.fetchall()
-    c.execute("SELECT id, nome FROM componenti")
-    componenti = c.fetchall()
-    conn.close()
-    return render_template("ordine_fornitore_manuale.html", fornitori=fornitori, componenti=componenti)
+    return render_template("ordine_fornitore_manuale.html", fornitori=fornitori)
     
 @app.route('/nuovo-cliente', methods=['GET', 'POST'])
 def nuovo_cliente():
@@ -785,19 +5168,19 @@ def nuovo_cliente():
         persona_rif = request.form['persona_riferimento']
         note = request.form['note']
 
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         c = conn.cursor()
         c.execute('''
             INSERT INTO clienti (ragione_sociale, indirizzo, email, telefono, iban, persona_riferimento, note)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (ragione_sociale, indirizzo, email, telefono, iban, persona_rif, note))
         conn.commit()
-        conn.close()
-        return redirect(url_for('lista_clienti'))  # oppure altra pagina di conferma
+        return redirect(url_for('dashboard'))
 
     return render_template('nuovo_cliente.html')
 
 
 if __name__ == '__main__':
+    prepara_db(DB_NAME)
     app.run(host='0.0.0.0', port=5000, debug=True)
 
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_6  # noqa: E402
+
+
+# Database, allegati ed export in una cartella temporanea: il database non
+# esiste ancora, lo crea la prima connessione (o genera_database)
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    percorso = str(tmp_path / 'test.db')
+    monkeypatch.setattr(main_6, 'DB_NAME', percorso)
+    monkeypatch.setattr(main_6, 'BLOB_FOLDER', str(tmp_path / 'allegati'))
+    monkeypatch.setattr(main_6, 'EXPORT_FOLDER', str(tmp_path / 'export'))
+    os.makedirs(main_6.EXPORT_FOLDER)
+    yield percorso
+    main_6.chiudi_pool()
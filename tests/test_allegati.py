@@ -0,0 +1,34 @@
+import hashlib
+import os
+
+import main_6
+
+
+# La migrazione 9 porta i vecchi upload nell'archivio con lo stesso formato
+# usato dai caricamenti (percorso_blob, riga in allegati, contatore riferimenti)
+def test_migrazione_allegati(database, tmp_path, monkeypatch):
+    main_6.init_db(database)
+    monkeypatch.setattr(main_6, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    os.makedirs(main_6.UPLOAD_FOLDER)
+    contenuto = b"0\nSECTION\n" * 1000
+    with open(os.path.join(main_6.UPLOAD_FOLDER, 'telaio.dxf'), 'wb') as f:
+        f.write(contenuto)
+
+    conn = main_6._apri_connessione(database)
+    c = conn.cursor()
+    c.execute("INSERT INTO distinte (codice, descrizione) VALUES ('D1', '')")
+    c.executemany("INSERT INTO componenti (id_distinta, nome, file) VALUES (?, ?, ?)",
+                  [(c.lastrowid, 'Telaio', 'telaio.dxf'), (c.lastrowid, 'Manca', 'assente.dxf')])
+    c.execute("UPDATE componenti SET nome_file = NULL")
+    main_6._migrazione_allegati(c)
+
+    hash_file = hashlib.sha256(contenuto).hexdigest()
+    with open(main_6.percorso_blob(hash_file), 'rb') as f:
+        assert f.read() == contenuto
+    c.execute("SELECT hash, dimensione, riferimenti FROM allegati")
+    assert c.fetchall() == [(hash_file, len(contenuto), 1)]
+    c.execute("SELECT nome, file, nome_file FROM componenti ORDER BY id")
+    assert c.fetchall() == [('Telaio', hash_file, 'telaio.dxf'), ('Manca', None, 'assente.dxf')]
+    assert os.listdir(os.path.join(main_6.BLOB_FOLDER, 'tmp')) == []
+    conn.rollback()
+    conn.close()
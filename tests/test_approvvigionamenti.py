@@ -0,0 +1,16 @@
+import sqlite3
+
+import benchmark
+import main_6
+
+
+def test_pianifica_quantita_intera(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    codice = sqlite3.connect(database).execute("SELECT codice FROM distinte WHERE id = 1").fetchone()[0]
+    client = main_6.app.test_client()
+    assert client.post('/mrp', data={'azione': 'pianifica', 'codice': codice, 'qty': '2,5'}).status_code == 400
+    assert client.post('/mrp', data={'azione': 'pianifica', 'codice': codice, 'qty': '3,0'}).status_code == 302
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT qty_prodotta, typeof(qty_prodotta) FROM produzioni "
+                        "WHERE id_distinta = 1 ORDER BY id DESC LIMIT 1").fetchone() == (3, 'integer')
+    conn.close()
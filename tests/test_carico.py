@@ -0,0 +1,12 @@
+import benchmark
+
+
+# Lettori concorrenti mentre uno scrittore genera ordini: nessuna richiesta
+# fallisce (database bloccato, connessione condivisa tra thread) e
+# letture e scritture avanzano entrambe
+def test_lettori_e_scrittore_concorrenti(database):
+    benchmark.genera_database(database, 50, 1000, n_ordini=100)
+    letture, ordini, errori = benchmark.carico(database, 50, 2, 4)
+    assert errori == 0
+    assert letture > 0
+    assert ordini > 0
@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+
+import benchmark
+import main_6
+
+
+def modulo_componente(**campi):
+    modulo = {'macrozona': 'Telaio', 'nome': 'Piastra', 'materiale': 'S235', 'spessore': '3',
+              'qty': '2', 'lavorazioni': '', 'costo': '10', 'tipo': 'Produzione'}
+    modulo.update(campi)
+    return modulo
+
+
+# Una sottodistinta inesistente e' un errore di validazione, non un ciclo
+def test_sottodistinta_inesistente(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    client = main_6.app.test_client()
+    risposta = client.post('/distinta/1/aggiungi-componente', data=modulo_componente(sottodistinta='NON-ESISTE'))
+    assert risposta.status_code == 400
+    assert 'inesistente' in risposta.get_data(as_text=True)
+    c = sqlite3.connect(database).cursor()
+    c.execute("SELECT COUNT(*) FROM componenti WHERE nome = 'Piastra'")
+    assert c.fetchone()[0] == 0
+    with pytest.raises(main_6.SottodistintaInesistente) as errore:
+        main_6.leggi_sottodistinta(c, modulo_componente(sottodistinta='NON-ESISTE'))
+    assert not isinstance(errore.value, main_6.DistintaCiclica)
+
+
+def test_export_excel_distinte_non_valide(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    client = main_6.app.test_client()
+    assert client.get('/distinte/export_excel?distinte=1,abc').status_code == 400
+    assert client.get('/distinte/export_excel?distinte=1,2').status_code == 200
+
+
+# Il link "Stampa PDF" in GET mostra la pagina d'attesa senza avviare job:
+# li avvia solo la POST della pagina
+def test_export_pdf_get_non_avvia_job(database, monkeypatch):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    avviati = []
+    monkeypatch.setattr(main_6, 'avvia_export', lambda *argomenti: avviati.append(argomenti))
+    risposta = main_6.app.test_client().get('/distinta/1/export_pdf')
+    assert risposta.status_code == 200
+    assert '/distinta/1/export_pdf/job' in risposta.get_data(as_text=True)
+    assert avviati == []
+
+
+# Con l'ordinamento per codice si ricalcolano solo i riepiloghi della pagina,
+# e i valori mostrati sono gli stessi del ricalcolo completo
+def test_elenco_ricalcola_solo_la_pagina(database):
+    benchmark.genera_database(database, 200, 2000, n_ordini=5)
+    conn = main_6._apri_connessione(database)
+    c = conn.cursor()
+    c.execute("DELETE FROM riepilogo_costi")
+    conn.commit()
+    righe, n_distinte = main_6.elenco_distinte(c, per_pagina=20)
+    assert n_distinte == 200 and len(righe) == 20
+    c.execute("SELECT COUNT(*) FROM riepilogo_costi")
+    assert c.fetchone()[0] == 20
+
+    per_costo, _ = main_6.elenco_distinte(c, ordina='costo', direzione='desc', per_pagina=20)
+    c.execute("SELECT COUNT(*) FROM riepilogo_costi")
+    assert c.fetchone()[0] == 200
+    assert [riga[3] for riga in per_costo] == sorted((riga[3] for riga in per_costo), reverse=True)
+    assert main_6.elenco_distinte(c, per_pagina=20)[0] == righe
+    conn.close()
+
+
+# Dentro la transazione del chiamante non apre ne' chiude transazioni
+def test_riepiloghi_nella_transazione_del_chiamante(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    conn = main_6._apri_connessione(database)
+    conn.execute("DELETE FROM riepilogo_costi")
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    assert set(main_6.calcola_riepiloghi(conn, [1, 2])) >= {1, 2}
+    assert conn.in_transaction
+    conn.rollback()
+    assert conn.execute("SELECT COUNT(*) FROM riepilogo_costi").fetchone()[0] == 0
+    conn.close()
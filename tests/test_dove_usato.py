@@ -0,0 +1,94 @@
+import random
+import sqlite3
+
+import pytest
+
+import main_6
+
+
+# Chiusura per enumerazione dei percorsi: {(discendente, antenato): (percorsi, moltiplicatore)}
+def chiusura_attesa(legami):
+    figli = {}
+    for padre, figlio, qty in legami:
+        figli.setdefault(padre, []).append((figlio, qty or 0))
+
+    def discendenti(padre):
+        trovati = {}
+        for figlio, qty in figli.get(padre, []):
+            percorsi, moltiplicatore = trovati.get(figlio, (0, 0.0))
+            trovati[figlio] = (percorsi + 1, moltiplicatore + qty)
+            for nipote, (p, m) in discendenti(figlio).items():
+                percorsi, moltiplicatore = trovati.get(nipote, (0, 0.0))
+                trovati[nipote] = (percorsi + p, moltiplicatore + qty * m)
+        return trovati
+
+    return {(d, a): valori for a in {padre for padre, _, _ in legami} for d, valori in discendenti(a).items()}
+
+
+def legami_diretti(righe):
+    return [(padre, figlio, qty) for _, padre, figlio, qty in righe if figlio is not None]
+
+
+def ha_ciclo(legami):
+    figli = {}
+    for padre, figlio, _ in legami:
+        figli.setdefault(padre, set()).add(figlio)
+
+    def raggiungibili(nodo, visti):
+        for figlio in figli.get(nodo, ()):
+            if figlio not in visti:
+                visti.add(figlio)
+                raggiungibili(figlio, visti)
+        return visti
+
+    return any(nodo in raggiungibili(nodo, set()) for nodo in figli)
+
+
+# Inserimenti, modifiche e cancellazioni casuali di componenti con sottodistinta:
+# dopo ogni scrittura legami_distinte coincide con la chiusura calcolata da zero
+@pytest.mark.parametrize('seed', range(5))
+def test_chiusura_come_forza_bruta(database, seed):
+    rnd = random.Random(seed)
+    main_6.init_db(database)
+    conn = sqlite3.connect(database)
+    n_distinte = 8
+    conn.executemany("INSERT INTO distinte (id, codice, descrizione) VALUES (?, ?, '')",
+                     [(i, f"D{i}") for i in range(1, n_distinte + 1)])
+    for _ in range(150):
+        componenti = conn.execute("SELECT id, id_distinta, id_sottodistinta, qty FROM componenti").fetchall()
+        operazione = rnd.choice(['inserisci', 'inserisci', 'modifica', 'elimina'] if componenti else ['inserisci'])
+        padre, figlio = rnd.randint(1, n_distinte), rnd.choice([None, *range(1, n_distinte + 1)])
+        qty = rnd.choice([None, 1, 2, 3, 0.5])
+        try:
+            if operazione == 'inserisci':
+                legami = componenti + [(None, padre, figlio, qty)]
+                conn.execute("INSERT INTO componenti (id_distinta, id_sottodistinta, qty, tipo) "
+                             "VALUES (?, ?, ?, 'Produzione')", (padre, figlio, qty))
+            elif operazione == 'modifica':
+                id_c, vecchio_padre, vecchio_figlio, vecchia_qty = rnd.choice(componenti)
+                nuovo = (id_c, rnd.choice([vecchio_padre, padre]), rnd.choice([vecchio_figlio, figlio]),
+                         rnd.choice([vecchia_qty, qty]))
+                legami = [r for r in componenti if r[0] != id_c] + [nuovo]
+                conn.execute("UPDATE componenti SET id_distinta = ?, id_sottodistinta = ?, qty = ? WHERE id = ?",
+                             (*nuovo[1:], id_c))
+            else:
+                id_c = rnd.choice(componenti)[0]
+                legami = [r for r in componenti if r[0] != id_c]
+                conn.execute("DELETE FROM componenti WHERE id = ?", (id_c,))
+            conn.commit()
+        except sqlite3.DatabaseError as e:
+            conn.rollback()
+            assert 'Ciclo' in str(e)
+            assert ha_ciclo(legami_diretti(legami))
+            continue
+
+        legami = legami_diretti(legami)
+        assert not ha_ciclo(legami)
+        attesa = chiusura_attesa(legami)
+        salvata = {(d, a): (p, m) for d, a, p, m in
+                   conn.execute("SELECT id_discendente, id_antenato, percorsi, moltiplicatore FROM legami_distinte")}
+        assert salvata.keys() == attesa.keys()
+        for coppia, (percorsi, moltiplicatore) in attesa.items():
+            assert salvata[coppia][0] == percorsi
+            assert salvata[coppia][1] == pytest.approx(moltiplicatore, abs=1e-9)
+    conn.close()
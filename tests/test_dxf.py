@@ -0,0 +1,86 @@
+import io
+import math
+import os
+import random
+import sqlite3
+
+import pytest
+
+import benchmark
+import main_6
+
+
+def dxf(entita):
+    return io.BytesIO(benchmark.DXF_RETTANGOLO.format("".join(entita)).encode('ascii'))
+
+
+def rettangolo_chiuso(x, y, w, h):
+    return (f"0\nLWPOLYLINE\n90\n4\n70\n1\n10\n{x}\n20\n{y}\n10\n{x + w}\n20\n{y}\n"
+            f"10\n{x + w}\n20\n{y + h}\n10\n{x}\n20\n{y + h}\n")
+
+
+def rettangolo_a_linee(x, y, w, h):
+    vertici = [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+    # Ordine e verso dei segmenti mescolati: la concatenazione li deve ritrovare
+    linee = [(a, b) if i % 2 else (b, a) for i, (a, b) in enumerate(zip(vertici, vertici[1:] + vertici[:1]))]
+    return [benchmark.DXF_LINEA.format(*a, *b) for a, b in reversed(linee)]
+
+
+def test_pezzi_e_fori():
+    entita = []
+    for i in range(30):
+        x, y = (i % 6) * 50, (i // 6) * 50
+        entita += rettangolo_a_linee(x, y, 40, 30) if i % 2 else [rettangolo_chiuso(x, y, 40, 30)]
+        entita.append(f"0\nCIRCLE\n10\n{x + 20}\n20\n{y + 15}\n40\n5\n")
+    geometria = main_6.analizza_dxf(dxf(entita))
+    assert (geometria.n_pezzi, geometria.n_fori, geometria.n_entita) == (30, 30, 15 + 15 * 4 + 30)
+    assert (geometria.min_x, geometria.min_y, geometria.larghezza, geometria.altezza) == (0, 0, 290, 230)
+    # I cerchi sono poligoni inscritti di DXF_PASSO_ARCO
+    assert geometria.area == pytest.approx(30 * (40 * 30 - math.pi * 25), rel=1e-3)
+    assert geometria.lunghezza_taglio == pytest.approx(30 * (140 + 2 * math.pi * 5))
+
+
+# Pezzo con un foro che contiene a sua volta un pezzo (isola): profondita' 0, 1, 2
+def test_isola_nel_foro():
+    geometria = main_6.analizza_dxf(dxf([rettangolo_chiuso(0, 0, 100, 100), rettangolo_chiuso(10, 10, 80, 80),
+                                         rettangolo_chiuso(20, 20, 10, 10)]))
+    assert (geometria.n_pezzi, geometria.n_fori) == (2, 1)
+    assert geometria.area == pytest.approx(100 * 100 - 80 * 80 + 10 * 10)
+
+
+# La scansione per x trova gli stessi contenitori del confronto di ogni coppia
+def test_profondita_come_forza_bruta():
+    rnd = random.Random(7)
+    for _ in range(200):
+        contorni = []
+        for _ in range(rnd.randint(1, 25)):
+            x, y = rnd.randint(0, 20), rnd.randint(0, 20)
+            w, h = rnd.randint(1, 20), rnd.randint(1, 20)
+            contorni.append(((x, y, x + w, y + h), w * h * rnd.choice([0.5, 1]), 4))
+        attese = [sum(1 for j, (r, a, _) in enumerate(contorni)
+                      if j != i and a > area and r[0] <= x0 and r[1] <= y0 and r[2] >= x1 and r[3] >= y1)
+                  for i, ((x0, y0, x1, y1), area, _) in enumerate(contorni)]
+        assert main_6._profondita(contorni) == attese
+
+
+# La migrazione crea solo la tabella; i DXF gia' caricati li indicizza il comando
+def test_indicizzazione_solo_da_comando(database):
+    main_6.init_db(database)
+    contenuto = benchmark.dxf_rettangolo(120)
+    conn = sqlite3.connect(database)
+    hash_file = main_6.hashlib.sha256(contenuto).hexdigest()
+    os.makedirs(os.path.dirname(main_6.percorso_blob(hash_file)))
+    with open(main_6.percorso_blob(hash_file), 'wb') as f:
+        f.write(contenuto)
+    conn.execute("INSERT INTO distinte (codice, descrizione) VALUES ('D1', '')")
+    conn.execute("INSERT INTO componenti (id_distinta, nome, file, nome_file) VALUES (1, 'Lamiera', ?, 'l.dxf')",
+                  (hash_file,))
+    conn.execute("DELETE FROM geometrie_dxf")
+    conn.commit()
+    main_6._migrazione_geometrie_dxf(conn.cursor())
+    assert conn.execute("SELECT COUNT(*) FROM geometrie_dxf").fetchone()[0] == 0
+
+    esito = main_6.app.test_cli_runner().invoke(args=['indicizza-dxf'])
+    assert esito.exit_code == 0, esito.output
+    assert conn.execute("SELECT larghezza, altezza, n_pezzi FROM geometrie_dxf").fetchall() == [(120, 60, 1)]
+    conn.close()
@@ -0,0 +1,56 @@
+import itertools
+import random
+import sqlite3
+
+import numpy as np
+
+import benchmark
+import main_6
+
+
+# Confronto con l'ottimo per enumerazione di tutte le assegnazioni su istanze piccole
+def test_ottimizza_fornitori_contro_forza_bruta():
+    rnd = random.Random(11)
+    scarti = []
+    for _ in range(300):
+        costi, fissi, minimi = benchmark.istanza_fornitori(rnd, rnd.randint(2, 7), rnd.randint(2, 4))
+        offerte = [np.flatnonzero(np.isfinite(riga)) for riga in costi]
+        ottimo = min(main_6._costo_fornitori(costi, np.array(scelta), fissi, minimi)
+                     for scelta in itertools.product(*offerte))
+        assegnazione = main_6.ottimizza_fornitori(costi, fissi, minimi)
+        # Solo fornitori che hanno un prezzo per la riga
+        assert np.isfinite(costi[np.arange(len(costi)), assegnazione]).all()
+        trovato = main_6._costo_fornitori(costi, assegnazione, fissi, minimi)
+        assert trovato >= ottimo - 1e-6
+        # Mai peggio del prezzo piu' basso riga per riga
+        assert trovato <= main_6._costo_fornitori(costi, np.argmin(costi, axis=1), fissi, minimi) + 1e-6
+        # Nessuno spostamento di una sola riga migliora il risultato
+        for i, j in itertools.product(range(len(costi)), range(len(fissi))):
+            if np.isfinite(costi[i, j]):
+                spostata = assegnazione.copy()
+                spostata[i] = j
+                assert main_6._costo_fornitori(costi, spostata, fissi, minimi) >= trovato - 1e-6
+        scarti.append(trovato / ottimo - 1)
+    scarti = np.array(scarti)
+    assert np.mean(scarti < 1e-9) >= 0.97
+    assert scarti.mean() <= 0.01
+
+
+# Condizioni d'ordine non numeriche o negative: 400 senza toccare il fornitore
+def test_condizioni_fornitore_non_valide(database):
+    benchmark.genera_database(database, 5, 50, n_fornitori=3, n_ordini=5)
+    client = main_6.app.test_client()
+    conn = sqlite3.connect(database)
+    prima = conn.execute("SELECT costo_ordine, ordine_minimo FROM fornitori WHERE id = 1").fetchone()
+    for dati in ({'costo_ordine': 'abc'}, {'ordine_minimo': '-5'}, {'costo_ordine': 'nan'}):
+        assert client.post('/fornitore/1/condizioni', data=dati).status_code == 400
+        assert client.post('/nuovo-fornitore', data={
+            'nome': 'X', 'indirizzo': '', 'piva': '', 'email': '', 'telefono': '', 'iban': '',
+            'lavorazioni': '', **dati}).status_code == 400
+    assert conn.execute("SELECT costo_ordine, ordine_minimo FROM fornitori WHERE id = 1").fetchone() == prima
+    assert conn.execute("SELECT COUNT(*) FROM fornitori").fetchone()[0] == 3
+
+    assert client.post('/fornitore/99/condizioni', data={'costo_ordine': '10'}).status_code == 404
+    assert client.post('/fornitore/1/condizioni', data={'costo_ordine': '12,5', 'ordine_minimo': ''}).status_code == 302
+    assert conn.execute("SELECT costo_ordine, ordine_minimo FROM fornitori WHERE id = 1").fetchone() == (12.5, 0)
+    conn.close()
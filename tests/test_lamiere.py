@@ -0,0 +1,58 @@
+import math
+import random
+
+import pytest
+
+import main_6
+
+
+# Stesso first-fit decreasing height di impacca_rettangoli, un pezzo alla volta
+def impacca_uno_alla_volta(pezzi, formato, distanza, bordo):
+    L = formato[0] - 2 * bordo + distanza
+    H = formato[1] - 2 * bordo + distanza
+    disposti = []
+    fuori_formato = []
+    for i, (larghezza, altezza, quantita) in enumerate(pezzi):
+        lungo, corto = max(larghezza, altezza) + distanza, min(larghezza, altezza) + distanza
+        if lungo <= L and corto <= H:
+            disposti.append((lungo, corto, quantita))
+        elif corto <= L and lungo <= H:
+            disposti.append((corto, lungo, quantita))
+        else:
+            fuori_formato.append(i)
+    disposti.sort(key=lambda p: (p[1], p[0]), reverse=True)
+
+    fogli = []  # altezza libera
+    ripiani = []  # larghezza libera
+    for w, h, n in disposti:
+        for _ in range(math.ceil(n)):
+            ripiano = next((i for i, libera in enumerate(ripiani) if libera >= w), None)
+            if ripiano is None:
+                foglio = next((i for i, libera in enumerate(fogli) if libera >= h), None)
+                if foglio is None:
+                    fogli.append(H)
+                    foglio = len(fogli) - 1
+                fogli[foglio] -= h
+                ripiani.append(L)
+                ripiano = len(ripiani) - 1
+            ripiani[ripiano] -= w
+    return len(fogli), fuori_formato
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_stessi_fogli_del_piazzamento_singolo(seed):
+    rnd = random.Random(seed)
+    formato = rnd.choice([(3000.0, 1500.0), (2500.0, 1250.0), (2000.0, 1000.0)])
+    distanza, bordo = rnd.choice([0, 5.0]), rnd.choice([0, 10.0])
+    pezzi = [(float(rnd.randint(10, 1600)), float(rnd.randint(10, 1600)),
+              rnd.choice([1, 2, 5, rnd.randint(1, 300), rnd.uniform(0.5, 40)]))
+             for _ in range(rnd.randint(1, 40))]
+    assert main_6.impacca_rettangoli(pezzi, formato, distanza, bordo) == \
+        impacca_uno_alla_volta(pezzi, formato, distanza, bordo)
+
+
+def test_fuori_formato():
+    n_fogli, fuori = main_6.impacca_rettangoli([(100, 100, 3), (4000, 10, 1), (1400, 2900, 2)])
+    assert fuori == [1]
+    # Un pezzo 1400x2900 per foglio; negli 80 mm rimasti un ripiano da 105 non entra
+    assert n_fogli == 3
@@ -0,0 +1,57 @@
+import sqlite3
+from datetime import datetime
+
+import benchmark
+import main_6
+
+
+def scaglioni(conn, id_componente, id_fornitore, data):
+    return main_6.scaglioni_in_vigore(conn.cursor(), id_componente, id_fornitore, data)
+
+
+# Il prezzo concordato in un ordine manuale sostituisce solo lo scaglione che
+# vale per la quantita' ordinata; gli altri scaglioni restano
+def test_ordine_manuale_mantiene_gli_scaglioni(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+    main_6.registra_listino(c, 1, 1, [(1.0, 10.0), (100.0, 9.0), (500.0, 8.0)], '2020-01-01')
+    conn.commit()
+
+    risposta = main_6.app.test_client().post('/ordine-fornitore/manuale', data={
+        'riferimento_oc': 'OC-1', 'fornitore_esistente': '1',
+        'componente[]': ['1'], 'qty[]': ['200'], 'prezzo[]': ['8.5']})
+    assert risposta.status_code == 302
+    oggi = datetime.now().strftime('%Y-%m-%d')
+    assert scaglioni(conn, 1, 1, oggi) == [(1.0, 10.0), (100.0, 8.5), (500.0, 8.0)]
+    assert scaglioni(conn, 1, 1, '2021-01-01') == [(1.0, 10.0), (100.0, 9.0), (500.0, 8.0)]
+    conn.close()
+
+
+def test_concorda_prezzo_senza_listino(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+    c.execute("DELETE FROM listini_fornitori WHERE id_componente = 2 AND id_fornitore = 3")
+    main_6.concorda_prezzo(c, 2, 3, 40, 7.0, '2024-05-01')
+    assert scaglioni(conn, 2, 3, '2024-05-01') == [(1.0, 7.0)]
+    # Sotto il primo scaglione vale il primo
+    main_6.registra_listino(c, 2, 3, [(10.0, 6.0), (50.0, 5.0)], '2024-06-01')
+    main_6.concorda_prezzo(c, 2, 3, 4, 6.5, '2024-06-01')
+    assert scaglioni(conn, 2, 3, '2024-06-01') == [(10.0, 6.5), (50.0, 5.0)]
+    conn.close()
+
+
+# Fornitore non numerico o inesistente: nessuna versione di listino scritta
+def test_aggiungi_prezzo_fornitore_non_valido(database):
+    benchmark.genera_database(database, 5, 50, n_fornitori=3, n_ordini=5)
+    client = main_6.app.test_client()
+    conn = sqlite3.connect(database)
+    prima = conn.execute("SELECT COUNT(*) FROM listini_fornitori").fetchone()[0]
+    assert client.post('/componente/1/aggiungi-prezzo',
+                       data={'id_fornitore': 'abc', 'prezzo': '10'}).status_code == 400
+    assert client.post('/componente/1/aggiungi-prezzo',
+                       data={'id_fornitore': '99', 'prezzo': '10'}).status_code == 404
+    assert conn.execute("SELECT COUNT(*) FROM listini_fornitori").fetchone()[0] == prima
+    assert conn.execute("SELECT COUNT(*) FROM prezzi_fornitori WHERE id_fornitore = 99").fetchone()[0] == 0
+    conn.close()
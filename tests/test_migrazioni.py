@@ -0,0 +1,36 @@
+import sqlite3
+
+import main_6
+
+
+def versione(percorso):
+    conn = sqlite3.connect(percorso)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Senza init_db() esplicito (worker WSGI): la prima richiesta migra il database
+def test_prima_richiesta_migra(database):
+    risposta = main_6.app.test_client().get('/distinte')
+    assert risposta.status_code == 200
+    assert versione(database) == main_6.MIGRAZIONI[-1][0]
+
+
+def test_comando_flask_migra(database):
+    esito = main_6.app.test_cli_runner().invoke(args=['pulisci-allegati'])
+    assert esito.exit_code == 0, esito.output
+    assert versione(database) == main_6.MIGRAZIONI[-1][0]
+
+
+# Migrazioni gia' applicate: una seconda volta non cambiano nulla
+def test_migrazioni_idempotenti(database):
+    main_6.init_db(database)
+    conn = sqlite3.connect(database)
+    schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    conn.close()
+    main_6.init_db(database)
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    conn.close()
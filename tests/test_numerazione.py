@@ -0,0 +1,15 @@
+import benchmark
+
+
+# Scrittori in piu' processi e thread sullo stesso database: nessun errore,
+# numeri tutti diversi e, per ogni anno, esattamente 1..N con N il contatore
+def test_numerazione_senza_buchi_ne_doppioni(database):
+    benchmark.genera_database(database, 24, 100, n_fornitori=6, n_ordini=5)
+    esito = benchmark.prova_numerazione(database, 24, processi=2, thread=3, n_fornitori=6)
+
+    assert esito.errori == []
+    assert esito.richieste == 24
+    assert esito.numeri
+    assert len(set(esito.numeri)) == len(esito.numeri)
+    for anno, progressivi in benchmark.progressivi_per_anno(esito.numeri).items():
+        assert sorted(progressivi) == list(range(1, esito.contatori[f"ordini-{anno}"] + 1))
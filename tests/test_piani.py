@@ -0,0 +1,9 @@
+import benchmark
+
+
+# Le query delle pagine usano gli indici: nessuna tabella grande letta per
+# intero (EXPLAIN QUERY PLAN delle SELECT eseguite da ogni pagina)
+def test_nessuna_scansione_completa(database):
+    benchmark.genera_database(database, 200, 5000, n_ordini=300)
+    errori = benchmark.scansioni_complete(database)
+    assert errori == [], "\n".join(f"{url}: {tabella}: {dettaglio}" for url, tabella, dettaglio, _ in errori)
@@ -0,0 +1,37 @@
+import benchmark
+import main_6
+from test_distinte import modulo_componente
+
+
+def ultima_revisione(c, id_distinta):
+    c.execute("SELECT COALESCE(MAX(numero), 0) FROM revisioni_distinta WHERE id_distinta = ?", (id_distinta,))
+    return c.fetchone()[0]
+
+
+def test_aggiunta_registra_revisione(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    c = main_6._apri_connessione(database).cursor()
+    prima = ultima_revisione(c, 1)
+    risposta = main_6.app.test_client().post('/distinta/1/aggiungi-componente',
+                                             data=modulo_componente(tipo='Acquisto'))
+    assert risposta.status_code == 302
+    assert ultima_revisione(c, 1) == prima + 1
+    c.execute("SELECT id FROM componenti WHERE id_distinta = 1")
+    componenti = {riga[0] for riga in c.fetchall()}
+    assert set(main_6.stato_revisione(c, 1, prima + 1)) == componenti
+
+
+# Se la revisione non si puo' salvare non resta nemmeno il componente
+def test_revisione_nella_stessa_transazione(database, monkeypatch):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+
+    def fallisce(*argomenti):
+        raise RuntimeError("revisione non salvata")
+
+    monkeypatch.setattr(main_6, '_salva_revisione', fallisce)
+    risposta = main_6.app.test_client().post('/distinta/1/aggiungi-componente',
+                                             data=modulo_componente(tipo='Acquisto'))
+    assert risposta.status_code == 500
+    c = main_6._apri_connessione(database).cursor()
+    c.execute("SELECT COUNT(*) FROM componenti WHERE nome = 'Piastra'")
+    assert c.fetchone()[0] == 0
@@ -0,0 +1,84 @@
+import sqlite3
+
+import benchmark
+import main_6
+
+
+def test_nessun_contatore_condiviso(database):
+    main_6.init_db(database)
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'versione_ricerca'").fetchone()[0] == 0
+    trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'componenti'")
+    assert not any('versione_ricerca' in sql for sql, in trigger)
+    conn.close()
+
+
+# Le parole per le correzioni tenute in memoria si aggiornano quando un'altra
+# connessione modifica l'indice, anche con un aggiornamento o una cancellazione
+def test_correzioni_seguono_le_modifiche(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    lettore = main_6._apri_connessione(database).cursor()
+    scrittore = sqlite3.connect(database)
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+
+    scrittore.execute("UPDATE componenti SET nome = 'Flangiatura' WHERE id = 1")
+    scrittore.commit()
+    assert 'flangiatura' in main_6.termini_simili(lettore, 'flangiatora')
+    risultato = main_6.cerca_componenti(lettore, 'flangiatora')
+    assert [riga.id for riga in risultato.righe] == [1]
+
+    scrittore.execute("DELETE FROM componenti WHERE id = 1")
+    scrittore.commit()
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+    scrittore.close()
+
+
+# Le scritture della connessione stessa: confermate o annullate, le parole
+# in memoria per le altre connessioni restano quelle del database
+def test_correzioni_con_scritture_della_connessione(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    scrittore = main_6._apri_connessione(database)
+    lettore = main_6._apri_connessione(database).cursor()
+    assert 'flangiatura' not in main_6.termini_simili(scrittore.cursor(), 'flangiatora')
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+
+    scrittore.execute("BEGIN")
+    scrittore.execute("UPDATE componenti SET nome = 'Flangiatura' WHERE id = 1")
+    assert 'flangiatura' in main_6.termini_simili(scrittore.cursor(), 'flangiatora')
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+    scrittore.rollback()
+    assert 'flangiatura' not in main_6.termini_simili(scrittore.cursor(), 'flangiatora')
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+
+    scrittore.execute("UPDATE componenti SET nome = 'Flangiatura' WHERE id = 1")
+    scrittore.commit()
+    assert 'flangiatura' in main_6.termini_simili(scrittore.cursor(), 'flangiatora')
+    assert 'flangiatura' in main_6.termini_simili(lettore, 'flangiatora')
+    scrittore.close()
+    lettore.connection.close()
+
+
+# Ricostruzioni e svuotamenti dell'indice FTS5 riscrivono le sue tabelle
+# interne: le correzioni seguono comunque il vocabolario
+def test_correzioni_dopo_ricostruzione_indice(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    lettore = main_6._apri_connessione(database).cursor()
+    scrittore = sqlite3.connect(database)
+    assert 'flangiatura' not in main_6.termini_simili(lettore, 'flangiatora')
+    assert 'particolare' in main_6.termini_simili(lettore, 'particolar')
+
+    scrittore.execute("INSERT INTO cerca_componenti (cerca_componenti) VALUES ('delete-all')")
+    scrittore.commit()
+    assert main_6.termini_simili(lettore, 'particolar') == []
+
+    # Modifica senza trigger e indice ricostruito dal contenuto, come dopo un import
+    trigger, = scrittore.execute("SELECT sql FROM sqlite_master WHERE name = 'cerca_componente_modificato'").fetchone()
+    scrittore.execute("DROP TRIGGER cerca_componente_modificato")
+    scrittore.execute("UPDATE componenti SET nome = 'Flangiatura' WHERE id = 1")
+    scrittore.execute(trigger)
+    scrittore.execute("INSERT INTO cerca_componenti (cerca_componenti) VALUES ('rebuild')")
+    scrittore.commit()
+    assert 'flangiatura' in main_6.termini_simili(lettore, 'flangiatora')
+    assert 'particolare' in main_6.termini_simili(lettore, 'particolar')
+    scrittore.close()
+    lettore.connection.close()
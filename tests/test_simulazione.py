@@ -0,0 +1,84 @@
+import random
+import sqlite3
+import time
+
+import pytest
+from flask import template_rendered
+
+import benchmark
+import main_6
+
+
+def test_leggi_quantita():
+    assert main_6.leggi_quantita("1, 10-14, 20-30:5").tolist() == [1, 10, 11, 12, 13, 14, 20, 25, 30]
+
+
+# Un intervallo enorme e' rifiutato prima di essere generato
+def test_intervallo_oltre_il_limite():
+    inizio = time.perf_counter()
+    with pytest.raises(ValueError):
+        main_6.leggi_quantita("1-1000000000000")
+    assert time.perf_counter() - inizio < 1
+
+
+@pytest.mark.parametrize('testo', ["", "0", "a", "1-x", "1-10:0", "5-1"])
+def test_quantita_non_valide(testo):
+    with pytest.raises(ValueError):
+        main_6.leggi_quantita(testo)
+
+
+@pytest.mark.parametrize('richiesta', [
+    {'distinte': '1,x'},
+    {'distinte': ['1', None]},
+    {'scenari': {'Acciaio': 1.08}},
+    {'scenari': {'Acciaio': {'S235': 'molto'}}},
+    {'scenari': ['Acciaio']},
+    {'quantita': '1-1000000000'},
+])
+def test_parametri_non_validi(database, richiesta):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    risposta = main_6.app.test_client().post('/api/simulazione', json=richiesta)
+    assert risposta.status_code == 400
+    assert 'errore' in risposta.get_json()
+
+
+def test_simulazione(database):
+    benchmark.genera_database(database, 5, 50, n_ordini=5)
+    risposta = main_6.app.test_client().post('/api/simulazione', json={
+        'distinte': [1, 2], 'quantita': '1-3', 'scenari': {'Acciaio +10%': {'*': 1.1}}})
+    assert risposta.status_code == 200
+    dati = risposta.get_json()
+    assert dati['quantita'] == [1, 2, 3]
+    assert [d['id'] for d in dati['distinte']] == [1, 2]
+    for distinta in dati['distinte']:
+        base, aumentato = distinta['costo_unitario']
+        assert aumentato == pytest.approx([costo * 1.1 for costo in base], abs=1e-3)
+
+
+# Con gli scaglioni di listino la riga degli scenari a quantita' N e' il totale
+# della tabella della simulazione a N pezzi, sottodistinte comprese
+def test_scenari_come_tabella_a_scaglioni(database):
+    benchmark.genera_database(database, 6, 120, n_fornitori=4, n_ordini=5)
+    conn = sqlite3.connect(database)
+    benchmark.collega_distinte(conn, random.Random(3), 6)
+    conn.close()
+    quantita = [1, 4, 7, 25, 60, 100, 333, 1000]
+
+    contesti = []
+    with template_rendered.connected_to(lambda _, template, context, **__: contesti.append(context), main_6.app):
+        client = main_6.app.test_client()
+        for qty in quantita:
+            risposta = client.post('/simula/1', data={
+                'qty': qty, 'quantita': ', '.join(map(str, reversed(quantita))), 'scenari': ''})
+            assert risposta.status_code == 200
+
+    unitari = []
+    for qty, contesto in zip(quantita, contesti):
+        tabella = dict(contesto['tabella_scenari'][1])
+        totale = sum(r[2] * r[3] for r in contesto['risultati'])
+        assert tabella[qty][0] == pytest.approx(totale, rel=1e-9)
+        assert tabella[qty][0] == pytest.approx(contesto['costo_totale'], abs=0.01 * len(contesto['risultati']))
+        assert any(r[5] for r in contesto['risultati'])
+        unitari.append(totale / qty)
+    # Gli scaglioni abbassano davvero il costo per pezzo
+    assert unitari[-1] < unitari[0]